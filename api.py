@@ -3,17 +3,32 @@ import asyncio
 import os
 import requests
 import logging
-from flask import Flask, jsonify, request, session, redirect, url_for, flash
+from flask import Flask, jsonify, request, session, redirect, url_for, flash, send_file
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room
 from telegram import Update, Bot
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 from threading import Thread
+from werkzeug.datastructures import FileStorage
 from config import BOT_TOKEN, DASHBOARD_PASSWORD, CHANNEL_ID, GROUP_INVITE_LINK, CHANNEL_URL, ADMIN_USER_ID
 import datetime
 import traceback
 import signal
 import functools
+import time
+import heapq
+import shutil
+import threading
+import hashlib
+import hmac
+import atexit
+import queue
+import itertools
+import string
+import mimetypes
+import struct
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import Future
 
 from db import init_db
 
@@ -26,6 +41,11 @@ import config  # config.py should have BOT_TOKEN, API_ID, API_HASH, CHAT_ID, WEL
 from telegram.ext import filters as tg_filters
 from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAudio
 from telegram.request import HTTPXRequest as Request
+from telegram.error import RetryAfter
+try:
+    import fcntl
+except ImportError:  # Windows: the send budget is per process
+    fcntl = None
 import json
 import uuid
 
@@ -109,6 +129,9 @@ socketio = SocketIO(app, async_mode='threading', cors_allowed_origins=[
 
 DB_NAME = 'users.db'
 
+# Bot API server (override to point at a local Bot API server or fake_telegram.py)
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/')
+
 # Ensure DB tables exist
 init_db()
 
@@ -148,7 +171,50 @@ def migrate_database():
         current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         c.execute('UPDATE users SET created_at = ? WHERE created_at IS NULL', (current_time,))
         print("✅ created_at column added")
-    
+
+    try:
+        # Check if delivery_status column exists
+        c.execute('SELECT delivery_status FROM users LIMIT 1')
+        print("✅ delivery_status column exists")
+    except sqlite3.OperationalError:
+        print("🔄 Adding delivery_status column...")
+        c.execute('ALTER TABLE users ADD COLUMN delivery_status TEXT')
+        print("✅ delivery_status column added")
+
+    try:
+        # Check if delivery_checked_at column exists
+        c.execute('SELECT delivery_checked_at FROM users LIMIT 1')
+        print("✅ delivery_checked_at column exists")
+    except sqlite3.OperationalError:
+        print("🔄 Adding delivery_checked_at column...")
+        c.execute('ALTER TABLE users ADD COLUMN delivery_checked_at TEXT')
+        print("✅ delivery_checked_at column added")
+
+    try:
+        # Check if scheduled_broadcasts.broadcast_id column exists
+        c.execute('SELECT broadcast_id FROM scheduled_broadcasts LIMIT 1')
+        print("✅ scheduled_broadcasts.broadcast_id column exists")
+    except sqlite3.OperationalError:
+        print("🔄 Adding scheduled_broadcasts.broadcast_id column...")
+        c.execute('ALTER TABLE scheduled_broadcasts ADD COLUMN broadcast_id INTEGER')
+        print("✅ scheduled_broadcasts.broadcast_id column added")
+
+    try:
+        # Check if join_requests.claimed_at column exists
+        c.execute('SELECT claimed_at FROM join_requests LIMIT 1')
+        print("✅ join_requests.claimed_at column exists")
+    except sqlite3.OperationalError:
+        print("🔄 Adding join_requests.claimed_at column...")
+        c.execute('ALTER TABLE join_requests ADD COLUMN claimed_at INTEGER')
+        print("✅ join_requests.claimed_at column added")
+
+    # Indexes used by broadcast audience segments
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_label ON users (label)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_delivery_status ON users (delivery_status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp ON messages (user_id, timestamp)')
+
     conn.commit()
     conn.close()
     print("✅ Database migration completed")
@@ -156,7 +222,386 @@ def migrate_database():
 # Run migration
 migrate_database()
 
+# --- Telegram file locator ---
+# Message rows store "tg-file:<file_id>" instead of a download URL: Bot API file
+# paths expire and the URL embeds the bot token. File ids are resolved on demand.
+FILE_REF_PREFIX = 'tg-file:'
+FILE_PATH_TTL = 50 * 60  # getFile paths are valid for at least an hour
+FILE_PATH_CACHE_SIZE = 10000
+FILE_LOOKUP_TIMEOUT = 10
+FILE_LOOKUP_RATE = float(os.environ.get('FILE_LOOKUP_RATE', 20))  # getFile calls per second for the process; 0 disables
+FILE_LOOKUP_BURST = 20
+
+class TelegramFileCache:
+    """Shared getFile cache (file_id -> file_path) with a TTL and single-flight lookups.
+
+    Concurrent requests for the same file_id wait for the one getFile call
+    already in flight instead of issuing their own. Calls that do go out are
+    paced by a token bucket of FILE_LOOKUP_RATE per second.
+    """
+
+    def __init__(self, ttl=FILE_PATH_TTL, size=FILE_PATH_CACHE_SIZE, rate=FILE_LOOKUP_RATE, burst=FILE_LOOKUP_BURST):
+        self.ttl = ttl
+        self.size = size
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.tokens_at = time.monotonic()
+        self.entries = OrderedDict()  # file_id -> (file_path, expires_at)
+        self.inflight = {}  # file_id -> Future of the running lookup
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def wait_for_slot(self):
+        """Block until the getFile rate allows another call"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.tokens_at) * self.rate)
+            self.tokens_at = now
+            # Reserve the token now; a negative balance is the queue of waiting callers
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            self.counters['throttled'] += 1
+            time.sleep(delay)
+
+    def lookup(self, file_id):
+        """One getFile call; returns the file path or None"""
+        self.wait_for_slot()
+        self.counters['get_file'] += 1
+        try:
+            response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getFile", params={'file_id': file_id}, timeout=FILE_LOOKUP_TIMEOUT)
+            if response.status_code == 200:
+                data = response.json()
+                if data.get('ok'):
+                    return data['result'].get('file_path')
+            print(f"⚠️ getFile failed for {file_id}: {response.status_code}")
+        except Exception as e:
+            print(f"⚠️ getFile error for {file_id}: {e}")
+        return None
+
+    def file_path(self, file_id, refresh=False):
+        """Cached file path for file_id, or None if Telegram doesn't know it"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(file_id)
+            if entry and not refresh and entry[1] > now:
+                self.entries.move_to_end(file_id)
+                self.counters['hits'] += 1
+                return entry[0]
+            future = self.inflight.get(file_id)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[file_id] = future
+                self.counters['misses'] += 1
+            else:
+                self.counters['coalesced'] += 1
+        if not owner:
+            return future.result(timeout=FILE_LOOKUP_TIMEOUT + 5)
+
+        file_path = None
+        try:
+            file_path = self.lookup(file_id)
+        finally:
+            with self.lock:
+                if file_path:
+                    self.entries[file_id] = (file_path, time.monotonic() + self.ttl)
+                    self.entries.move_to_end(file_id)
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+                self.inflight.pop(file_id, None)
+            future.set_result(file_path)
+        return file_path
+
+    def url(self, file_id, refresh=False):
+        """Download URL for file_id (server side only: it contains the bot token)"""
+        file_path = self.file_path(file_id, refresh=refresh)
+        if not file_path:
+            return None
+        if file_path.startswith('http'):
+            return file_path
+        return f"{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}/{file_path}"
+
+    async def url_async(self, file_id):
+        return await asyncio.get_running_loop().run_in_executor(None, self.url, file_id)
+
+    def invalidate(self, file_id):
+        with self.lock:
+            self.entries.pop(file_id, None)
+
+    def stats(self):
+        return {'cached': len(self.entries), 'inflight': len(self.inflight), **self.counters}
+
+telegram_files = TelegramFileCache()
+
+def file_ref(file_id):
+    """Value stored in message rows for a Telegram file"""
+    return f"{FILE_REF_PREFIX}{file_id}"
+
+def public_media_url(value, media_base):
+    """Dashboard URL for a stored file reference or a legacy Bot API download URL"""
+    if not value:
+        return value
+    if value.startswith(FILE_REF_PREFIX):
+        return f"{media_base}{value[len(FILE_REF_PREFIX):]}"
+    # Older rows hold the full download URL, bot token included
+    marker = f"/file/bot{BOT_TOKEN}/"
+    if marker in value:
+        return f"{media_base}{value.split(marker, 1)[1]}"
+    return value
+
+def public_photo_url(value):
+    """Dashboard URL for a users.photo_url value, served by this host's /media route"""
+    return public_media_url(value, f"{request.host_url}media/")
+
+def public_media_message(message, media_base):
+    """Rewrite the media reference in a "[tag]..." message for the dashboard"""
+    if not message or not message.startswith('[') or ']' not in message:
+        return message
+    end = message.index(']') + 1
+    tag, body = message[:end], message[end:]
+    if tag == '[group_media]':
+        try:
+            data = json.loads(body)
+            for item in data.get('items', []):
+                item['file_url'] = public_media_url(item.get('file_url'), media_base)
+            return tag + json.dumps(data)
+        except (ValueError, AttributeError):
+            return message
+    return tag + public_media_url(body, media_base)
+
+# --- Local media mirror ---
+# Media is copied into a content-addressed store (<dir>/<sha256[:2]>/<sha256>) as
+# soon as its message is saved, so the dashboard is served from disk instead of
+# re-downloading from Telegram on every chat open. Least recently used blobs are
+# evicted once the store grows past MEDIA_MIRROR_MAX_BYTES.
+MEDIA_MIRROR_DIR = os.environ.get('MEDIA_MIRROR_DIR', 'media_mirror')
+MEDIA_MIRROR_MAX_BYTES = int(os.environ.get('MEDIA_MIRROR_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+MEDIA_MIRROR_WORKERS = 2
+MEDIA_MIRROR_QUEUE_SIZE = 1000
+MEDIA_MIRROR_CHUNK = 256 * 1024
+MEDIA_MIRROR_EVICT_TO = 0.9  # eviction frees headroom down to this share of max_bytes
+MEDIA_MIRROR_TOTAL_REFRESH = 60  # seconds; re-read the store size so other processes' writes count too
+
+class MediaMirror:
+    """Background prefetcher and LRU-capped local store for Telegram media"""
+
+    def __init__(self, directory=MEDIA_MIRROR_DIR, max_bytes=MEDIA_MIRROR_MAX_BYTES,
+                 workers=MEDIA_MIRROR_WORKERS, queue_size=MEDIA_MIRROR_QUEUE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = set()  # file_ids queued or downloading
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        # Running size of the store, so a write only scans the table when eviction is due
+        self.total_bytes = None
+        self.total_at = 0
+
+    def blob_path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def start(self):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for _ in range(self.workers - len(self.threads)):
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def prefetch(self, file_id):
+        """Queue file_id for download; never blocks the caller"""
+        if not file_id or self.max_bytes <= 0:
+            return
+        with self.lock:
+            if file_id in self.pending:
+                return
+            self.pending.add(file_id)
+        if len(self.threads) < self.workers:
+            self.start()
+        try:
+            self.queue.put_nowait(file_id)
+        except queue.Full:
+            with self.lock:
+                self.pending.discard(file_id)
+            self.counters['dropped'] += 1
+
+    def prefetch_ref(self, value):
+        """Prefetch the file behind a stored "tg-file:<file_id>" reference"""
+        if value and value.startswith(FILE_REF_PREFIX):
+            self.prefetch(value[len(FILE_REF_PREFIX):])
+
+    def run(self):
+        while True:
+            file_id = self.queue.get()
+            try:
+                if self.lookup(file_id, touch=False) is None:
+                    self.download(file_id)
+            except Exception as e:
+                self.counters['failed'] += 1
+                print(f"⚠️ Could not mirror media {file_id}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(file_id)
+                self.queue.task_done()
+
+    def download(self, file_id):
+        file_url = telegram_files.url(file_id)
+        if not file_url:
+            self.counters['failed'] += 1
+            return
+        response = requests.get(file_url, stream=True, timeout=60)
+        try:
+            if response.status_code != 200:
+                self.counters['failed'] += 1
+                return
+            # The Bot API usually answers application/octet-stream; the file path's extension says more
+            content_type = mimetypes.guess_type(file_url)[0] or response.headers.get('Content-Type') or 'application/octet-stream'
+            self.write_blob(file_id, response.iter_content(MEDIA_MIRROR_CHUNK), content_type)
+            self.counters['downloaded'] += 1
+        finally:
+            response.close()
+
+    def store_upload(self, file_id, upload):
+        """Mirror an admin upload from its request stream, without downloading it back.
+
+        An upload is copied once, under the first file_id Telegram returns for it.
+        """
+        if not file_id or self.max_bytes <= 0 or upload.mirrored_file_id is not None:
+            return
+        upload.mirrored_file_id = file_id
+        if self.lookup(file_id, touch=False) is not None:
+            return
+        stream = upload.file.stream
+        stream.seek(0)
+        try:
+            self.write_blob(file_id, iter(lambda: stream.read(MEDIA_MIRROR_CHUNK), b''), upload.content_type)
+            self.counters['stored'] += 1
+        except Exception as e:
+            print(f"⚠️ Could not mirror upload {upload.filename}: {e}")
+        finally:
+            stream.seek(0)
+
+    def write_blob(self, file_id, chunks, content_type):
+        """Stream chunks into the store under their sha256 and index them by file_id"""
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        temp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.blob_path(sha256)
+            if os.path.exists(path):
+                self.counters['deduplicated'] += 1
+                added = 0
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                added = size
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        c.execute('INSERT OR REPLACE INTO media_mirror (file_id, sha256, size, content_type, last_used) VALUES (?, ?, ?, ?, ?)',
+                  (file_id, sha256, size, content_type, now))
+        conn.commit()
+        conn.close()
+        if self.add_bytes(added) > self.max_bytes:
+            self.evict()
+
+    def add_bytes(self, size):
+        """Add size to the running store total and return it"""
+        now = time.monotonic()
+        if self.total_bytes is None or now - self.total_at > MEDIA_MIRROR_TOTAL_REFRESH:
+            total = self.stored_bytes()
+            with self.lock:
+                self.total_bytes, self.total_at = total, now
+            return total
+        with self.lock:
+            self.total_bytes += size
+            return self.total_bytes
+
+    def stored_bytes(self):
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        c.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM media_mirror GROUP BY sha256)')
+        total = c.fetchone()[0]
+        conn.close()
+        return total
+
+    def lookup(self, file_id, touch=True):
+        """(path, content_type) of a mirrored file, or None"""
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        c.execute('SELECT sha256, content_type FROM media_mirror WHERE file_id = ?', (file_id,))
+        row = c.fetchone()
+        if row is not None and touch:
+            c.execute('UPDATE media_mirror SET last_used = ? WHERE file_id = ?',
+                      (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), file_id))
+            conn.commit()
+        conn.close()
+        if row is None:
+            return None
+        path = self.blob_path(row[0])
+        if not os.path.exists(path):
+            return None
+        return path, row[1]
+
+    def evict(self):
+        """Delete least recently used blobs until the store is back under MEDIA_MIRROR_EVICT_TO of max_bytes"""
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        c.execute('SELECT sha256, MAX(size), MAX(last_used) AS used FROM media_mirror GROUP BY sha256 ORDER BY used ASC')
+        blobs = c.fetchall()
+        total = sum(size for _, size, _ in blobs)
+        evicted = []
+        target = self.max_bytes * MEDIA_MIRROR_EVICT_TO
+        for sha256, size, _ in blobs:
+            if total <= target:
+                break
+            evicted.append(sha256)
+            total -= size
+        with self.lock:
+            self.total_bytes, self.total_at = total, time.monotonic()
+        if evicted:
+            c.executemany('DELETE FROM media_mirror WHERE sha256 = ?', [(sha256,) for sha256 in evicted])
+            conn.commit()
+        conn.close()
+        for sha256 in evicted:
+            try:
+                os.remove(self.blob_path(sha256))
+            except OSError:
+                pass
+        self.counters['evicted'] += len(evicted)
+
+    def stats(self):
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (SELECT sha256, MAX(size) AS size FROM media_mirror GROUP BY sha256)')
+        blobs, total = c.fetchone()
+        conn.close()
+        return {'blobs': blobs, 'bytes': total, 'max_bytes': self.max_bytes, 'queued': self.queue.qsize(), **self.counters}
+
+media_mirror = MediaMirror()
+
 # Helper function to detect GIF files
+GIF_RANGE_TIMEOUT = 3  # seconds
+GIF_VERDICT_CACHE_SIZE = 10000
+GIF_VERDICTS = OrderedDict()  # file_unique_id -> is GIF
+
 def is_gif_file(file_path, mimetype=None, original_filename=None):
     """Detect if a file is a GIF based on path, mimetype, and original filename"""
     if not file_path:
@@ -238,18 +683,53 @@ def is_gif_by_header(file_path):
     except:
         return False
 
-def is_gif_by_url(url):
-    """Download file and check if it's a GIF by examining the header"""
+def is_gif_by_url(url, timeout=GIF_RANGE_TIMEOUT):
+    """Check if a remote file is a GIF by fetching only its first 6 bytes"""
     try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            # Read first 6 bytes to check GIF header
-            header = response.raw.read(6)
-            return header.startswith(b'GIF87a') or header.startswith(b'GIF89a')
-    except:
-        pass
+        response = requests.get(url, headers={'Range': 'bytes=0-5'}, stream=True, timeout=timeout)
+        try:
+            if response.status_code in (200, 206):
+                header = response.raw.read(6)
+                return header.startswith(b'GIF87a') or header.startswith(b'GIF89a')
+        finally:
+            response.close()
+    except Exception as e:
+        print(f"Could not check GIF header for {url}: {e}")
     return False
 
+def gif_verdict_from_message(message):
+    """Decide from the update itself whether it carries a GIF, or None if it can't tell"""
+    if message.animation:
+        return True
+    if message.photo:
+        # Telegram re-encodes photos as JPEG; GIFs always arrive as animations
+        return False
+    document = message.document
+    if document:
+        if (document.mime_type or '').lower() == 'image/gif' or (document.file_name or '').lower().endswith('.gif'):
+            return True
+        if document.mime_type:
+            return False
+    return None
+
+async def detect_gif(message, media):
+    """GIF verdict for an inbound media object, cached by file_unique_id.
+
+    Only falls back to a Range request (through the shared getFile cache) when the update doesn't say.
+    """
+    key = media.file_unique_id
+    if key in GIF_VERDICTS:
+        GIF_VERDICTS.move_to_end(key)
+        return GIF_VERDICTS[key]
+    verdict = gif_verdict_from_message(message)
+    if verdict is None:
+        file_url = await telegram_files.url_async(media.file_id)
+        verdict = bool(file_url) and await asyncio.get_running_loop().run_in_executor(None, is_gif_by_url, file_url)
+    GIF_VERDICTS[key] = verdict
+    while len(GIF_VERDICTS) > GIF_VERDICT_CACHE_SIZE:
+        GIF_VERDICTS.popitem(last=False)
+    return verdict
+
 # --- Database helpers ---
 def get_all_users():
     conn = sqlite3.connect(DB_NAME)
@@ -387,6 +867,421 @@ def get_user_online_status(user_id, minutes=5):
     conn.close()
     return is_online
 
+# --- Broadcast audience segments ---
+SEGMENT_CHUNK_SIZE = 500
+SEGMENT_COLUMNS = 'u.user_id, u.full_name, u.username, u.join_date, u.invite_link, u.photo_url, u.label'
+
+def parse_segment(source):
+    """Read broadcast segment filters from a form/dict (label, join_from, join_to, referred_by, messaged_since, not_blocked)"""
+    segment = {}
+    for key in ('label', 'join_from', 'join_to', 'messaged_since'):
+        value = (source.get(key) or '').strip()
+        if value:
+            segment[key] = value
+    referred_by = (source.get('referred_by') or '').strip()
+    if referred_by:
+        segment['referred_by'] = int(referred_by)
+    # Undeliverable users are skipped unless explicitly requested with not_blocked=0
+    not_blocked = str(source.get('not_blocked', '1')).strip().lower()
+    if not_blocked not in ('0', 'false', 'no', 'off'):
+        segment['not_blocked'] = True
+    # Date-only upper bound should include the whole day
+    if len(segment.get('join_to', '')) == 10:
+        segment['join_to'] += ' 23:59:59'
+    return segment
+
+def build_segment_where(segment):
+    """Build the WHERE clause and params for a segment over the users table (aliased u)"""
+    clauses = []
+    params = []
+    if segment.get('label'):
+        clauses.append('u.label = ?')
+        params.append(segment['label'])
+    if segment.get('join_from'):
+        clauses.append('u.join_date >= ?')
+        params.append(segment['join_from'])
+    if segment.get('join_to'):
+        clauses.append('u.join_date <= ?')
+        params.append(segment['join_to'])
+    if segment.get('referred_by') is not None:
+        clauses.append('u.referred_by = ?')
+        params.append(segment['referred_by'])
+    if segment.get('messaged_since'):
+        clauses.append("EXISTS (SELECT 1 FROM messages m WHERE m.user_id = u.user_id AND m.timestamp >= ? AND m.sender = 'user')")
+        params.append(segment['messaged_since'])
+    if segment.get('not_blocked'):
+        clauses.append("(u.delivery_status IS NULL OR u.delivery_status = 'ok')")
+    where = ' AND '.join(clauses) if clauses else '1 = 1'
+    return where, params
+
+def count_segment_users(segment):
+    """Count the audience of a broadcast segment"""
+    where, params = build_segment_where(segment)
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute(f'SELECT COUNT(*) FROM users u WHERE {where}', params)
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+def iter_segment_users(segment, chunk_size=SEGMENT_CHUNK_SIZE, columns=SEGMENT_COLUMNS):
+    """Stream the users of a segment in user_id order, one chunk at a time.
+
+    Uses keyset pagination so only one chunk is held in memory and no read
+    lock is kept open while messages are being sent between chunks.
+    """
+    where, params = build_segment_where(segment)
+    query = f'SELECT {columns} FROM users u WHERE {where} AND u.user_id > ? ORDER BY u.user_id LIMIT ?'
+    last_id = None
+    conn = sqlite3.connect(DB_NAME)
+    try:
+        while True:
+            c = conn.cursor()
+            c.execute(query, params + [last_id if last_id is not None else -2 ** 63, chunk_size])
+            rows = c.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+    finally:
+        conn.close()
+
+# --- Outbound dispatcher ---
+PRIORITY_INTERACTIVE = 0  # admin replies from the dashboard
+PRIORITY_NOTIFICATION = 1  # welcome DMs and receptionist/referrer notifications
+PRIORITY_BULK = 2  # broadcasts and background jobs
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_NOTIFICATION: 'notification', PRIORITY_BULK: 'bulk'}
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', 30))  # sends per second across all chats, 0 = unlimited
+OUTBOUND_BURST = 30
+CHAT_RATE = 1.0  # sends per second to a single chat
+CHAT_BURST = 3
+CHAT_BUCKETS_MAX = 10000
+OUTBOUND_BUDGET_FILE = os.environ.get('OUTBOUND_BUDGET_FILE', 'outbound_budget.state')
+# Tokens a send of each priority must leave in the shared bucket, so bulk traffic
+# in one process can never use up the headroom replies and notifications need in another
+OUTBOUND_RESERVE = {PRIORITY_INTERACTIVE: 0, PRIORITY_NOTIFICATION: 3, PRIORITY_BULK: 8}
+
+class SharedSendBudget:
+    """Global token bucket and 429 pause shared by the web and bot processes.
+
+    The state lives in a small file updated under an exclusive flock, so every
+    process started by start_bots draws from the same OUTBOUND_RATE. Without
+    fcntl (Windows) the bucket falls back to this process only.
+    """
+
+    STATE = struct.Struct('<ddd')  # tokens, updated_at, paused_until (wall clock)
+
+    def __init__(self, path=OUTBOUND_BUDGET_FILE, rate=OUTBOUND_RATE, burst=OUTBOUND_BURST, reserve=OUTBOUND_RESERVE):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.fd = None
+        self.pid = None
+        self.local = (burst, time.time(), 0.0)
+
+    def transact(self, change):
+        """Apply change(state, now) -> (new_state, result) atomically across processes"""
+        now = time.time()
+        if fcntl is None:
+            self.local, result = change(self.local, now)
+            return result
+        if self.fd is None or self.pid != os.getpid():
+            # flock is held per open file, so each process needs its own descriptor rather than one inherited across fork
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self.pid = os.getpid()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            data = os.pread(self.fd, self.STATE.size, 0)
+            state = self.STATE.unpack(data) if len(data) == self.STATE.size else (self.burst, now, 0.0)
+            state, result = change(state, now)
+            os.pwrite(self.fd, self.STATE.pack(*state), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return result
+
+    def refill(self, tokens, updated_at, now):
+        if self.rate <= 0:
+            return tokens
+        return min(self.burst, tokens + max(0, now - updated_at) * self.rate)
+
+    def take(self, priority):
+        """Take a token for a send of this priority; returns 0, or the seconds to wait before trying again"""
+        def change(state, now):
+            tokens, updated_at, paused_until = state
+            tokens = self.refill(tokens, updated_at, now)
+            if paused_until > now:
+                return (tokens, now, paused_until), paused_until - now
+            if self.rate <= 0:
+                return (tokens, now, paused_until), 0
+            need = 1 + self.reserve.get(priority, 0)
+            if tokens < need:
+                return (tokens, now, paused_until), (need - tokens) / self.rate
+            return (tokens - 1, now, paused_until), 0
+        return self.transact(change)
+
+    def pause(self, seconds):
+        """Hold sends in every process until retry_after has passed"""
+        def change(state, now):
+            tokens, updated_at, paused_until = state
+            return (self.refill(tokens, updated_at, now), now, max(paused_until, now + seconds)), None
+        self.transact(change)
+
+    def peek(self):
+        """(tokens, seconds paused) without taking anything"""
+        def change(state, now):
+            tokens, updated_at, paused_until = state
+            tokens = self.refill(tokens, updated_at, now)
+            return (tokens, now, paused_until), (tokens, max(0, paused_until - now))
+        return self.transact(change)
+
+class OutboundDispatcher:
+    """Grants Bot API send slots in priority order under the shared send budget and per-chat pacing.
+
+    Callers reserve a slot and make the request themselves once it is
+    granted, so uploads still stream from the caller's thread. Priorities
+    order this process's queue; across processes they are kept by the
+    budget's per-priority reserve. Per-chat pacing is per process.
+    """
+
+    def __init__(self, budget=None, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.budget = budget or SharedSendBudget()
+        self.rate = self.budget.rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}  # chat_id -> (tokens, updated)
+        self.queue = []  # heap of (priority, seq, chat_id, future)
+        self.seq = itertools.count()
+        self.granted = Counter()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def reserve(self, priority, chat_id=None):
+        """Queue a request for a send slot; the returned Future resolves when it is granted"""
+        future = Future()
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            heapq.heappush(self.queue, (priority, next(self.seq), str(chat_id) if chat_id is not None else None, future))
+            self.condition.notify()
+        return future
+
+    def acquire(self, priority, chat_id=None):
+        """Block until a send slot is granted"""
+        self.reserve(priority, chat_id).result()
+
+    def pause(self, seconds):
+        """Hold every send, in every process, after Telegram answered 429 with retry_after"""
+        self.budget.pause(seconds)
+        with self.condition:
+            self.condition.notify()
+
+    def chat_wait(self, chat_id, now):
+        """Seconds until chat_id may receive another message"""
+        if chat_id is None or chat_id not in self.chat_buckets:
+            return 0
+        tokens, updated = self.chat_buckets[chat_id]
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        return 0 if tokens >= 1 else (1 - tokens) / self.chat_rate
+
+    def take_chat_token(self, chat_id, now):
+        if chat_id is None:
+            return
+        tokens, updated = self.chat_buckets.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        self.chat_buckets[chat_id] = (tokens - 1, now)
+        if len(self.chat_buckets) > CHAT_BUCKETS_MAX:
+            # Buckets that have refilled completely carry no state
+            refill_time = self.chat_burst / self.chat_rate
+            self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if now - v[1] < refill_time}
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                now = time.monotonic()
+                # Highest priority first; a chat that is being paced doesn't hold up other chats
+                entry = None
+                chat_waits = []
+                for candidate in sorted(self.queue):
+                    if candidate[3].cancelled():
+                        entry = candidate
+                        break
+                    chat_wait = self.chat_wait(candidate[2], now)
+                    if chat_wait <= 0:
+                        entry = candidate
+                        break
+                    chat_waits.append(chat_wait)
+                if entry is None:
+                    self.condition.wait(min(chat_waits))
+                    continue
+                if not entry[3].cancelled():
+                    wait = self.budget.take(entry[0])
+                    if wait > 0:
+                        self.condition.wait(wait)
+                        continue
+
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                if entry[3].set_running_or_notify_cancel():
+                    self.take_chat_token(entry[2], now)
+                    self.granted[entry[0]] += 1
+                    entry[3].set_result(True)
+
+    def stats(self):
+        tokens, paused_for = self.budget.peek()
+        with self.condition:
+            waiting = Counter(entry[0] for entry in self.queue)
+            return {
+                'waiting': {name: waiting.get(priority, 0) for priority, name in PRIORITY_NAMES.items()},
+                'granted': {name: self.granted.get(priority, 0) for priority, name in PRIORITY_NAMES.items()},
+                'rate': self.rate,
+                'reserve': {PRIORITY_NAMES[priority]: reserve for priority, reserve in self.budget.reserve.items()},
+                'tokens': round(tokens, 2),
+                'paused_for': round(paused_for, 2)
+            }
+
+outbound = OutboundDispatcher()
+
+async def wait_for_send_slot(priority, chat_id=None):
+    """Await a send slot from the outbound dispatcher inside a bot event loop"""
+    await asyncio.wrap_future(outbound.reserve(priority, chat_id))
+
+class PacedRequest(Request):
+    """PTB request that reports Telegram's RetryAfter to the outbound dispatcher"""
+
+    async def post(self, *args, **kwargs):
+        try:
+            return await super().post(*args, **kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+            print(f"⏳ Telegram asked to retry after {retry_after}s, pausing outbound sends")
+            outbound.pause(retry_after)
+            raise
+
+def telegram_retry_after(response, default=1):
+    """Read retry_after from a 429 Bot API response"""
+    try:
+        return response.json().get('parameters', {}).get('retry_after', default)
+    except ValueError:
+        return default
+
+# --- Delivery status registry ---
+# Telegram error descriptions that mean a user can no longer receive messages
+UNDELIVERABLE_ERRORS = [
+    ('bot was blocked by the user', 'blocked'),
+    ('user_is_blocked', 'blocked'),
+    ('user is deactivated', 'deactivated'),
+    ('user_deactivated', 'deactivated'),
+    ('chat not found', 'chat_not_found'),
+]
+UNDELIVERABLE_STATUSES = ('blocked', 'deactivated', 'chat_not_found')
+REVALIDATION_INTERVAL = 6 * 60 * 60  # 6 hours
+REVALIDATION_BATCH = 200
+
+def classify_delivery_error(error_text):
+    """Map a Telegram/Pyrogram error text to a delivery status, or None if the error is transient"""
+    if not error_text:
+        return None
+    error_text = str(error_text).lower()
+    for needle, status in UNDELIVERABLE_ERRORS:
+        if needle in error_text:
+            return status
+    return None
+
+def set_delivery_status(user_id, status):
+    """Store the delivery status of a user ('ok' or one of UNDELIVERABLE_STATUSES)"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('UPDATE users SET delivery_status = ?, delivery_checked_at = ? WHERE user_id = ?',
+              (status, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
+    conn.commit()
+    conn.close()
+
+def clear_delivery_status(user_id):
+    """Mark a previously undeliverable user as reachable again"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("UPDATE users SET delivery_status = 'ok', delivery_checked_at = ? WHERE user_id = ? AND delivery_status IS NOT NULL AND delivery_status != 'ok'",
+              (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
+    conn.commit()
+    conn.close()
+
+def record_delivery_error(user_id, error_text):
+    """Record the outcome of a failed send; returns the status if the user is undeliverable"""
+    status = classify_delivery_error(error_text)
+    if status and user_id is not None:
+        try:
+            set_delivery_status(int(user_id), status)
+            print(f"🚫 User {user_id} marked as {status}")
+        except Exception as e:
+            print(f"❌ Could not record delivery status for user {user_id}: {e}")
+    return status
+
+def send_telegram_request(url, data, files=None, timeout=10, priority=PRIORITY_NOTIFICATION, retries=1):
+    """POST to the Bot API through the outbound dispatcher and record undeliverable recipients"""
+    for attempt in range(retries + 1):
+        outbound.acquire(priority, data.get('chat_id'))
+        for file_tuple in (files or {}).values():
+            file_tuple[1].seek(0)
+        response = requests.post(url, data=data, files=files, timeout=timeout)
+        if response.status_code != 429:
+            break
+        retry_after = telegram_retry_after(response)
+        print(f"⏳ Telegram rate limit hit, pausing outbound sends for {retry_after}s")
+        outbound.pause(retry_after)
+    if response.status_code in (400, 403):
+        record_delivery_error(data.get('chat_id'), response.text)
+    return response
+
+def revalidate_undeliverable_users(limit=REVALIDATION_BATCH):
+    """Probe undeliverable users with sendChatAction and clear the ones that are reachable again"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT user_id FROM users
+        WHERE delivery_status IN ({','.join('?' * len(UNDELIVERABLE_STATUSES))})
+        ORDER BY delivery_checked_at ASC
+        LIMIT ?
+    ''', UNDELIVERABLE_STATUSES + (limit,))
+    user_ids = [row[0] for row in c.fetchall()]
+    conn.close()
+
+    restored = 0
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/sendChatAction"
+    for user_id in user_ids:
+        try:
+            outbound.acquire(PRIORITY_BULK, user_id)
+            response = requests.post(url, data={'chat_id': user_id, 'action': 'typing'}, timeout=10)
+            if response.status_code == 200:
+                set_delivery_status(user_id, 'ok')
+                restored += 1
+            else:
+                # Refresh the check time so the next run probes other users first
+                status = classify_delivery_error(response.text)
+                if status:
+                    set_delivery_status(user_id, status)
+        except Exception as e:
+            print(f"❌ Revalidation error for user {user_id}: {e}")
+        time.sleep(0.05)  # Stay well under the Bot API rate limit
+
+    print(f"🔁 Delivery revalidation: checked {len(user_ids)}, restored {restored}")
+    return {'checked': len(user_ids), 'restored': restored}
+
+def run_delivery_revalidation_loop():
+    """Periodically revalidate undeliverable users (runs in a daemon thread)"""
+    while True:
+        time.sleep(REVALIDATION_INTERVAL)
+        try:
+            revalidate_undeliverable_users()
+        except Exception as e:
+            print(f"❌ Delivery revalidation job failed: {e}")
+
 @app.route('/user-status/<int:user_id>')
 def user_status(user_id):
     """Get user online status and last activity"""
@@ -410,7 +1305,7 @@ def user_status(user_id):
         'user_id': user_id,
         'full_name': user_info[0] if user_info else '',
         'username': user_info[1] if user_info else '',
-        'photo_url': user_info[2] if user_info else None,
+        'photo_url': public_photo_url(user_info[2]) if user_info else None,
         'is_online': is_online,
         'last_activity': last_message[0] if last_message else None
     })
@@ -427,7 +1322,7 @@ def dashboard_users():
     c = conn.cursor()
     c.execute('SELECT COUNT(*) FROM users')
     total = c.fetchone()[0]
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label, referral_count, referred_by FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?', (page_size, offset))
+    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label, referral_count, referred_by, delivery_status FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?', (page_size, offset))
     users = c.fetchall()
     conn.close()
 
@@ -441,11 +1336,12 @@ def dashboard_users():
                 'username': u[2],
                 'join_date': u[3],
                 'invite_link': u[4],
-                'photo_url': u[5],
+                'photo_url': public_photo_url(u[5]),
                 'is_online': is_online,
                 'label': u[6],
                 'referral_count': u[7] or 0,
-                'referred_by': u[8]
+                'referred_by': u[8],
+                'delivery_status': u[9] or 'ok'
         })
 
     return jsonify({
@@ -475,9 +1371,10 @@ def dashboard_stats():
 @app.route('/chat/<int:user_id>/messages')
 def chat_messages(user_id):
     messages = get_messages_for_user(user_id)
-    # messages is a list of (sender, message, timestamp)
+    # messages is a list of (sender, message, timestamp); media points at /media, never at the Bot API
+    media_base = f"{request.host_url}media/"
     return jsonify([
-        [sender, message, timestamp] for sender, message, timestamp in messages
+        [sender, public_media_message(message, media_base), timestamp] for sender, message, timestamp in messages
     ])
 
 @app.route('/get_channel_invite_link', methods=['GET'])
@@ -551,261 +1448,539 @@ def get_user_tracking_link(user_id):
         print(f"Error getting user tracking link: {e}")
         return jsonify({'error': str(e)}), 500
 
-# --- Telegram Bot Handlers ---
-async def user_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if user is None:
-        return
-    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-    username = user.username or ''
-    join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Fetch profile photo URL
-    photo_url = None
+# --- Database executor ---
+DB_WORKERS = 4
+DB_QUEUE_SIZE = 1000
+
+class DBExecutor:
+    """Runs blocking sqlite helpers on dedicated worker threads behind a bounded queue.
+
+    Async bot handlers await run_db() so a slow commit only holds up the
+    update that issued it, not the whole event loop.
+    """
+
+    def __init__(self, workers=DB_WORKERS, queue_size=DB_QUEUE_SIZE):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for _ in range(self.workers - len(self.threads)):
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        while True:
+            future, func, args, kwargs = self.queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            self.queue.task_done()
+
+    async def submit(self, func, *args, **kwargs):
+        """Queue func on a worker and await its result; waits without blocking the loop while the queue is full"""
+        if len(self.threads) < self.workers:
+            self.start()
+        future = Future()
+        item = (future, func, args, kwargs)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                await asyncio.sleep(0.01)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        return {'workers': len(self.threads), 'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize}
+
+db_executor = DBExecutor()
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper from an async handler"""
+    return await db_executor.submit(func, *args, **kwargs)
+
+def lookup_start_user(user_id):
+    """Return (exists, invite_link) for /start and mark an existing user deliverable again"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT invite_link FROM users WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        return False, None
+    # A user pressing /start can receive messages again
+    clear_delivery_status(user_id)
+    return True, row[0]
+
+def set_user_photo(user_id, photo_url):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('UPDATE users SET photo_url = ? WHERE user_id = ?', (photo_url, user_id))
+    conn.commit()
+    conn.close()
+
+# --- Profile photo cache ---
+PROFILE_PHOTO_TTL = 15 * 60  # re-check a user's profile photo at most this often
+PROFILE_PHOTO_CACHE_SIZE = 5000
+PROFILE_PHOTO_CACHE = OrderedDict()  # user_id -> {'file_unique_id', 'photo_url', 'checked_at'}
+PROFILE_PHOTO_REFRESHING = {}  # user_id -> background refresh task
+
+async def fetch_profile_photo(bot, user_id):
+    """Fetch a reference to a user's current profile photo and cache it.
+
+    Like message media, the photo is stored as "tg-file:<file_id>" and served
+    through /media, so no getFile call is made and the bot token never ends
+    up in users.photo_url.
+    """
+    entry = PROFILE_PHOTO_CACHE.get(user_id)
+    now = time.monotonic()
     try:
-        photos = await context.bot.get_user_profile_photos(user.id, limit=1)
+        photos = await bot.get_user_profile_photos(user_id, limit=1)
         if photos.total_count > 0:
-            file = await context.bot.get_file(photos.photos[0][0].file_id)
-            photo_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
+            photo = photos.photos[0][0]
+            if entry and entry['file_unique_id'] == photo.file_unique_id:
+                photo_url = entry['photo_url']
+            else:
+                photo_url = file_ref(photo.file_id)
+            file_unique_id = photo.file_unique_id
+        else:
+            photo_url, file_unique_id = None, None
     except Exception as e:
-        print(f"Could not fetch profile photo for user {user.id}: {e}")
-    add_user(user.id, full_name, username, join_date, None, photo_url)
+        print(f"Could not fetch profile photo for user {user_id}: {e}")
+        return entry['photo_url'] if entry else None
 
-    # Handle media groups (multiple images/videos sent together)
-    if update.message.media_group_id:
-        # This is part of a media group
-        media_group_id = update.message.media_group_id
-        
-        # Store media group info for processing
-        if not hasattr(context, 'media_groups'):
-            context.media_groups = {}
-        
-        if media_group_id not in context.media_groups:
-            context.media_groups[media_group_id] = {
-                'items': [],
-                'processed': False
-            }
-        
-        # Add this item to the media group
-        if update.message.photo:
-            file = await context.bot.get_file(update.message.photo[-1].file_id)
-            if file.file_path.startswith('http'):
-                file_url = file.file_path
-            else:
-                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-            
-            # Check if it's a GIF
-            is_gif = is_gif_file(file.file_path)
-            
-            context.media_groups[media_group_id]['items'].append({
-                'type': 'gif' if is_gif else 'image',
-                'file_url': file_url,
-                'caption': update.message.caption
-            })
-            
-        elif update.message.video:
-            file = await context.bot.get_file(update.message.video.file_id)
-            if file.file_path.startswith('http'):
-                file_url = file.file_path
-            else:
-                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-            
-            context.media_groups[media_group_id]['items'].append({
-                'type': 'video',
-                'file_url': file_url,
-                'caption': update.message.caption
-            })
-        
-        # Process the media group after a short delay to collect all items
-        await asyncio.sleep(0.5)
-        
-        if not context.media_groups[media_group_id]['processed']:
-            context.media_groups[media_group_id]['processed'] = True
-            
-            # Create a group media message with all items
-            group_items = context.media_groups[media_group_id]['items']
-            if len(group_items) > 1:
-                # Save as group media message
-                group_media_data = {
-                    'type': 'group_media',
-                    'items': group_items,
-                    'count': len(group_items)
-                }
-                save_message(user.id, 'user', f"[group_media]{json.dumps(group_media_data)}")
-            else:
-                # Save as single media message
-                item = group_items[0]
-                save_message(user.id, 'user', f"[{item['type']}]{item['file_url']}")
-            
-            # Real-time notify admin dashboard
-            socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
-        
-        return
+    PROFILE_PHOTO_CACHE[user_id] = {'file_unique_id': file_unique_id, 'photo_url': photo_url, 'checked_at': now}
+    PROFILE_PHOTO_CACHE.move_to_end(user_id)
+    while len(PROFILE_PHOTO_CACHE) > PROFILE_PHOTO_CACHE_SIZE:
+        PROFILE_PHOTO_CACHE.popitem(last=False)
 
-    # Handle bulk media: For each message in a media group, this handler is called separately
-    if update.message.photo:
-        file = await context.bot.get_file(update.message.photo[-1].file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        
-        # File size validation for user uploads
-        try:
-            file_info = await context.bot.get_file(file.file_id)
-            if hasattr(file_info, 'file_size'):
-                file_size = file_info.file_size
-                MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
-                if file_size > MAX_PHOTO_SIZE:
-                    await update.message.reply_text("❌ Image is too large. Maximum size is 20MB.")
-                    return
-        except Exception as e:
-            print(f"Could not check file size: {e}")
-        
-        # Get original file information - try multiple ways
-        original_filename = None
-        mime_type = None
-        
-        # Try to get file_name from the photo object
-        try:
-            original_filename = getattr(update.message.photo[-1], 'file_name', None)
-        except:
-            pass
-            
-        # Try to get mime_type from the photo object
+    if not entry or entry['photo_url'] != photo_url:
+        await run_db(set_user_photo, user_id, photo_url)
+        if entry and entry['file_unique_id'] != file_unique_id:
+            # Relative to the API host, like every other dashboard endpoint
+            socketio.emit('user_photo_updated', {'user_id': user_id, 'photo_url': public_media_url(photo_url, '/media/')})
+    return photo_url
+
+async def refresh_profile_photo(bot, user_id):
+    try:
+        await fetch_profile_photo(bot, user_id)
+    finally:
+        PROFILE_PHOTO_REFRESHING.pop(user_id, None)
+
+def cached_profile_photo(bot, user_id):
+    """Return the cached profile photo URL and refresh it in the background when missing or stale.
+
+    Must be called from the bot's event loop; never waits on the Bot API.
+    """
+    entry = PROFILE_PHOTO_CACHE.get(user_id)
+    if entry is not None:
+        PROFILE_PHOTO_CACHE.move_to_end(user_id)
+    if (entry is None or time.monotonic() - entry['checked_at'] > PROFILE_PHOTO_TTL) and user_id not in PROFILE_PHOTO_REFRESHING:
+        PROFILE_PHOTO_REFRESHING[user_id] = asyncio.get_running_loop().create_task(refresh_profile_photo(bot, user_id))
+    return entry['photo_url'] if entry else None
+
+# --- Known user cache ---
+KNOWN_USERS_SIZE = 20000
+PROFILE_FLUSH_BATCH = 200
+PROFILE_FLUSH_INTERVAL = 5  # seconds
+
+class KnownUserCache:
+    """LRU of users already stored in the database with a hash of their name and username.
+
+    Lets the message handler skip add_user for known users; profile changes
+    are queued and written in batches by a background flusher.
+    """
+
+    def __init__(self, size=KNOWN_USERS_SIZE):
+        self.size = size
+        self.users = OrderedDict()  # user_id -> profile hash
+        self.pending = {}  # user_id -> (full_name, username)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def profile_hash(full_name, username):
+        return hashlib.sha1(f"{full_name}\0{username}".encode('utf-8')).hexdigest()
+
+    def remember(self, user_id, full_name, username):
+        with self.lock:
+            self.users[user_id] = self.profile_hash(full_name, username)
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+
+    def observe(self, user_id, full_name, username, join_date, photo_url=None):
+        """Record an inbound message's sender, writing only when the user is new or their profile changed"""
+        profile = self.profile_hash(full_name, username)
+        with self.lock:
+            known = self.users.get(user_id)
+            if known is not None:
+                self.users.move_to_end(user_id)
+        if known is None:
+            # Not cached: compare with the stored row instead of blindly upserting
+            conn = sqlite3.connect(DB_NAME)
+            c = conn.cursor()
+            c.execute('SELECT full_name, username FROM users WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
+            conn.close()
+            if row is None:
+                add_user(user_id, full_name, username, join_date, None, photo_url)
+                self.remember(user_id, full_name, username)
+                return 'new'
+            known = self.profile_hash(row[0] or '', row[1] or '')
+        if known == profile:
+            self.remember(user_id, full_name, username)
+            return 'known'
+        self.remember(user_id, full_name, username)
+        self.queue_update(user_id, full_name, username)
+        return 'changed'
+
+    def queue_update(self, user_id, full_name, username):
+        with self.lock:
+            self.pending[user_id] = (full_name, username)
+            flush_now = len(self.pending) >= PROFILE_FLUSH_BATCH
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Write all queued profile changes in one transaction"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
         try:
-            mime_type = getattr(update.message.photo[-1], 'mime_type', None)
-        except:
-            pass
-            
-        # If we don't have the original info, try to get it from the file object
-        if not original_filename:
+            conn = sqlite3.connect(DB_NAME)
             try:
-                original_filename = getattr(file, 'file_name', None)
-            except:
-                pass
-                
-        if not mime_type:
+                c = conn.cursor()
+                c.executemany('UPDATE users SET full_name = ?, username = ? WHERE user_id = ?',
+                              [(full_name, username, user_id) for user_id, (full_name, username) in pending.items()])
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            # Requeue for the next flush; changes observed meanwhile are newer and win
+            with self.lock:
+                self.pending = {**pending, **self.pending}
+            raise
+        print(f"💾 Flushed {len(pending)} profile update(s)")
+        return len(pending)
+
+    def run(self):
+        while True:
+            time.sleep(PROFILE_FLUSH_INTERVAL)
             try:
-                mime_type = getattr(file, 'mime_type', None)
-            except:
-                pass
-        
-        # Check message caption for GIF hints
-        caption = getattr(update.message, 'caption', '')
-        if caption and 'gif' in caption.lower():
-            print(f"Debug - Found GIF hint in caption: {caption}")
-        
-        # Check if message has any GIF-specific attributes
-        message_type = getattr(update.message, 'content_type', None)
-        print(f"Debug - Message content type: {message_type}")
-        
-        # Check if this is a GIF file using original information
-        is_gif = is_gif_file(file.file_path, mimetype=mime_type, original_filename=original_filename)
-        
-        # If we couldn't detect it by filename/mimetype, try checking the actual file content
-        if not is_gif and file_url:
-            print(f"Debug - Trying to check file content for GIF...")
-            is_gif = is_gif_by_url(file_url)
-            print(f"Debug - File content check result: {is_gif}")
-        
-        # Additional check: if the file path contains 'gif' anywhere, it might be a GIF
-        if not is_gif and 'gif' in file.file_path.lower():
-            print(f"Debug - Found 'gif' in file path, treating as GIF")
-            is_gif = True
-        
-        print(f"Debug - user image file.file_path: {file.file_path}")
-        print(f"Debug - user image constructed URL: {file_url}")
-        print(f"Debug - original filename: {original_filename}")
-        print(f"Debug - mime type: {mime_type}")
-        print(f"Debug - caption: {caption}")
-        print(f"Debug - message content type: {message_type}")
-        print(f"Debug - is GIF: {is_gif}")
-        print(f"Debug - photo object attributes: {dir(update.message.photo[-1])}")
-        print(f"Debug - file object attributes: {dir(file)}")
-        print(f"Debug - message object attributes: {dir(update.message)}")
-        
-        # Save with appropriate prefix for GIFs
-        if is_gif:
-            save_message(user.id, 'user', f"[gif]{file_url}")
-            print(f"Debug - Saved as GIF: [gif]{file_url}")
-        else:
-            save_message(user.id, 'user', f"[image]{file_url}")
-            print(f"Debug - Saved as image: [image]{file_url}")
-        
-        # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
-    elif update.message.video:
-        file = await context.bot.get_file(update.message.video.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        
-        # File size validation for user uploads
+                self.flush()
+            except Exception as e:
+                print(f"❌ Profile flush failed: {e}")
+
+known_users = KnownUserCache()
+atexit.register(known_users.flush)
+
+# --- Inbound media pipeline ---
+INBOUND_MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
+INBOUND_MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+
+# (message attribute, saved tag, max size, reply when too large); animation must come before document
+INBOUND_MEDIA = [
+    ('animation', 'gif', INBOUND_MAX_FILE_SIZE, "❌ GIF is too large. Maximum size is 50MB."),
+    ('photo', 'image', INBOUND_MAX_PHOTO_SIZE, "❌ Image is too large. Maximum size is 20MB."),
+    ('video', 'video', INBOUND_MAX_FILE_SIZE, "❌ Video is too large. Maximum size is 50MB."),
+    ('video_note', 'video', INBOUND_MAX_FILE_SIZE, "❌ Video is too large. Maximum size is 50MB."),
+    ('sticker', 'image', None, None),
+    ('voice', 'voice', None, None),
+    ('audio', 'audio', None, None),
+    ('document', 'document', INBOUND_MAX_FILE_SIZE, "❌ File is too large. Maximum size is 50MB."),
+]
+
+def find_inbound_media(message):
+    """Return (spec, media object) for the media a message carries, or (None, None)"""
+    for spec in INBOUND_MEDIA:
+        media = getattr(message, spec[0], None)
+        if media:
+            # Photos come as a list of sizes; the last one is the largest
+            return spec, media[-1] if spec[0] == 'photo' else media
+    return None, None
+
+async def ingest_inbound_media(bot, message):
+    """Classify, size-check and resolve an inbound media message in one pass.
+
+    Size comes from the message itself, so oversized files are rejected
+    without any Bot API call. Accepted media is stored as a file reference
+    and only resolved when the dashboard asks for it.
+    Returns (tag, file_ref, error_reply); all None when there is no media.
+    """
+    spec, media = find_inbound_media(message)
+    if spec is None:
+        return None, None, None
+    attribute, tag, max_size, too_large = spec
+    size = getattr(media, 'file_size', None)
+    if max_size and size and size > max_size:
+        return None, None, too_large
+
+    if attribute == 'sticker' and media.is_video:
+        tag = 'video'
+    elif attribute == 'sticker' and media.is_animated:
+        # .tgs is gzipped Lottie JSON, no browser shows it as an image
+        tag = 'sticker_animated'
+    elif attribute in ('photo', 'document') and await detect_gif(message, media):
+        tag = 'gif'
+    return tag, file_ref(media.file_id), None
+
+# --- Media group aggregator ---
+MEDIA_GROUP_DEBOUNCE = 1.0  # seconds without a new item before an album is saved
+MEDIA_GROUP_MAX_AGE = 10  # seconds; an album is saved at the latest this long after its first item
+MEDIA_GROUP_MAX_GROUPS = 500
+MEDIA_GROUP_MAX_ITEMS = 10  # Telegram albums hold at most 10 items
+
+class MediaGroupAggregator:
+    """Collects album items by media_group_id and saves each album once its items stop arriving.
+
+    Every new item re-arms a debounce timer on the bot's event loop. At most
+    MEDIA_GROUP_MAX_GROUPS albums of MEDIA_GROUP_MAX_ITEMS items are held;
+    when full, the oldest album is saved early instead of being dropped.
+    """
+
+    def __init__(self, debounce=MEDIA_GROUP_DEBOUNCE, max_age=MEDIA_GROUP_MAX_AGE,
+                 max_groups=MEDIA_GROUP_MAX_GROUPS, max_items=MEDIA_GROUP_MAX_ITEMS):
+        self.debounce = debounce
+        self.max_age = max_age
+        self.max_groups = max_groups
+        self.max_items = max_items
+        self.groups = OrderedDict()  # media_group_id -> {'user', 'items', 'created', 'timer'}
+        self.tasks = set()
+        self.flushed = 0
+
+    def add(self, media_group_id, user, item, throttled=False):
+        """Add an item to its album; user is (user_id, full_name, username)"""
+        loop = asyncio.get_running_loop()
+        group = self.groups.get(media_group_id)
+        if group is None:
+            while len(self.groups) >= self.max_groups:
+                self.flush(next(iter(self.groups)))
+            group = {'user': user, 'items': [], 'created': loop.time(), 'timer': None, 'throttled': False}
+            self.groups[media_group_id] = group
+        group['items'].append(item)
+        group['throttled'] = group['throttled'] or throttled
+        if group['timer'] is not None:
+            group['timer'].cancel()
+        if len(group['items']) >= self.max_items:
+            self.flush(media_group_id)
+            return
+        # Debounce, but never hold an album past max_age
+        delay = max(0, min(self.debounce, group['created'] + self.max_age - loop.time()))
+        group['timer'] = loop.call_later(delay, self.flush, media_group_id)
+
+    def flush(self, media_group_id):
+        group = self.groups.pop(media_group_id, None)
+        if group is None:
+            return
+        if group['timer'] is not None:
+            group['timer'].cancel()
+        self.flushed += 1
+        task = asyncio.get_running_loop().create_task(self.save(group))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def save(self, group):
+        user_id, full_name, username = group['user']
+        items = group['items']
         try:
-            file_info = await context.bot.get_file(file.file_id)
-            if hasattr(file_info, 'file_size'):
-                file_size = file_info.file_size
-                MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
-                if file_size > MAX_FILE_SIZE:
-                    await update.message.reply_text("❌ Video is too large. Maximum size is 50MB.")
-                    return
+            if len(items) > 1:
+                group_media_data = {
+                    'type': 'group_media',
+                    'items': items,
+                    'count': len(items)
+                }
+                await store_inbound_message(user_id, full_name, username, f"[group_media]{json.dumps(group_media_data)}", group['throttled'])
+            else:
+                await store_inbound_message(user_id, full_name, username, f"[{items[0]['type']}]{items[0]['file_url']}", group['throttled'])
         except Exception as e:
-            print(f"Could not check file size: {e}")
-        
-        save_message(user.id, 'user', f"[video]{file_url}")
-        # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
-    elif update.message.voice:
-        file = await context.bot.get_file(update.message.voice.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[voice]{file_url}")
-        # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
-    elif update.message.audio:
-        file = await context.bot.get_file(update.message.audio.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[audio]{file_url}")
-        # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
-    elif update.message.document:
-        file = await context.bot.get_file(update.message.document.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        
-        # File size validation for user uploads
+            print(f"❌ Could not save media group for user {user_id}: {e}")
+            return
+        if group['throttled']:
+            return
+        for item in items:
+            media_mirror.prefetch_ref(item['file_url'])
+
+    def stats(self):
+        return {
+            'pending_groups': len(self.groups),
+            'pending_items': sum(len(group['items']) for group in self.groups.values()),
+            'flushed': self.flushed
+        }
+
+media_groups = MediaGroupAggregator()
+
+# --- Inbound flood control ---
+FLOOD_RATE = float(os.environ.get('FLOOD_RATE', 1.0))  # sustained messages per second per user; 0 disables
+FLOOD_BURST = int(os.environ.get('FLOOD_BURST', 20))  # messages a user may send at once
+FLOOD_FLUSH_INTERVAL = 2.0  # seconds between writes of deferred messages
+FLOOD_MAX_DEFERRED = 200  # deferred messages kept per user between writes; further ones are dropped
+FLOOD_MAX_USERS = 10000  # token buckets kept
+FLOOD_LOG_INTERVAL = 300
+
+class FloodControl:
+    """Per-user token buckets for inbound messages.
+
+    Messages within a user's budget are handled as before. Past it they are
+    deferred: written together every FLOOD_FLUSH_INTERVAL with one dashboard
+    event per user, without mirroring or error replies. GIF probes still run,
+    paced by the global getFile limit in telegram_files. A user with
+    FLOOD_MAX_DEFERRED messages already waiting has further messages dropped.
+    """
+
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST, flush_interval=FLOOD_FLUSH_INTERVAL,
+                 max_deferred=FLOOD_MAX_DEFERRED, max_users=FLOOD_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.flush_interval = flush_interval
+        self.max_deferred = max_deferred
+        self.max_users = max_users
+        self.buckets = OrderedDict()  # user_id -> (tokens, updated_at)
+        self.rows = []
+        self.users = {}  # user_id -> new_message payload for the deferred messages
+        self.writing = Counter()  # user_id -> writes in flight holding their deferred messages
+        self.timer = None
+        self.tasks = set()
+        self.counters = Counter()
+        self.last_log = time.monotonic()
+
+    def admit(self, user_id):
+        """Take a token for user_id; False means the message should be deferred"""
+        if not self.rate:
+            return True
+        if user_id in self.users or user_id in self.writing:
+            # Some of the user's messages are still waiting to be saved; later ones wait too so rows stay
+            # in order. No token is taken for them, the deferred message isn't handled now.
+            return False
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[user_id] = (tokens, now)
+        while len(self.buckets) > self.max_users:
+            self.buckets.popitem(last=False)
+        return allowed
+
+    def defer(self, user_id, full_name, username, message):
+        """Buffer a throttled message; returns False if it was dropped"""
+        event = self.users.get(user_id)
+        if event is not None and event['count'] >= self.max_deferred:
+            self.counters['dropped'] += 1
+            return False
+        if event is None:
+            event = self.users[user_id] = {'user_id': user_id, 'full_name': full_name, 'username': username, 'count': 0}
+        event['count'] += 1
+        self.rows.append((user_id, 'user', message, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.counters['deferred'] += 1
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+        return True
+
+    def flush(self):
+        self.timer = None
+        rows, self.rows = self.rows, []
+        users, self.users = self.users, {}
+        if not rows:
+            return
+        self.writing.update(users.keys())
+        task = asyncio.get_running_loop().create_task(self.write(rows, users))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def write(self, rows, users):
         try:
-            file_info = await context.bot.get_file(file.file_id)
-            if hasattr(file_info, 'file_size'):
-                file_size = file_info.file_size
-                MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
-                if file_size > MAX_FILE_SIZE:
-                    await update.message.reply_text("❌ File is too large. Maximum size is 50MB.")
-                    return
+            await run_db(save_messages, rows)
         except Exception as e:
-            print(f"Could not check file size: {e}")
-        
-        save_message(user.id, 'user', f"[document]{file_url}")
-        # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
-    elif update.message.text:
-        save_message(user.id, 'user', update.message.text)
+            self.counters['failed'] += len(rows)
+            print(f"❌ Could not save {len(rows)} deferred message(s): {e}")
+            return
+        finally:
+            self.writing.subtract(users.keys())
+            self.writing += Counter()  # drop users with no write left in flight
+        self.counters['flushes'] += 1
+        # One dashboard event per user for the whole burst
+        for event in users.values():
+            socketio.emit('new_message', event)
+        self.maybe_log()
+
+    def maybe_log(self):
+        now = time.monotonic()
+        if now - self.last_log >= FLOOD_LOG_INTERVAL:
+            self.last_log = now
+            print(f"🚦 Flood control: {self.counters['deferred']} deferred, {self.counters['dropped']} dropped")
 
-        # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+    async def stop(self):
+        """Write every deferred message now"""
+        self.flush()
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    def save_remaining(self):
+        """Synchronous last write for rows still buffered when the process exits"""
+        rows, self.rows = self.rows, []
+        if rows:
+            save_messages(rows)
+            print(f"✅ Saved {len(rows)} deferred message(s) at exit")
+
+    def stats(self):
+        return {'users': len(self.buckets), 'buffered': len(self.rows), **self.counters}
+
+flood_control = FloodControl()
+atexit.register(flood_control.save_remaining)
+
+# --- Telegram Bot Handlers ---
+async def user_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None:
+        return
+    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+    username = user.username or ''
+    join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # Profile photo comes from the cache; a missing or stale entry is refreshed in the background
+    photo_url = cached_profile_photo(context.bot, user.id)
+    await run_db(known_users.observe, user.id, full_name, username, join_date, photo_url)
+    # Past the user's message budget: batched writes, no mirroring and no replies
+    throttled = not backlog.active and not flood_control.admit(user.id)
+
+    # Album items are collected by the media group aggregator and saved together
+    if update.message.media_group_id:
+        tag, media_ref, error = await ingest_inbound_media(context.bot, update.message)
+        if error:
+            if not throttled:
+                await update.message.reply_text(error)
+        elif tag:
+            media_groups.add(update.message.media_group_id, (user.id, full_name, username), {
+                'type': tag,
+                'file_url': media_ref,
+                'caption': update.message.caption
+            }, throttled)
+        return
+
+    # Single media message: one table-driven pass for every media kind
+    tag, media_ref, error = await ingest_inbound_media(context.bot, update.message)
+    if error:
+        if not throttled:
+            await update.message.reply_text(error)
+        return
+    if tag:
+        await store_inbound_message(user.id, full_name, username, f"[{tag}]{media_ref}", throttled)
+        if not throttled:
+            media_mirror.prefetch_ref(media_ref)
+    elif update.message.text:
+        await store_inbound_message(user.id, full_name, username, update.message.text, throttled)
 
 def generate_personal_bot_link(user_id, user_name=None):
     """Generate a personal bot chat link that goes directly to the receptionist"""
@@ -813,7 +1988,7 @@ def generate_personal_bot_link(user_id, user_name=None):
     
     try:
         # Get bot info to get username
-        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=10)
+        response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=10)
         if response.status_code == 200:
             bot_data = response.json()
             if bot_data.get('ok'):
@@ -846,7 +2021,7 @@ async def get_bot_info():
     """Get bot information and set RECEPTIONIST_ID automatically"""
     global RECEPTIONIST_ID, BOT_USERNAME_CACHE
     try:
-        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=10)
+        response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=10)
         if response.status_code == 200:
             bot_data = response.json()
             if bot_data.get('ok'):
@@ -878,7 +2053,7 @@ def generate_personal_tracking_link(user_id, user_name=None):
     else:
         # Try to get bot username from Telegram API
         try:
-            response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=10)
+            response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=10)
             if response.status_code == 200:
                 bot_data = response.json()
                 if bot_data.get('ok'):
@@ -947,7 +2122,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text(welcome_text, parse_mode='HTML')
                     
                     # Track the referral
-                    track_referral_usage(referrer_id, user.id)
+                    await run_db(track_referral_usage, referrer_id, user.id)
                     
                     # Save user for tracking with referral information
                     full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
@@ -958,16 +2133,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     personal_link = generate_personal_tracking_link(user.id, full_name)
                     
                     # Save user with referral tracking
-                    add_user(user.id, full_name, username, join_date, personal_link, referred_by=referrer_id)
+                    await run_db(add_user, user.id, full_name, username, join_date, personal_link, referred_by=referrer_id)
                     print(f"💾 Personal chat user {user.id} saved to database with referral from {referrer_id}")
                     
                     # Notify the referrer (admin) that someone joined
                     try:
-                        # Ensure RECEPTIONIST_ID is set
-                        if RECEPTIONIST_ID is None:
-                            print("⚠️ RECEPTIONIST_ID not set, using ADMIN_USER_ID")
-                            RECEPTIONIST_ID = ADMIN_USER_ID
-                        
                         notification_text = (
                             f"🎉 New customer joined through your personal tracking link!\n\n"
                             f"👤 <b>Customer:</b> {user.first_name} {user.last_name or ''}\n"
@@ -983,12 +2153,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             f"• Monitor their activity in admin panel"
                         )
                         
-                        await context.bot.send_message(
-                            chat_id=RECEPTIONIST_ID,
-                            text=notification_text,
-                            parse_mode='HTML'
+                        notification_digest.notify(
+                            context.bot, receptionist_chat_id(), 'start_referral', notification_text,
+                            f"{full_name} (@{username or '-'}, {user.id}) via {referrer_id}", parse_mode='HTML'
                         )
-                        print(f"✅ Notified receptionist {RECEPTIONIST_ID} about new customer {user.id}")
                         
                         # Send real-time notification to admin dashboard
                         socketio.emit('new_user_joined', {
@@ -1019,16 +2187,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Regular /start command (existing logic)
         # Check if user is new or old
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT 1 FROM users WHERE user_id = ?', (user.id,))
-        exists = c.fetchone()
+        exists, existing_link = await run_db(lookup_start_user, user.id)
         
         if exists:
             # Old user: send their existing tracking link
-            c.execute('SELECT invite_link FROM users WHERE user_id = ?', (user.id,))
-            existing_link = c.fetchone()
-            if existing_link and existing_link[0]:
+            if existing_link:
                 # Generate personal tracking link instead of channel link
                 personal_link = generate_personal_tracking_link(user.id, user.first_name)
                 welcome_text = config.WELCOME_MESSAGE.replace('{TRACKING_LINK}', personal_link)
@@ -1050,7 +2213,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             print(f"🔗 Generated personal tracking link: {personal_link}")
             
             # Save user with personal tracking link
-            add_user(user.id, full_name, username, join_date, personal_link)
+            await run_db(add_user, user.id, full_name, username, join_date, personal_link)
             print(f"💾 User {user.id} saved to database")
             
             # Send welcome message with personal tracking link
@@ -1064,8 +2227,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             print(f"✅ Welcome message sent to user {user.id}")
         
-        conn.close()
-        
     except Exception as e:
         print(f"❌ Error in /start command: {e}")
         print(f"🔍 Error type: {type(e).__name__}")
@@ -1079,144 +2240,527 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
-async def approve_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        user = update.chat_join_request.from_user
-        chat = update.chat_join_request.chat
-        
-        print(f"🔔 Telegram bot: Join request received from {user.first_name} ({user.id}) for {chat.title}")
-        print(f"🔧 CHAT_ID: {CHAT_ID}, chat.id: {chat.id}")
-        print(f"🔧 User details: {user.first_name} {user.last_name}, @{user.username}")
-        
-        await update.chat_join_request.approve()
-        logger.info(f"✅ Telegram bot: Approved join request for user {user.id}")
-
-        # Store user info
-        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-        username = user.username or ''
-        join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Get the invite link that was used for joining
-        invite_link = None
-        referred_by = None
-        
-        # Check if this user came through a tracking link
-        if update.chat_join_request.invite_link:
-            invite_link = update.chat_join_request.invite_link.invite_link
-            print(f"🔗 Telegram bot: Invite link used: {invite_link}")
-            # Check if the invite link contains tracking parameter
-            if invite_link and 'ref=' in invite_link:
-                try:
-                    # Extract referrer ID from the link
-                    ref_param = invite_link.split('ref=')[1].split('&')[0]
-                    referred_by = int(ref_param)
-                    print(f"🎯 Telegram bot: User {user.id} was referred by user {referred_by}")
-                except (ValueError, IndexError):
-                    print(f"⚠️ Telegram bot: Could not parse referral ID from link: {invite_link}")
-        else:
-            # Generate a unique channel link for this user
-            invite_link = generate_unique_channel_link(user.id, full_name)
-            print(f"🔗 Telegram bot: Generated unique channel link: {invite_link}")
-        
-        photo_url = None
+# --- Notification digests ---
+# Admin and referrer notifications go through a per-chat aggregator: the first
+# NOTIFY_IMMEDIATE_LIMIT events in a window are sent as they happen, later ones
+# are summed up in a single digest when the window closes. A quiet bot behaves
+# as before, while a burst costs one message per chat per window instead of
+# hitting the ~1 msg/s per-chat limit.
+NOTIFY_DIGEST_WINDOW = float(os.environ.get('NOTIFY_DIGEST_WINDOW', 60))  # seconds
+NOTIFY_IMMEDIATE_LIMIT = int(os.environ.get('NOTIFY_IMMEDIATE_LIMIT', 3))  # per chat per window
+NOTIFY_DIGEST_ROWS = 20
+NOTIFY_STOP_TIMEOUT = 10  # seconds the last digests get to go out when the bot stops
+NOTIFY_DIGEST_LABELS = {
+    'join': '✅ {count} new members approved',
+    'start_referral': '🎉 {count} new customers through personal tracking links',
+    'referral': '🎉 {count} people joined through your tracking link'
+}
+
+def receptionist_chat_id():
+    """Chat that receives admin notifications"""
+    return RECEPTIONIST_ID if RECEPTIONIST_ID is not None else ADMIN_USER_ID
+
+class NotificationDigest:
+    """Sends notifications immediately while traffic is low and as one digest per window during bursts"""
+
+    def __init__(self, window=NOTIFY_DIGEST_WINDOW, immediate_limit=NOTIFY_IMMEDIATE_LIMIT, rows=NOTIFY_DIGEST_ROWS):
+        self.window = window
+        self.immediate_limit = immediate_limit
+        self.rows = rows
+        self.chats = {}  # chat_id -> {'window_start', 'sent', 'events', 'timer', 'bot'}
+        self.swept_at = 0
+        self.tasks = set()
+        self.counters = Counter()
+
+    def notify(self, bot, chat_id, kind, text, summary, parse_mode=None):
+        """Notify chat_id of one event; summary is its one-line row in a digest"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if now - self.swept_at >= self.window:
+            self.evict_idle(now)
+        state = self.chats.get(chat_id)
+        if state is None or (not state['events'] and now - state['window_start'] >= self.window):
+            state = {'window_start': now, 'sent': 0, 'events': [], 'timer': None, 'bot': bot}
+            self.chats[chat_id] = state
+        state['bot'] = bot
+        if not state['events'] and state['sent'] < self.immediate_limit:
+            state['sent'] += 1
+            self.counters['immediate'] += 1
+            self.spawn(self.send(bot, chat_id, text, parse_mode))
+            return
+        state['events'].append((kind, summary))
+        self.counters['deferred'] += 1
+        if state['timer'] is None:
+            delay = max(0, state['window_start'] + self.window - now)
+            state['timer'] = loop.call_later(delay, self.flush, chat_id)
+
+    def evict_idle(self, now):
+        """Forget chats with nothing pending whose window has run out; their next event starts afresh anyway"""
+        self.swept_at = now
+        for chat_id in [k for k, v in self.chats.items()
+                        if not v['events'] and v['timer'] is None and now - v['window_start'] >= self.window]:
+            del self.chats[chat_id]
+
+    def spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def flush(self, chat_id):
+        state = self.chats.get(chat_id)
+        if state is None or not state['events']:
+            return
+        events = state['events']
+        # The digest opens a new window; events arriving during it wait for the next digest
+        state.update({'window_start': asyncio.get_running_loop().time(), 'sent': 1, 'events': [], 'timer': None})
+        self.counters['digests'] += 1
+        self.spawn(self.send(state['bot'], chat_id, self.digest_text(events)))
+
+    def digest_text(self, events):
+        period = 'the last minute' if self.window == 60 else f"the last {int(self.window)} seconds"
+        counts = Counter(kind for kind, _ in events)
+        lines = [NOTIFY_DIGEST_LABELS.get(kind, '🔔 {count} ' + kind).format(count=count) + f" in {period}"
+                 for kind, count in counts.most_common()]
+        lines.append('')
+        lines.extend(f"• {summary}" for _, summary in events[:self.rows])
+        if len(events) > self.rows:
+            lines.append(f"…and {len(events) - self.rows} more (see the admin dashboard)")
+        return '\n'.join(lines)
+
+    async def send(self, bot, chat_id, text, parse_mode=None):
         try:
-            photos = await context.bot.get_user_profile_photos(user.id, limit=1)
-            if photos.total_count > 0:
-                file = await context.bot.get_file(photos.photos[0][0].file_id)
-                photo_url = f"https://api.telegram.org/file/bot{context.bot.token}/{file.file_path}"
+            await wait_for_send_slot(PRIORITY_NOTIFICATION, chat_id)
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            self.counters['sent'] += 1
         except Exception as e:
-            logger.error(f"Could not fetch profile photo for user {user.id}: {e}")
+            print(f"❌ Could not send notification to {chat_id}: {e}")
+            await run_db(record_delivery_error, chat_id, e)
+
+    async def stop(self, timeout=NOTIFY_STOP_TIMEOUT):
+        """Send every digest still waiting for its window, then wait up to timeout seconds for the sends"""
+        for chat_id, state in list(self.chats.items()):
+            if state['timer'] is not None:
+                state['timer'].cancel()
+            self.flush(chat_id)
+        if not self.tasks:
+            return
+        done, pending = await asyncio.wait(list(self.tasks), timeout=timeout)
+        if pending:
+            print(f"⚠️ {len(pending)} notification(s) still unsent at shutdown")
 
-        # Add user with the actual invite link they used
-        add_user(user.id, full_name, username, join_date, invite_link, photo_url, referred_by=referred_by)
-        print(f"💾 Telegram bot: User {user.first_name} ({user.id}) added to database with invite link: {invite_link}")
+    def stats(self):
+        return {'pending': sum(len(state['events']) for state in self.chats.values()), **self.counters}
 
-        # Notify receptionist about the approved user
+notification_digest = NotificationDigest()
+
+# --- Join request pipeline ---
+# Join requests are approved inline; everything else is deferred. Database rows
+# are committed in batches, and profile photos, the receptionist notification and
+# the welcome/referrer DMs run in background stages paced by the outbound
+# dispatcher, so a burst of requests never queues behind slow enrichment.
+#
+# The PTB and Pyrogram bots both receive every join request for CHAT_ID. Each
+# request is claimed in the join_requests table under (chat_id, user_id, request
+# date) before it is approved, so whichever transport claims it first does the
+# approval and side effects and the other one skips it. A claim still 'approving'
+# after JOIN_CLAIM_LEASE seconds belongs to a process that died mid-approval, and
+# the next delivery of the request takes it over.
+JOIN_REQUEST_RETENTION_DAYS = 30
+JOIN_CLAIM_LEASE = 120  # seconds
+JOIN_BATCH_SIZE = 200
+JOIN_FLUSH_INTERVAL = 1.0  # seconds a join may wait for its batch to fill
+JOIN_ENRICH_WORKERS = 4  # welcome DM workers
+JOIN_ENRICH_QUEUE_SIZE = 10000
+JOIN_PHOTO_RATE = 5  # profile photo lookups per second
+JOIN_CHANNEL_WELCOME_INTERVAL = 60  # seconds; one channel welcome covers every DM that failed in this window
+JOIN_STOP_TIMEOUT = 10  # seconds the background stages get to finish when the bot stops
+JOIN_COMMIT_RETRIES = 5  # attempts at saving a join before it is given up
+JOIN_COMMIT_RETRY_DELAY = 1.0  # seconds before the first retry, doubled on every further attempt
+
+def parse_referrer(invite_link):
+    """Referrer user id from a tracking invite link (ref=<id>), or None"""
+    if invite_link and 'ref=' in invite_link:
         try:
-            # Ensure RECEPTIONIST_ID is set
-            if RECEPTIONIST_ID is None:
-                print("⚠️ RECEPTIONIST_ID not set, using ADMIN_USER_ID")
-                RECEPTIONIST_ID = ADMIN_USER_ID
-            
-            notification_text = (
-                f"✅ New member approved in {chat.title}\n\n"
-                f"👤 Name: {full_name}\n"
-                f"🆔 User ID: {user.id}\n"
-                f"🌐 Username: @{username or 'No username'}\n"
-                f"🔗 Invite link: {invite_link or 'N/A'}\n"
-                f"👥 Referred by: {referred_by if referred_by else 'N/A'}"
-            )
-            await context.bot.send_message(chat_id=RECEPTIONIST_ID, text=notification_text)
-            print(f"✅ Notified receptionist {RECEPTIONIST_ID} about approved user {user.id}")
+            return int(invite_link.split('ref=')[1].split('&')[0])
+        except (ValueError, IndexError):
+            print(f"⚠️ Could not parse referral ID from link: {invite_link}")
+    return None
+
+def join_request_timestamp(date):
+    """Request date as a unix timestamp, the third part of a join request's key"""
+    if date is None:
+        return int(time.time())
+    if isinstance(date, (int, float)):
+        return int(date)
+    return int(date.timestamp())
+
+def claim_join_request_row(c, key, source, created_at, now):
+    """Claim one (chat_id, user_id, request_date) key inside an open write transaction.
+
+    Returns 'new', 'expired' when an abandoned 'approving' claim was taken over,
+    or None when the request is approved or claimed by a live process.
+    """
+    c.execute('SELECT status, claimed_at FROM join_requests WHERE chat_id = ? AND user_id = ? AND request_date = ?', key)
+    row = c.fetchone()
+    if row is None:
+        c.execute('INSERT INTO join_requests (chat_id, user_id, request_date, source, status, created_at, claimed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                  key + (source, 'approving', created_at, now))
+        return 'new'
+    status, claimed_at = row
+    if status != 'approving' or (claimed_at or 0) > now - JOIN_CLAIM_LEASE:
+        return None
+    c.execute('UPDATE join_requests SET source = ?, claimed_at = ? WHERE chat_id = ? AND user_id = ? AND request_date = ?',
+              (source, now) + key)
+    return 'expired'
+
+def claim_join_request(chat_id, user_id, request_date, source):
+    """Claim a join request; returns 'new', 'expired' (lease taken over) or None if it is already handled"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    # Read and write under one write lock so two transports can't both take over an expired lease
+    c.execute('BEGIN IMMEDIATE')
+    claim = claim_join_request_row(c, (chat_id, user_id, request_date), source,
+                                   datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), int(time.time()))
+    conn.commit()
+    conn.close()
+    return claim
+
+def is_already_approved_error(error):
+    """Approval errors meaning the request was already approved, e.g. by a process that died before saving it"""
+    text = str(error).lower()
+    return 'already_participant' in text or 'hide_requester_missing' in text
+
+def release_join_request(chat_id, user_id, request_date):
+    """Drop the claim of a request whose approval failed, so a redelivery can retry it"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("DELETE FROM join_requests WHERE chat_id = ? AND user_id = ? AND request_date = ? AND status = 'approving'",
+              (chat_id, user_id, request_date))
+    conn.commit()
+    conn.close()
+
+def add_joined_users(joins):
+    """Insert a batch of joined users in one transaction; returns the ids that were new"""
+    created_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    new_ids = set()
+    referrals = Counter()
+    for join in joins:
+        c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, referred_by, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                  (join['user_id'], join['full_name'], join['username'], join['join_date'], join['invite_link'], join['referred_by'], created_at))
+        if c.rowcount:
+            new_ids.add(join['user_id'])
+            if join['referred_by']:
+                referrals[join['referred_by']] += 1
+    if referrals:
+        c.executemany('UPDATE users SET referral_count = COALESCE(referral_count, 0) + ? WHERE user_id = ?',
+                      [(count, referrer) for referrer, count in referrals.items()])
+    c.executemany("UPDATE join_requests SET status = 'approved', approved_at = ? WHERE chat_id = ? AND user_id = ? AND request_date = ?",
+                  [(created_at, join['chat_id'], join['user_id'], join['request_date']) for join in joins if join.get('request_date') is not None])
+    retention_cutoff = (datetime.datetime.now() - datetime.timedelta(days=JOIN_REQUEST_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    c.execute('DELETE FROM join_requests WHERE created_at < ?', (retention_cutoff,))
+    conn.commit()
+    conn.close()
+    return new_ids
+
+class JoinPipeline:
+    """Batches approved joins into the database and enriches them in background stages.
+
+    After a batch commits, each join goes to one queue per stage (welcome DMs,
+    profile photos paced at JOIN_PHOTO_RATE overall), and the receptionist and
+    referrer notifications go through the notification digest. Members whose
+    welcome DM fails get the welcome posted in the channel by a single worker,
+    at most once per JOIN_CHANNEL_WELCOME_INTERVAL.
+    """
+
+    def __init__(self, batch_size=JOIN_BATCH_SIZE, flush_interval=JOIN_FLUSH_INTERVAL,
+                 workers=JOIN_ENRICH_WORKERS, queue_size=JOIN_ENRICH_QUEUE_SIZE, photo_rate=JOIN_PHOTO_RATE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.photo_interval = 1.0 / photo_rate if photo_rate else 0
+        self.next_photo_at = 0
+        self.channel_welcome_at = None
+        self.pending = []  # (join, bot) waiting for the next batch commit
+        self.timer = None
+        # stage -> (handler, worker count, fed by every committed join)
+        self.stages = {
+            'welcome': (self.send_welcome, workers, True),
+            'photo': (self.fetch_photo, workers, True),
+            'channel_welcome': (self.post_channel_welcome, 1, False)
+        }
+        self.queues = {}
+        self.worker_tasks = []
+        self.commit_tasks = set()
+        self.retry_delay = 0
+        self.counters = Counter()
+
+    def start(self):
+        if not self.queues:
+            self.queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in self.stages}
+        self.worker_tasks = [task for task in self.worker_tasks if not task.done()]
+        if self.worker_tasks:
+            return
+        loop = asyncio.get_running_loop()
+        for stage, (handler, workers, _) in self.stages.items():
+            for _ in range(workers):
+                self.worker_tasks.append(loop.create_task(self.stage_worker(stage, handler)))
+
+    def submit(self, join, bot):
+        """Queue an approved join; bot is used for the deferred Bot API calls"""
+        if not self.worker_tasks:
+            self.start()
+        self.counters['approved'] += 1
+        self.pending.append((join, bot))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.get_running_loop().create_task(self.commit(batch))
+        self.commit_tasks.add(task)
+        task.add_done_callback(self.commit_tasks.discard)
+
+    async def commit(self, batch):
+        try:
+            new_ids = await run_db(add_joined_users, [join for join, _ in batch])
         except Exception as e:
-            print(f"❌ Could not notify receptionist: {e}")
+            print(f"❌ Could not save {len(batch)} joined users: {e}")
+            self.retry(batch)
+            return
+        self.counters['batches'] += 1
+        self.counters['committed'] += len(batch)
+        print(f"💾 Saved {len(batch)} joined users ({len(new_ids)} new)")
+        # Members are announced and welcomed only once their rows exist
+        if backlog.active:
+            # Also summed up in backlog_processed
+            backlog.counters['joins'] += len(batch)
+        for join, bot in batch:
+            # Real-time notification once the row exists; the photo follows as user_photo_updated
+            socketio.emit('new_user_joined', {
+                'user_id': join['user_id'],
+                'full_name': join['full_name'],
+                'username': join['username'],
+                'join_date': join['join_date'],
+                'invite_link': join['invite_link'],
+                'photo_url': None,
+                'referred_by': join['referred_by'],
+                'is_online': True
+            })
+            for stage, (_, _, on_commit) in self.stages.items():
+                if on_commit:
+                    self.enqueue(stage, join, bot)
+            self.notify_receptionist(join, bot)
+            self.notify_referrer(join, bot)
 
-        # Send real-time notification to frontend about new user
-        socketio.emit('new_user_joined', {
-            'user_id': user.id,
-            'full_name': full_name,
-            'username': username,
-            'join_date': join_date,
-            'invite_link': invite_link,
-            'photo_url': photo_url,
-            'referred_by': referred_by,
-            'is_online': True
-        })
-        print(f"📡 Telegram bot: Sent real-time notification for new user {user.id}")
+    def retry(self, batch):
+        """Put a batch that failed to save back into pending, flushed again after a backoff"""
+        retry = []
+        for join, bot in batch:
+            join['commit_attempts'] = join.get('commit_attempts', 0) + 1
+            if join['commit_attempts'] < JOIN_COMMIT_RETRIES:
+                retry.append((join, bot))
+            else:
+                self.counters['db_failed'] += 1
+                print(f"❌ Giving up on saving joined user {join['user_id']} after {join['commit_attempts']} attempts")
+        if not retry:
+            return
+        self.counters['db_retried'] += len(retry)
+        self.pending = retry + self.pending
+        self.retry_delay = JOIN_COMMIT_RETRY_DELAY * 2 ** (max(join['commit_attempts'] for join, _ in retry) - 1)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(self.retry_delay, self.flush)
 
-        # Send welcome DM
-        if referred_by:
-            # Custom welcome for referred users
-            welcome_message = config.WELCOME_MESSAGE
-        else:
-            welcome_message = config.WELCOME_MESSAGE
-        
+    async def commit_all(self):
+        """Flush and wait until every pending join is saved or given up, retries included"""
+        while True:
+            self.flush()
+            while self.commit_tasks:
+                await asyncio.gather(*list(self.commit_tasks))
+            if not self.pending:
+                return
+            # A commit failed; wait out its backoff before the next attempt
+            await asyncio.sleep(self.retry_delay)
+
+    def enqueue(self, stage, join, bot):
         try:
-            print(f"📝 Telegram bot: Sending welcome message to {user.first_name} ({user.id})")
-            print(f"📝 Message: {welcome_message}")
-            
-            await context.bot.send_message(chat_id=user.id, text=welcome_message)
-            logger.info(f"✅ Telegram bot: Sent welcome DM to user {user.id}")
-            
-            # If this was a referral, notify the referrer
-            if referred_by:
-                try:
-                    referrer_message = (
-                        f"🎉 Great news!\n\n"
-                        f"Someone joined through your tracking link!\n"
-                        f"👤 **New Member:** {full_name}\n"
-                        f"🆔 **User ID:** {user.id}\n\n"
-                        f"Keep sharing your link to grow your network! 🚀"
-                    )
-                    await context.bot.send_message(chat_id=referred_by, text=referrer_message)
-                    print(f"✅ Telegram bot: Notified referrer {referred_by} about new referral {user.id}")
-                except Exception as e:
-                    print(f"❌ Telegram bot: Could not notify referrer {referred_by}: {e}")
-                    
+            self.queues[stage].put_nowait((join, bot))
+        except asyncio.QueueFull:
+            self.counters[f'{stage}_dropped'] += 1
+
+    async def stage_worker(self, stage, handler):
+        stage_queue = self.queues[stage]
+        while True:
+            join, bot = await stage_queue.get()
+            try:
+                await handler(join, bot)
+                self.counters[f'{stage}_done'] += 1
+            except Exception as e:
+                print(f"❌ Join {stage} failed for user {join['user_id']}: {e}")
+            finally:
+                stage_queue.task_done()
+
+    async def fetch_photo(self, join, bot):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        at = max(now, self.next_photo_at)
+        self.next_photo_at = at + self.photo_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+        await fetch_profile_photo(bot, join['user_id'])
+
+    def notify_receptionist(self, join, bot):
+        notification_text = (
+            f"✅ New member approved in {join['chat_title']}\n\n"
+            f"👤 Name: {join['full_name']}\n"
+            f"🆔 User ID: {join['user_id']}\n"
+            f"🌐 Username: @{join['username'] or 'No username'}\n"
+            f"🔗 Invite link: {join['invite_link'] or 'N/A'}\n"
+            f"👥 Referred by: {join['referred_by'] if join['referred_by'] else 'N/A'}"
+        )
+        summary = f"{join['full_name']} (@{join['username'] or '-'}, {join['user_id']})"
+        if join['referred_by']:
+            summary += f" via {join['referred_by']}"
+        notification_digest.notify(bot, receptionist_chat_id(), 'join', notification_text, summary)
+
+    async def send_welcome(self, join, bot):
+        """Welcome DM to the new member"""
+        user_id = join['user_id']
+        try:
+            await wait_for_send_slot(PRIORITY_NOTIFICATION, user_id)
+            await bot.send_message(chat_id=user_id, text=config.WELCOME_MESSAGE)
+            logger.info(f"✅ Sent welcome DM to user {user_id}")
         except Exception as e:
-            print(f"❌ Telegram bot: Failed to send DM to {user.first_name} ({user.id}): {e}")
-            print(f"🔍 Error type: {type(e).__name__}")
-            print(f"🔍 Error details: {str(e)}")
-            
+            print(f"❌ Failed to send welcome DM to {join['full_name']} ({user_id}): {e}")
+            await run_db(record_delivery_error, user_id, e)
             if "Forbidden" in str(e) or "chat not found" in str(e):
-                logger.warning(f"Telegram bot: Cannot send DM to user {user.id}: User may have blocked the bot or restricted DMs")
-                socketio.emit('dm_failed', {'user_id': user.id, 'error': 'User may have blocked the bot or restricted DMs'})
-                
-                # Try to send a message in the channel instead
-                try:
-                    channel_message = config.WELCOME_MESSAGE
-                    await context.bot.send_message(chat_id=CHAT_ID, text=channel_message)
-                    print(f"✅ Sent welcome message to channel for user {user.id}")
-                except Exception as channel_error:
-                    print(f"❌ Could not send channel message: {channel_error}")
-                    
-            elif "USER_DEACTIVATED" in str(e):
-                print(f"⚠️ Telegram bot: User {user.first_name} ({user.id}) has deactivated their account")
-            elif "USER_IS_BLOCKED" in str(e):
-                print(f"⚠️ Telegram bot: User {user.first_name} ({user.id}) has blocked the bot")
-            else:
-                logger.error(f"Telegram bot: Error sending welcome DM to user {user.id}: {e}")
-                
+                socketio.emit('dm_failed', {'user_id': user_id, 'error': 'User may have blocked the bot or restricted DMs'})
+                # Reach them in the channel instead
+                self.enqueue('channel_welcome', join, bot)
+
+    async def post_channel_welcome(self, join, bot):
+        """Welcome message in the channel for members who can't be DMed; repeats within the interval are skipped"""
+        now = asyncio.get_running_loop().time()
+        if self.channel_welcome_at is not None and now - self.channel_welcome_at < JOIN_CHANNEL_WELCOME_INTERVAL:
+            self.counters['channel_welcome_skipped'] += 1
+            return
+        self.channel_welcome_at = now
+        try:
+            await wait_for_send_slot(PRIORITY_NOTIFICATION, CHAT_ID)
+            await bot.send_message(chat_id=CHAT_ID, text=config.WELCOME_MESSAGE)
+            print(f"✅ Sent welcome message to channel for user {join['user_id']}")
+        except Exception as e:
+            print(f"❌ Could not send channel message: {e}")
+
+    def notify_referrer(self, join, bot):
+        """Tell the owner of the tracking link that someone joined through it"""
+        referred_by = join['referred_by']
+        if not referred_by:
+            return
+        referrer_message = (
+            f"🎉 Great news!\n\n"
+            f"Someone joined through your tracking link!\n"
+            f"👤 **New Member:** {join['full_name']}\n"
+            f"🆔 **User ID:** {join['user_id']}\n\n"
+            f"Keep sharing your link to grow your network! 🚀"
+        )
+        notification_digest.notify(bot, referred_by, 'referral', referrer_message, join['full_name'] or str(join['user_id']))
+
+    async def drain(self, stages=None):
+        """Commit pending joins and wait until the given stages (default all) are idle"""
+        await self.commit_all()
+        for stage in stages or list(self.queues):
+            if stage in self.queues:
+                await self.queues[stage].join()
+
+    async def stop(self, timeout=JOIN_STOP_TIMEOUT):
+        """Commit every approved join, then give the background stages up to timeout seconds"""
+        if not self.pending and not self.commit_tasks and not any(q.qsize() for q in self.queues.values()):
+            return
+        # Database commits are never cut short; cancelling them would lose the joins
+        await self.commit_all()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(stage_queue.join() for stage_queue in self.queues.values())), timeout)
+        except asyncio.TimeoutError:
+            # Joins are saved by now; only DMs and photo lookups are left behind
+            left = {stage: stage_queue.qsize() for stage, stage_queue in self.queues.items() if stage_queue.qsize()}
+            print(f"⚠️ Join pipeline stopped with unfinished work: {left}")
+        print(f"✅ Join pipeline flushed: {self.counters['committed']} joins saved")
+
+    def stats(self):
+        return {
+            'pending_db': len(self.pending),
+            'queued': {stage: stage_queue.qsize() for stage, stage_queue in self.queues.items()},
+            **self.counters
+        }
+
+join_pipeline = JoinPipeline()
+
+def join_from_request(chat, user, invite_link, request_date=None):
+    """Join record handed to the pipeline; chat and user may come from PTB or Pyrogram"""
+    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+    # Only a link the user actually joined through names a referrer; the generated one carries their own id
+    referred_by = parse_referrer(invite_link)
+    if not invite_link:
+        # Generate a unique channel link for this user
+        invite_link = generate_unique_channel_link(user.id, full_name)
+    return {
+        'chat_id': chat.id,
+        'chat_title': chat.title,
+        'user_id': user.id,
+        'full_name': full_name,
+        'username': user.username or '',
+        'join_date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'invite_link': invite_link,
+        'referred_by': referred_by,
+        'request_date': request_date
+    }
+
+async def process_join_request(chat, user, invite_link, date, approve, bot, source):
+    """Claim, approve and enqueue one join request; returns False if it was already handled.
+
+    approve is a coroutine function making the transport's approval call, and bot
+    makes the deferred Bot API calls (welcome DM, photo, notifications).
+    """
+    request_date = join_request_timestamp(date)
+    claim = await run_db(claim_join_request, chat.id, user.id, request_date, source)
+    if not claim:
+        join_pipeline.counters['duplicates'] += 1
+        print(f"ℹ️ {source}: join request from {user.id} for {chat.id} already handled")
+        return False
+    try:
+        await approve()
+    except Exception as e:
+        # The previous claim holder approved but never saved the join: finish its work
+        if claim != 'expired' or not is_already_approved_error(e):
+            await run_db(release_join_request, chat.id, user.id, request_date)
+            raise
+        join_pipeline.counters['recovered'] += 1
+    join_pipeline.counters[f'approved_{source}'] += 1
+    join_pipeline.submit(join_from_request(chat, user, invite_link, request_date), bot)
+    return True
+
+async def approve_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Approve a join request now and hand the rest to the join pipeline"""
+    try:
+        join_request = update.chat_join_request
+        user = join_request.from_user
+        chat = join_request.chat
+        print(f"🔔 Telegram bot: Join request received from {user.first_name} ({user.id}) for {chat.title}")
+
+        invite_link = join_request.invite_link.invite_link if join_request.invite_link else None
+        if await process_join_request(chat, user, invite_link, join_request.date, join_request.approve, context.bot, 'ptb'):
+            logger.info(f"✅ Telegram bot: Approved join request for user {user.id}")
+
     except Exception as e:
         if "User_already_participant" in str(e):
             logger.info(f"Telegram bot: User {user.id} is already a participant")
@@ -1229,8 +2773,397 @@ async def approve_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             logger.error(f"Telegram bot: Error approving join request for user {user.id}: {e}")
 
+# --- Concurrent update processing ---
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 16))  # handlers running at once
+UPDATE_MAX_PENDING = 1000  # updates admitted from the queue (running or waiting for their turn)
+UPDATE_LATENCY_SAMPLES = 1000
+UPDATE_STATS_LOG_INTERVAL = 300
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently on a bounded pool while keeping each user's updates in order.
+
+    An update waits for the previous update with the same key (the sending
+    user, or the chat when there is no user) before it takes a worker slot,
+    so one busy user never holds slots that other users could run on.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=UPDATE_MAX_PENDING):
+        super().__init__(max(workers, max_pending))
+        self.workers = workers
+        self.slots = None
+        self.tails = {}  # key -> future finished when that key's latest update is done
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_times = deque(maxlen=UPDATE_LATENCY_SAMPLES)
+        self.latencies = deque(maxlen=UPDATE_LATENCY_SAMPLES)
+        self.last_log = time.monotonic()
+
+    async def initialize(self):
+        self.slots = asyncio.Semaphore(self.workers)
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+        return ('update', id(update))
+
+    async def do_process_update(self, update, coroutine):
+        update_id = update.update_id if isinstance(update, Update) else None
+        if update_id is not None and not update_offsets.begin(update_id):
+            # Delivered again after a restart; it was handled before
+            coroutine.close()
+            return
+        ok = False
+        try:
+            await self.process_in_order(update, coroutine)
+            ok = True
+        finally:
+            if update_id is not None:
+                # Outside catch-up a failed update is not redelivered, so it counts as done
+                update_offsets.done(update_id, ok or not backlog.active)
+
+    async def process_in_order(self, update, coroutine):
+        if self.slots is None:
+            await self.initialize()
+        key = self.update_key(update)
+        previous = self.tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self.tails[key] = done
+        queued_at = time.monotonic()
+        self.waiting += 1
+        running = False
+        try:
+            if previous is not None:
+                await previous
+            async with self.slots:
+                self.waiting -= 1
+                running = True
+                self.active += 1
+                started = time.monotonic()
+                self.wait_times.append(started - queued_at)
+                try:
+                    await coroutine
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.active -= 1
+                    self.processed += 1
+                    self.latencies.append(time.monotonic() - started)
+        finally:
+            if not running:
+                # Cancelled before its turn
+                self.waiting -= 1
+                coroutine.close()
+            done.set_result(None)
+            if self.tails.get(key) is done:
+                del self.tails[key]
+            self.maybe_log()
+
+    def maybe_log(self):
+        now = time.monotonic()
+        if now - self.last_log >= UPDATE_STATS_LOG_INTERVAL:
+            self.last_log = now
+            stats = self.stats()
+            print(f"📊 Updates: {stats['processed']} processed, {stats['active']} active, {stats['waiting']} waiting, "
+                  f"p50 {stats['latency_ms']['p50']} ms, p99 {stats['latency_ms']['p99']} ms")
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'waiting': self.waiting,
+            'keys': len(self.tails),
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_ms': latency_summary(self.wait_times),
+            'latency_ms': latency_summary(self.latencies)
+        }
+
+def latency_summary(samples):
+    """p50/p99/max in milliseconds of a sample window"""
+    if not samples:
+        return {'p50': 0, 'p99': 0, 'max': 0}
+    values = sorted(samples)
+    pick = lambda pct: values[min(len(values) - 1, int(pct / 100 * (len(values) - 1) + 0.5))]
+    return {'p50': round(pick(50) * 1000, 2), 'p99': round(pick(99) * 1000, 2), 'max': round(values[-1] * 1000, 2)}
+
+update_processor = KeyedUpdateProcessor()
+
+# --- Update offset tracking and backlog catch-up ---
+# The highest update_id below which every update has been handled is kept in
+# bot_state, so updates Telegram delivers again after a restart are skipped.
+# Polling no longer drops pending updates: before polling starts, the backlog is
+# fetched a getUpdates page at a time, each page's messages are written in one
+# transaction and the dashboard gets one event per user instead of one per message.
+# A backlog update whose handler fails is retried; if it keeps failing, catch-up
+# stops in front of it so Telegram delivers it again instead of it being confirmed.
+UPDATE_OFFSET_KEY = 'last_update_id'
+UPDATE_OFFSET_SAVE_INTERVAL = 1.0  # seconds between offset writes
+# Telegram picks a random next update_id after a week without updates; ids this
+# far below the saved offset start a new sequence instead of being skipped
+UPDATE_ID_RESET_GAP = 100000
+CATCHUP_PAGE_SIZE = 100  # getUpdates maximum
+CATCHUP_RETRIES = 3  # extra attempts for a failed backlog update
+CATCHUP_RETRY_DELAY = 1.0  # seconds before the first retry, doubled each time
+
+def get_bot_state(key, default=None):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else default
+
+def set_bot_state(key, value):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO bot_state (key, value, updated_at) VALUES (?, ?, ?)',
+              (key, str(value), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    conn.close()
+
+class UpdateOffsetTracker:
+    """Persists the update_id up to which every update has been handled.
+
+    Updates finish out of order, so the stored offset sits just below the
+    oldest update still in flight or failed and never skips one that did not
+    finish. Updates handled above that point are remembered, so a redelivery
+    of the same page only runs the ones that did not complete.
+    """
+
+    def __init__(self, key=UPDATE_OFFSET_KEY, interval=UPDATE_OFFSET_SAVE_INTERVAL):
+        self.key = key
+        self.interval = interval
+        self.saved = None  # loaded from bot_state on first use
+        self.highest = 0
+        self.in_flight = set()
+        self.failed = set()  # backlog updates whose handlers raised; retried, never skipped
+        self.errors = set()  # update ids reported by the error handler, consumed by done()
+        self.handled = set()  # finished updates above the watermark
+        self.timer = None
+        self.skipped = 0
+
+    def load(self):
+        self.saved = max(self.saved or 0, int(get_bot_state(self.key, 0)))
+        self.highest = max(self.highest, self.saved)
+        return self.saved
+
+    def begin(self, update_id):
+        """Mark an update as started; returns False if it was handled before"""
+        if self.saved is None:
+            self.load()
+        if update_id in self.handled:
+            self.skipped += 1
+            return False
+        if update_id <= self.saved and update_id not in self.failed:
+            if update_id > self.saved - UPDATE_ID_RESET_GAP:
+                self.skipped += 1
+                return False
+            print(f"🔄 Update ids restarted at {update_id}, resetting the stored offset")
+            self.saved = self.highest = update_id - 1
+        self.in_flight.add(update_id)
+        self.highest = max(self.highest, update_id)
+        return True
+
+    def done(self, update_id, ok=True):
+        self.in_flight.discard(update_id)
+        if ok and update_id not in self.errors:
+            self.failed.discard(update_id)
+            self.handled.add(update_id)
+        else:
+            self.errors.discard(update_id)
+            self.failed.add(update_id)
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.save)
+
+    def watermark(self):
+        unfinished = self.in_flight | self.failed
+        return min(unfinished) - 1 if unfinished else self.highest
+
+    def save(self):
+        self.timer = None
+        if backlog.active:
+            # Backlog rows are still buffered; catch_up_updates persists after each page is written
+            return
+        value = self.watermark()
+        self.handled = {update_id for update_id in self.handled if update_id > value}
+        if value != self.saved:
+            self.saved = value
+            asyncio.get_running_loop().create_task(run_db(set_bot_state, self.key, value))
+
+    async def persist(self):
+        """Write the current offset now"""
+        self.saved = self.watermark()
+        self.handled = {update_id for update_id in self.handled if update_id > self.saved}
+        await run_db(set_bot_state, self.key, self.saved)
+
+    def stats(self):
+        return {'saved': self.saved, 'in_flight': len(self.in_flight), 'failed': len(self.failed), 'skipped': self.skipped}
+
+update_offsets = UpdateOffsetTracker()
+
+def save_messages(rows):
+    """Insert (user_id, sender, message, timestamp) rows in one transaction"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.executemany('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+class BacklogWriter:
+    """While catching up, buffers inbound messages and dashboard events for one getUpdates page"""
+
+    def __init__(self):
+        self.active = False
+        self.rows = []
+        self.users = {}  # user_id -> new_message payload with a message count
+        self.counters = Counter()
+
+    def start(self):
+        self.active = True
+        self.counters.clear()
+
+    def save(self, user_id, full_name, username, message):
+        """Buffer an inbound message; returns False when not catching up"""
+        if not self.active:
+            return False
+        self.rows.append((user_id, 'user', message, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        event = self.users.setdefault(user_id, {'user_id': user_id, 'full_name': full_name, 'username': username, 'count': 0})
+        event['count'] += 1
+        return True
+
+    async def flush(self):
+        rows, self.rows = self.rows, []
+        users, self.users = self.users, {}
+        if rows:
+            await run_db(save_messages, rows)
+            self.counters['messages'] += len(rows)
+            self.counters['batches'] += 1
+        for event in users.values():
+            socketio.emit('new_message', event)
+        self.counters['events'] += len(users)
+
+    async def finish(self):
+        await self.flush()
+        self.active = False
+        if self.counters['updates']:
+            socketio.emit('backlog_processed', dict(self.counters))
+
+    def stats(self):
+        return {'active': self.active, 'buffered': len(self.rows), **self.counters}
+
+backlog = BacklogWriter()
+
+async def store_inbound_message(user_id, full_name, username, message, throttled=False):
+    """Save a user's message and notify the dashboard, batched while catching up or throttled"""
+    if backlog.save(user_id, full_name, username, message):
+        return
+    if throttled:
+        flood_control.defer(user_id, full_name, username, message)
+        return
+    await run_db(save_message, user_id, 'user', message)
+    # Real-time notify admin dashboard
+    socketio.emit('new_message', {'user_id': user_id, 'full_name': full_name, 'username': username})
+
+async def catch_up_updates(app):
+    """Handle updates that arrived while the bot was down, page by page, before polling starts"""
+    saved = await run_db(update_offsets.load)
+    offset = saved + 1 if saved else None
+    backlog.start()
+    try:
+        while True:
+            # Fetching with a higher offset also confirms the previous page to Telegram
+            updates = await app.bot.get_updates(offset=offset, limit=CATCHUP_PAGE_SIZE, timeout=0, allowed_updates=ALLOWED_UPDATES)
+            if not updates:
+                break
+            await asyncio.gather(*(update_processor.process_update(update, app.process_update(update)) for update in updates),
+                                 return_exceptions=True)
+            failed = [update for update in updates if update.update_id in update_offsets.failed]
+            for attempt in range(CATCHUP_RETRIES):
+                if not failed:
+                    break
+                await asyncio.sleep(CATCHUP_RETRY_DELAY * 2 ** attempt)
+                print(f"🔁 Retrying {len(failed)} failed backlog update(s), attempt {attempt + 1}")
+                backlog.counters['retried'] += len(failed)
+                # Retried one after another, in their original order
+                for update in failed:
+                    try:
+                        await update_processor.process_update(update, app.process_update(update))
+                    except Exception:
+                        pass
+                failed = [update for update in failed if update.update_id in update_offsets.failed]
+            await join_pipeline.commit_all()
+            await backlog.flush()
+            # Only now is everything below the watermark in the database
+            await update_offsets.persist()
+            backlog.counters['updates'] += len(updates) - len(failed)
+            if failed:
+                # Asking for the next page would confirm the failed update; leave it to polling
+                backlog.counters['failed'] += len(failed)
+                print(f"❌ Backlog update {failed[0].update_id} still fails after {CATCHUP_RETRIES} retries, "
+                      f"stopping catch-up in front of it")
+                break
+            offset = updates[-1].update_id + 1
+            print(f"📥 Caught up on {backlog.counters['updates']} pending update(s)")
+    except Exception as e:
+        print(f"❌ Backlog catch-up stopped early: {e}")
+    finally:
+        await backlog.finish()
+        await update_offsets.persist()
+
+async def record_update_error(update, context):
+    """Error handler: log handler errors and mark backlog updates for a retry"""
+    update_id = update.update_id if isinstance(update, Update) else None
+    print(f"❌ Error while handling update {update_id}: {context.error}")
+    if update_id is not None and backlog.active:
+        update_offsets.errors.add(update_id)
+
+async def flush_on_stop(app):
+    """Save work still held in memory when the bot stops (post_stop, Pyrogram shutdown)"""
+    try:
+        await join_pipeline.stop()
+    except Exception as e:
+        print(f"❌ Could not flush the join pipeline: {e}")
+    try:
+        # After the pipeline, whose last commits queue receptionist and referrer notifications
+        await notification_digest.stop()
+    except Exception as e:
+        print(f"❌ Could not send pending notifications: {e}")
+    try:
+        await flood_control.stop()
+    except Exception as e:
+        print(f"❌ Could not save deferred messages: {e}")
+
+@app.route('/update-stats', methods=['GET'])
+def update_stats():
+    """Bot update queue depth and handler latency for this process"""
+    return jsonify({
+        'mode': TELEGRAM_MODE,
+        'update_queue': application.update_queue.qsize(),
+        'processor': update_processor.stats(),
+        'db_executor': db_executor.stats(),
+        'media_groups': media_groups.stats(),
+        'join_pipeline': join_pipeline.stats(),
+        'notifications': notification_digest.stats(),
+        'offsets': update_offsets.stats(),
+        'join_sweep': json.loads(get_bot_state(JOIN_SWEEP_STATE_KEY, 'null')),
+        'backlog': backlog.stats(),
+        'flood_control': flood_control.stats(),
+        'file_cache': telegram_files.stats(),
+        'media_mirror': media_mirror.stats()
+    })
+
 # Register handlers for Telegram bot
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+application = ApplicationBuilder().token(BOT_TOKEN).request(PacedRequest(connection_pool_size=256)).base_url(f"{TELEGRAM_API_BASE}/bot").base_file_url(f"{TELEGRAM_API_BASE}/file/bot").concurrent_updates(update_processor).post_init(catch_up_updates).post_stop(flush_on_stop).build()
 application.add_handler(CommandHandler('start', start))
 # application.add_handler(CommandHandler('mylink', mylink))  # Temporarily commented out
 application.add_handler(MessageHandler(tg_filters.TEXT & ~tg_filters.COMMAND, user_message_handler))
@@ -1238,8 +3171,107 @@ application.add_handler(MessageHandler(tg_filters.PHOTO, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.VIDEO, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.VOICE, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.AUDIO, user_message_handler))
+application.add_handler(MessageHandler(tg_filters.ANIMATION, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.Document.ALL, user_message_handler))
+application.add_handler(MessageHandler(tg_filters.VIDEO_NOTE, user_message_handler))
+application.add_handler(MessageHandler(tg_filters.Sticker.ALL, user_message_handler))
 application.add_handler(ChatJoinRequestHandler(approve_join))
+application.add_error_handler(record_update_error)
+
+# --- Webhook ingestion ---
+# TELEGRAM_MODE=webhook runs the PTB application inside the web process: Telegram
+# posts updates to /telegram/webhook/<secret>, the route acknowledges at once and
+# hands the update to application.update_queue. Only one process polls or owns
+# the webhook, so a second Render/Railway instance no longer causes getUpdates conflicts.
+TELEGRAM_MODE = os.environ.get('TELEGRAM_MODE', 'polling').lower()
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')  # public base URL, e.g. https://bot.example.com
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_join_request']
+
+webhook_loop = None
+webhook_stats = Counter()
+
+def run_webhook_application(ready):
+    """Run the PTB application on its own event loop thread without an updater"""
+    global webhook_loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(application.initialize())
+        loop.run_until_complete(application.start())
+        if WEBHOOK_URL:
+            loop.run_until_complete(application.bot.set_webhook(
+                url=f"{WEBHOOK_URL}/telegram/webhook/{WEBHOOK_SECRET}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            ))
+            print(f"✅ Webhook set to {WEBHOOK_URL}/telegram/webhook/<secret>")
+        else:
+            print("⚠️ WEBHOOK_URL not set, expecting the webhook to be registered externally")
+        webhook_loop = loop
+    except Exception as e:
+        print(f"❌ Webhook application failed to start: {e}")
+        ready.set()
+        return
+    ready.set()
+    print("🔗 Telegram webhook application running")
+    loop.run_forever()
+
+def stop_webhook_application(timeout=JOIN_STOP_TIMEOUT + 10):
+    """Flush the webhook application's in-memory work from the exiting web process"""
+    if webhook_loop is None or not webhook_loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(flush_on_stop(application), webhook_loop).result(timeout)
+    except Exception as e:
+        print(f"❌ Webhook application flush failed: {e}")
+
+atexit.register(stop_webhook_application)
+
+def start_webhook_application(timeout=30):
+    """Start the webhook application thread once; returns True when it is accepting updates"""
+    if webhook_loop is not None:
+        return True
+    ready = threading.Event()
+    threading.Thread(target=run_webhook_application, args=(ready,), daemon=True).start()
+    ready.wait(timeout)
+    return webhook_loop is not None
+
+@app.route('/telegram/webhook/<secret>', methods=['POST'])
+def telegram_webhook(secret):
+    """Acknowledge a Telegram update immediately and queue it for the application"""
+    header = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET) or (header is not None and not hmac.compare_digest(header, WEBHOOK_SECRET)):
+        webhook_stats['rejected'] += 1
+        return jsonify({'error': 'Forbidden'}), 403
+    if webhook_loop is None:
+        webhook_stats['unavailable'] += 1
+        return jsonify({'error': 'Webhook application not running'}), 503
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'update_id' not in data:
+        webhook_stats['invalid'] += 1
+        return jsonify({'error': 'Invalid update'}), 400
+    try:
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        print(f"❌ Could not parse webhook update {data.get('update_id')}: {e}")
+        webhook_stats['invalid'] += 1
+        return jsonify({'error': 'Invalid update'}), 400
+    webhook_loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+    webhook_stats['accepted'] += 1
+    return '', 200
+
+@app.route('/telegram/webhook-stats', methods=['GET'])
+def telegram_webhook_stats():
+    """Webhook counters and the application's pending update queue"""
+    return jsonify({
+        'mode': TELEGRAM_MODE,
+        'running': webhook_loop is not None,
+        'queued': application.update_queue.qsize(),
+        **webhook_stats
+    })
 
 # Pyrogram Bot Setup - Only initialize when needed
 pyro_app = None
@@ -1300,135 +3332,13 @@ def setup_pyrogram_handlers():
             chat = join_request.chat
 
             print(f"🔔 Join request received from {user.first_name} ({user.id}) for {chat.title}")
-            print(f"🔧 CHAT_ID: {CHAT_ID}, chat.id: {chat.id}")
-            print(f"🔧 User details: {user.first_name} {user.last_name}, @{user.username}")
 
             try:
-                # Approve the join request
-                await client.approve_chat_join_request(chat.id, user.id)
-                print(f"✅ Approved: {user.first_name} ({user.id}) in {chat.title}")
-
-                # Add user to DB
-                from datetime import datetime
-                full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-                username = user.username or ''
-                join_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Get the invite link that was used for joining
-                invite_link = None
-                referred_by = None
-                
-                # Check if this user came through a tracking link
-                if join_request.invite_link:
-                    invite_link = join_request.invite_link.invite_link
-                    print(f"🔗 Invite link used: {invite_link}")
-                    # Check if the invite link contains tracking parameter
-                    if invite_link and 'ref=' in invite_link:
-                        try:
-                            # Extract referrer ID from the link
-                            ref_param = invite_link.split('ref=')[1].split('&')[0]
-                            referred_by = int(ref_param)
-                            print(f"🎯 User {user.id} was referred by user {referred_by}")
-                        except (ValueError, IndexError):
-                            print(f"⚠️ Could not parse referral ID from link: {invite_link}")
-                else:
-                    # Generate a unique channel link for this user
-                    invite_link = generate_unique_channel_link(user.id, full_name)
-                    print(f"🔗 Generated unique channel link: {invite_link}")
-                
-                add_user(user.id, full_name, username, join_date, invite_link, referred_by=referred_by)
-                print(f"💾 User {user.first_name} ({user.id}) added to database with invite link: {invite_link}")
-
-                # Notify receptionist about the approved user
-                try:
-                    # Ensure RECEPTIONIST_ID is set
-                    if RECEPTIONIST_ID is None:
-                        print("⚠️ RECEPTIONIST_ID not set, using ADMIN_USER_ID")
-                        RECEPTIONIST_ID = ADMIN_USER_ID
-                    
-                    notification_text = (
-                        f"✅ New member approved in {chat.title}\n\n"
-                        f"👤 Name: {full_name}\n"
-                        f"🆔 User ID: {user.id}\n"
-                        f"🌐 Username: @{username or 'No username'}\n"
-                        f"🔗 Invite link: {invite_link or 'N/A'}\n"
-                        f"👥 Referred by: {referred_by if referred_by else 'N/A'}"
-                    )
-                    await client.send_message(chat_id=RECEPTIONIST_ID, text=notification_text)
-                    print(f"✅ Notified receptionist {RECEPTIONIST_ID} about approved user {user.id}")
-                except Exception as e:
-                    print(f"❌ Could not notify receptionist: {e}")
-
-                # Send real-time notification to frontend about new user
-                socketio.emit('new_user_joined', {
-                    'user_id': user.id,
-                    'full_name': full_name,
-                    'username': username,
-                    'join_date': join_date,
-                    'invite_link': invite_link,
-                    'photo_url': None,  # Pyrogram doesn't fetch photo by default
-                    'referred_by': referred_by,
-                    'is_online': True
-                })
-                print(f"📡 Pyrogram bot: Sent real-time notification for new user {user.id}")
-
-                # Send welcome message
-                try:
-                    if referred_by:
-                        # Custom welcome for referred users
-                        welcome_message = config.WELCOME_MESSAGE
-                    else:
-                        welcome_message = config.WELCOME_MESSAGE
-                    
-                    print(f"📝 Sending welcome message to {user.first_name} ({user.id})")
-                    print(f"📝 Message: {welcome_message}")
-                    
-                    await client.send_message(
-                        user.id,
-                        welcome_message
-                    )
-                    print(f"✅ DM sent successfully to {user.first_name} ({user.id})")
-                    
-                    # If this was a referral, notify the referrer
-                    if referred_by:
-                        try:
-                            referrer_message = (
-                                f"🎉 Great news!\n\n"
-                                f"Someone joined through your tracking link!\n"
-                                f"👤 **New Member:** {full_name}\n"
-                                f"🆔 **User ID:** {user.id}\n\n"
-                                f"Keep sharing your link to grow your network! 🚀"
-                            )
-                            await client.send_message(chat_id=referred_by, text=referrer_message)
-                            print(f"✅ Notified referrer {referred_by} about new referral {user.id}")
-                        except Exception as e:
-                            print(f"❌ Could not notify referrer {referred_by}: {e}")
-                            
-                except Exception as e:
-                    print(f"❌ Failed to send DM to {user.first_name} ({user.id}): {e}")
-                    print(f"🔍 Error type: {type(e).__name__}")
-                    print(f"🔍 Error details: {str(e)}")
-                    
-                    # Try to get more specific error information
-                    if "Forbidden" in str(e):
-                        print(f"⚠️ User {user.first_name} ({user.id}) has blocked the bot or doesn't allow DMs")
-                    elif "User not found" in str(e):
-                        print(f"⚠️ User {user.first_name} ({user.id}) not found - may have deleted account")
-                    elif "Chat not found" in str(e):
-                        print(f"⚠️ Chat not found for user {user.first_name} ({user.id})")
-                    elif "USER_DEACTIVATED" in str(e):
-                        print(f"⚠️ User {user.first_name} ({user.id}) has deactivated their account")
-                    elif "USER_IS_BLOCKED" in str(e):
-                        print(f"⚠️ User {user.first_name} ({user.id}) has blocked the bot")
-                        
-                    # Try to send a message in the channel instead
-                    try:
-                        channel_message = config.WELCOME_MESSAGE
-                        await client.send_message(chat_id=CHAT_ID, text=channel_message)
-                        print(f"✅ Sent welcome message to channel for user {user.id}")
-                    except Exception as channel_error:
-                        print(f"❌ Could not send channel message: {channel_error}")
-                        
+                invite_link = join_request.invite_link.invite_link if join_request.invite_link else None
+                approve = lambda: client.approve_chat_join_request(chat.id, user.id)
+                # Deferred calls go through the Bot API client so photos and DMs work the same for both transports
+                if await process_join_request(chat, user, invite_link, join_request.date, approve, pyrogram_bot, 'pyrogram'):
+                    print(f"✅ Approved: {user.first_name} ({user.id}) in {chat.title}")
             except Exception as e:
                 if "User_already_participant" in str(e) or "USER_ALREADY_PARTICIPANT" in str(e):
                     print(f"ℹ️ User {user.first_name} ({user.id}) is already a participant in {chat.title}")
@@ -1448,6 +3358,377 @@ def setup_pyrogram_handlers():
     except Exception as e:
         print(f"❌ Failed to setup Pyrogram handlers: {e}")
 
+# --- Pending join request sweeper ---
+# Join requests that arrived while both bots were down stay pending in CHAT_ID.
+# get_chat_join_requests is a user-only method (bots get BOT_METHOD_INVALID), so
+# listing needs a user session of a chat admin in JOIN_SWEEP_SESSION_STRING;
+# approvals still go through the bot. Without a session the sweeper disables
+# itself after the first refused listing.
+# The Pyrogram process lists them with get_chat_join_requests at startup and
+# every JOIN_SWEEP_INTERVAL seconds, claims them in one transaction, approves
+# the claimed ones concurrently and feeds them to the join pipeline, which
+# registers them with its batched upsert. Requests are approved one by one rather
+# than with approve_all_chat_join_requests, which would also approve requests
+# that arrived after the listing and that the live handlers then could not claim.
+JOIN_SWEEP_INTERVAL = int(os.environ.get('JOIN_SWEEP_INTERVAL', 600))  # seconds; 0 sweeps only at startup
+JOIN_SWEEP_CONCURRENCY = 8  # approvals in flight
+JOIN_SWEEP_STATE_KEY = 'join_sweep'
+JOIN_SWEEP_SESSION_STRING = os.environ.get('JOIN_SWEEP_SESSION_STRING', '')  # Pyrogram session string of a user admin
+
+# application.bot was set up in the parent process (and initialised there in
+# webhook mode) before the Pyrogram process was forked, so that process builds
+# its own Bot API client for deferred photos, DMs and notifications.
+pyrogram_bot = None
+
+async def start_pyrogram_bot():
+    """Create and initialise the Pyrogram process's Bot API client, same endpoint and pacing as application.bot"""
+    global pyrogram_bot
+    pyrogram_bot = Bot(BOT_TOKEN, base_url=f"{TELEGRAM_API_BASE}/bot", base_file_url=f"{TELEGRAM_API_BASE}/file/bot",
+                       request=PacedRequest(connection_pool_size=64))
+    await pyrogram_bot.initialize()
+    return pyrogram_bot
+
+def get_join_sweep_client():
+    """User client used to list pending join requests, or None without JOIN_SWEEP_SESSION_STRING"""
+    if not JOIN_SWEEP_SESSION_STRING:
+        return None
+    try:
+        from pyrogram import Client
+        return Client(
+            "JoinSweeper",
+            session_string=JOIN_SWEEP_SESSION_STRING,
+            api_id=config.API_ID,
+            api_hash=config.API_HASH,
+            in_memory=True,
+            no_updates=True
+        )
+    except Exception as e:
+        print(f"❌ Failed to create the join sweep user client: {e}")
+        return None
+
+async def warm_join_sweep_peer(lister):
+    """Load CHAT_ID into the in-memory session's peer cache, else listing fails with PEER_ID_INVALID"""
+    try:
+        await lister.get_chat(CHAT_ID)
+        return True
+    except Exception as e:
+        print(f"ℹ️ Join sweep session doesn't know {CHAT_ID} yet ({e}), looking through its dialogs")
+    # Walking the dialogs stores every chat they contain as a known peer
+    async for dialog in lister.get_dialogs():
+        if dialog.chat.id == CHAT_ID:
+            return True
+    print(f"❌ Join sweep session has no dialog with {CHAT_ID}; is that user an admin of the chat?")
+    return False
+
+def claim_join_requests(requests_to_claim, source):
+    """Claim (chat_id, user_id, request_date) keys in one transaction; returns {key: 'new' or 'expired'} for the ones taken"""
+    created_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    now = int(time.time())
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    claimed = {}
+    for key in requests_to_claim:
+        claim = claim_join_request_row(c, key, source, created_at, now)
+        if claim:
+            claimed[key] = claim
+    conn.commit()
+    conn.close()
+    return claimed
+
+async def sweep_join_requests(client, lister=None):
+    """Approve every join request pending in CHAT_ID; returns a summary of the sweep.
+
+    lister is the user client that lists the requests (default client);
+    client, the bot, approves them.
+    """
+    started = time.monotonic()
+    chat = await client.get_chat(CHAT_ID)
+    joiners = {}
+    async for joiner in (lister or client).get_chat_join_requests(CHAT_ID):
+        joiners[(chat.id, joiner.user.id, join_request_timestamp(joiner.date))] = joiner
+    result = Counter(pending=len(joiners))
+    if joiners:
+        claimed = await run_db(claim_join_requests, list(joiners), 'sweeper')
+        result['already_claimed'] = len(joiners) - len(claimed)
+        slots = asyncio.Semaphore(JOIN_SWEEP_CONCURRENCY)
+
+        async def approve(key):
+            joiner = joiners[key]
+            async with slots:
+                try:
+                    await client.approve_chat_join_request(chat.id, joiner.user.id)
+                except Exception as e:
+                    if claimed[key] != 'expired' or not is_already_approved_error(e):
+                        result['failed'] += 1
+                        print(f"❌ Sweeper could not approve {joiner.user.id}: {e}")
+                        await run_db(release_join_request, *key)
+                        return
+                    result['recovered'] += 1
+            result['approved'] += 1
+            join_pipeline.submit(join_from_request(chat, joiner.user, None, key[2]), pyrogram_bot)
+
+        await asyncio.gather(*(approve(key) for key in claimed))
+        join_pipeline.flush()
+    result['seconds'] = round(time.monotonic() - started, 2)
+    summary = {**result, 'finished_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    await run_db(set_bot_state, JOIN_SWEEP_STATE_KEY, json.dumps(summary))
+    print(f"🧹 Join request sweep: {result['pending']} pending, {result['approved']} approved, "
+          f"{result['already_claimed']} already handled, {result['failed']} failed")
+    return summary
+
+async def run_join_sweeper(client, lister=None, interval=JOIN_SWEEP_INTERVAL):
+    """Sweep at startup, then every interval seconds"""
+    while True:
+        try:
+            await sweep_join_requests(client, lister)
+        except Exception as e:
+            if "BOT_METHOD_INVALID" in str(e):
+                # Retrying can't help: bots may never list join requests
+                print("⚠️ Join request sweeper disabled: listing join requests needs a user session, set JOIN_SWEEP_SESSION_STRING")
+                await run_db(set_bot_state, JOIN_SWEEP_STATE_KEY, json.dumps({'disabled': 'BOT_METHOD_INVALID'}))
+                return
+            print(f"❌ Join request sweep failed: {e}")
+        if not interval:
+            return
+        await asyncio.sleep(interval)
+
+async def run_pyrogram_client(client):
+    """Run the Pyrogram client with the join request sweeper until the process stops"""
+    from pyrogram import idle
+
+    await start_pyrogram_bot()
+    await client.start()
+    lister = get_join_sweep_client()
+    if lister is not None:
+        try:
+            await lister.start()
+            await warm_join_sweep_peer(lister)
+        except Exception as e:
+            print(f"❌ Join sweep user session failed to start: {e}")
+            if lister.is_connected:
+                await lister.stop()
+            lister = None
+    sweeper = asyncio.get_running_loop().create_task(run_join_sweeper(client, lister))
+    try:
+        await idle()
+    finally:
+        sweeper.cancel()
+        await flush_on_stop(application)
+        if lister is not None:
+            await lister.stop()
+        await client.stop()
+        await pyrogram_bot.shutdown()
+
+# --- Uploaded media cache (sha256 -> Telegram file_id) ---
+MEDIA_CACHE_MEMORY_SIZE = 1000  # Entries kept in memory
+MEDIA_CACHE_MAX_ROWS = 10000  # Rows kept in the media_cache table
+MEDIA_CACHE_TOUCH_INTERVAL = 600  # seconds between last_used writes for an entry served from memory
+MEDIA_FILE_ID_CACHE = OrderedDict()  # (sha256, kind) -> (file_id, last_used written at)
+MEDIA_FILE_ID_CACHE_LOCK = threading.Lock()
+
+# Errors Telegram returns when a cached file_id can no longer be used
+STALE_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference', 'failed to get http url content', 'invalid file_id')
+
+def get_cached_file_id(sha256, kind):
+    """Look up the file_id of previously uploaded bytes (memory LRU first, then the database)"""
+    key = (sha256, kind)
+    with MEDIA_FILE_ID_CACHE_LOCK:
+        entry = MEDIA_FILE_ID_CACHE.get(key)
+        if entry is not None:
+            MEDIA_FILE_ID_CACHE.move_to_end(key)
+            file_id, touched_at = entry
+            touch = time.monotonic() - touched_at > MEDIA_CACHE_TOUCH_INTERVAL
+            if touch:
+                MEDIA_FILE_ID_CACHE[key] = (file_id, time.monotonic())
+    if entry is not None:
+        if touch:
+            # Keep hot entries from being evicted from the table by least recently used
+            conn = sqlite3.connect(DB_NAME)
+            c = conn.cursor()
+            c.execute('UPDATE media_cache SET last_used = ? WHERE sha256 = ? AND kind = ?',
+                      (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),) + key)
+            conn.commit()
+            conn.close()
+        return file_id
+
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT file_id FROM media_cache WHERE sha256 = ? AND kind = ?', key)
+    row = c.fetchone()
+    if row:
+        c.execute('UPDATE media_cache SET last_used = ? WHERE sha256 = ? AND kind = ?',
+                  (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),) + key)
+        conn.commit()
+    conn.close()
+    if not row:
+        return None
+    remember_file_id(sha256, kind, row[0])
+    return row[0]
+
+def remember_file_id(sha256, kind, file_id):
+    """Put a file_id in the in-memory LRU, evicting the least recently used entry"""
+    with MEDIA_FILE_ID_CACHE_LOCK:
+        # Callers have just written last_used
+        MEDIA_FILE_ID_CACHE[(sha256, kind)] = (file_id, time.monotonic())
+        MEDIA_FILE_ID_CACHE.move_to_end((sha256, kind))
+        while len(MEDIA_FILE_ID_CACHE) > MEDIA_CACHE_MEMORY_SIZE:
+            MEDIA_FILE_ID_CACHE.popitem(last=False)
+
+def store_file_id(sha256, kind, file_id, size=None):
+    """Persist the file_id Telegram assigned to uploaded bytes"""
+    remember_file_id(sha256, kind, file_id)
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO media_cache (sha256, kind, file_id, size, last_used) VALUES (?, ?, ?, ?, ?)',
+              (sha256, kind, file_id, size, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    # Keep the table bounded by dropping the least recently used rows
+    c.execute('''
+        DELETE FROM media_cache WHERE rowid IN (
+            SELECT rowid FROM media_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+        )
+    ''', (MEDIA_CACHE_MAX_ROWS,))
+    conn.commit()
+    conn.close()
+
+def invalidate_file_id(sha256, kind):
+    """Forget a file_id that Telegram rejected"""
+    with MEDIA_FILE_ID_CACHE_LOCK:
+        MEDIA_FILE_ID_CACHE.pop((sha256, kind), None)
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('DELETE FROM media_cache WHERE sha256 = ? AND kind = ?', (sha256, kind))
+    conn.commit()
+    conn.close()
+
+def is_stale_file_id_error(response):
+    return response.status_code == 400 and any(error in response.text.lower() for error in STALE_FILE_ID_ERRORS)
+
+# --- Outgoing admin uploads ---
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.m4a')
+
+class OutgoingUpload:
+    """An admin upload sent straight from its request stream.
+
+    Werkzeug keeps each uploaded part in a spooled temp file (in memory for
+    small files), so the same stream can be rewound and re-sent to any number
+    of chats without writing our own temp copies to disk. Bytes that were
+    uploaded before are sent by their cached Telegram file_id instead.
+    """
+
+    def __init__(self, file_storage, size):
+        self.file = file_storage
+        self.filename = file_storage.filename or 'file'
+        self.content_type = file_storage.mimetype or 'application/octet-stream'
+        self.size = size
+        name = self.filename.lower()
+        if name.endswith(IMAGE_EXTENSIONS):
+            self.kind = 'image'
+        elif name.endswith(VIDEO_EXTENSIONS):
+            self.kind = 'video'
+        elif name.endswith(AUDIO_EXTENSIONS):
+            self.kind = 'audio'
+        else:
+            self.kind = 'document'
+        self.is_voice = self.kind == 'audio' and (name.endswith('.m4a') or 'voice' in name)
+        self._sha256 = None
+        self.mirrored_file_id = None  # file_id this upload was copied into the media mirror under
+
+    @property
+    def method_and_field(self):
+        """Bot API method and multipart field used to send this upload"""
+        if self.kind == 'image':
+            return 'sendPhoto', 'photo'
+        if self.kind == 'video':
+            return 'sendVideo', 'video'
+        if self.kind == 'audio':
+            return ('sendVoice', 'voice') if self.is_voice else ('sendAudio', 'audio')
+        return 'sendDocument', 'document'
+
+    @property
+    def tag(self):
+        """Message prefix used when saving this upload to the chat history"""
+        if self.kind == 'image':
+            return 'gif' if self.filename.lower().endswith('.gif') else 'image'
+        if self.kind == 'audio':
+            return 'voice' if self.is_voice else 'audio'
+        return self.kind
+
+    def sent_file_id(self, response_data):
+        """Extract the Telegram file_id from a send* response"""
+        if not response_data.get('ok'):
+            return None
+        result = response_data.get('result', {})
+        field = self.method_and_field[1]
+        if field == 'photo':
+            return result.get('photo', [{}])[-1].get('file_id') if result.get('photo') else None
+        return result.get(field, {}).get('file_id')
+
+    @property
+    def sha256(self):
+        """Content hash of the upload, computed once"""
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            self.file.stream.seek(0)
+            for chunk in iter(lambda: self.file.stream.read(1024 * 1024), b''):
+                digest.update(chunk)
+            self.file.stream.seek(0)
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    def send(self, chat_id, caption=None, timeout=30, priority=PRIORITY_NOTIFICATION):
+        """Send the upload to a chat, by cached file_id when these bytes were uploaded before"""
+        method, field = self.method_and_field
+        url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/{method}"
+        data = {'chat_id': chat_id}
+        if caption:
+            data['caption'] = caption
+
+        file_id = get_cached_file_id(self.sha256, field)
+        if file_id:
+            response = send_telegram_request(url, dict(data, **{field: file_id}), timeout=timeout, priority=priority)
+            if not is_stale_file_id_error(response):
+                return response
+            print(f"♻️ Cached file_id for {self.filename} was rejected, uploading again")
+            invalidate_file_id(self.sha256, field)
+
+        self.file.stream.seek(0)
+        files_data = {field: (self.filename, self.file.stream, self.content_type)}
+        response = send_telegram_request(url, data, files=files_data, timeout=timeout, priority=priority)
+        if response.status_code == 200:
+            try:
+                file_id = self.sent_file_id(response.json())
+                if file_id:
+                    store_file_id(self.sha256, field, file_id, self.size)
+            except ValueError:
+                pass
+        return response
+
+def prepare_uploads(files):
+    """Wrap uploaded files for sending; returns (uploads, rejected) where rejected lists oversized files"""
+    uploads = []
+    rejected = []
+    for file in files:
+        if not file or not file.filename:
+            continue
+        # Check file size
+        file.stream.seek(0, 2)
+        file_size = file.stream.tell()
+        file.stream.seek(0)
+
+        if (file.mimetype or '').startswith('image/') and file_size > MAX_PHOTO_SIZE:
+            rejected.append((file.filename, f'Image {file.filename} is too large. Maximum size is 20MB.'))
+        elif file_size > MAX_FILE_SIZE:
+            rejected.append((file.filename, f'File {file.filename} is too large. Maximum size is 50MB.'))
+        else:
+            uploads.append(OutgoingUpload(file, file_size))
+    return uploads, rejected
+
 @app.route('/chat/<int:user_id>', methods=['POST'])
 def chat_send(user_id):
     message = request.form.get('message')
@@ -1460,158 +3741,42 @@ def chat_send(user_id):
         # Handle text message
         if message:
             save_message(user_id, 'admin', message)
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+            url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/sendMessage"
             data = {
                 'chat_id': user_id,
                 'text': message
             }
-            response = requests.post(url, data=data, timeout=10)  # Added timeout
+            response = send_telegram_request(url, data, timeout=10, priority=PRIORITY_INTERACTIVE)
             if response.status_code != 200:
                 return {'status': 'error', 'msg': f'Telegram API error: {response.text}'}, 500
 
         # Handle files
         if files and len(files) > 0:
-            temp_paths = []
-            
-            # File size validation
-            MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
-            MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
+            uploads, rejected = prepare_uploads(files)  # Oversized files are skipped
             
-            for file in files:
-                filename = file.filename
-                mimetype = file.mimetype
-                
-                # Check file size
-                file.seek(0, 2)
-                file_size = file.tell()
-                file.seek(0)
-                
-                if mimetype.startswith('image/') and file_size > MAX_PHOTO_SIZE:
-                    continue  # Skip this file
-                elif file_size > MAX_FILE_SIZE:
-                    continue  # Skip this file
-                
-                temp_path = f'temp_{filename}_{user_id}'
-                file.save(temp_path)
-                temp_paths.append(temp_path)
-                
             try:
-                for temp_path in temp_paths:
-                    filename = os.path.basename(temp_path).split('_')[1]  # Get original filename
-                    mimetype = None
+                for index, upload in enumerate(uploads):
+                    # Add caption to first file only
+                    response = upload.send(user_id, caption=message if index == 0 else None, priority=PRIORITY_INTERACTIVE)
+                    
+                    if response.status_code != 200:
+                        return {'status': 'error', 'msg': f'Telegram API error: {response.text}'}, 500
                     
-                    # Determine mimetype from file extension
-                    if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp')):
-                        mimetype = 'image'
-                    elif filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-                        mimetype = 'video'
-                    elif filename.lower().endswith(('.mp3', '.wav', '.ogg', '.m4a')):
-                        mimetype = 'audio'
+                    # Store the file_id; it is resolved when the dashboard loads the media
+                    file_id = upload.sent_file_id(response.json())
+                    
+                    if file_id:
+                        save_message(user_id, 'admin', f'[{upload.tag}]{file_ref(file_id)}')
+                        media_mirror.store_upload(file_id, upload)
                     else:
-                        mimetype = 'document'
+                        # Fallback to placeholder
+                        save_message(user_id, 'admin', f'[{upload.kind}]admin-sent-{upload.filename}')
                     
-                    # Send file to Telegram
-                    with open(temp_path, 'rb') as f:
-                        files_data = {'document': f}
-                        data = {'chat_id': user_id}
-                        
-                        if message and temp_path == temp_paths[0]:  # Add caption to first file only
-                            data['caption'] = message
-                        
-                        if mimetype == 'image':
-                            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-                            files_data = {'photo': f}
-                        elif mimetype == 'video':
-                            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendVideo"
-                            files_data = {'video': f}
-                        elif mimetype == 'audio':
-                            # Check if it's a voice message (m4a format)
-                            if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendVoice"
-                                files_data = {'voice': f}
-                            else:
-                                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendAudio"
-                                files_data = {'audio': f}
-                        else:
-                            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendDocument"
-                            files_data = {'document': f}
-                        
-                        f.seek(0)  # Reset file pointer
-                        response = requests.post(url, data=data, files=files_data, timeout=30)  # Increased timeout for file uploads
-                        
-                        if response.status_code != 200:
-                            return {'status': 'error', 'msg': f'Telegram API error: {response.text}'}, 500
-                        
-                        # Get the file_id from the response to construct proper URL
-                        response_data = response.json()
-                        file_id = None
-                        
-                        if response_data.get('ok'):
-                            result = response_data.get('result', {})
-                            
-                            # Extract file_id based on message type
-                            if mimetype == 'image':
-                                file_id = result.get('photo', [{}])[-1].get('file_id') if result.get('photo') else None
-                            elif mimetype == 'video':
-                                file_id = result.get('video', {}).get('file_id')
-                            elif mimetype == 'audio':
-                                if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                                    file_id = result.get('voice', {}).get('file_id')
-                                else:
-                                    file_id = result.get('audio', {}).get('file_id')
-                            else:
-                                file_id = result.get('document', {}).get('file_id')
-                        
-                        # Save with proper URL if we got file_id, otherwise use placeholder
-                        if file_id:
-                            # Get file path from Telegram
-                            file_info_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getFile?file_id={file_id}"
-                            file_info_response = requests.get(file_info_url, timeout=10)
-                            
-                            if file_info_response.status_code == 200:
-                                file_info = file_info_response.json()
-                                if file_info.get('ok'):
-                                    file_path = file_info['result'].get('file_path')
-                                    if file_path:
-                                        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-                                        
-                                        # Save with proper URL
-                                        if mimetype == 'image':
-                                            is_gif = filename.lower().endswith('.gif')
-                                            save_message(user_id, 'admin', f'[{"gif" if is_gif else "image"}]{file_url}')
-                                        elif mimetype == 'video':
-                                            save_message(user_id, 'admin', f'[video]{file_url}')
-                                        elif mimetype == 'audio':
-                                            if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                                                save_message(user_id, 'admin', f'[voice]{file_url}')
-                                            else:
-                                                save_message(user_id, 'admin', f'[audio]{file_url}')
-                                        else:
-                                            save_message(user_id, 'admin', f'[document]{file_url}')
-                                    else:
-                                        # Fallback to placeholder
-                                        save_message(user_id, 'admin', f'[{mimetype}]admin-sent-{filename}')
-                                else:
-                                    # Fallback to placeholder
-                                    save_message(user_id, 'admin', f'[{mimetype}]admin-sent-{filename}')
-                            else:
-                                # Fallback to placeholder
-                                save_message(user_id, 'admin', f'[{mimetype}]admin-sent-{filename}')
-                        else:
-                            # Fallback to placeholder
-                            save_message(user_id, 'admin', f'[{mimetype}]admin-sent-{filename}')
-                        
-                        # Real-time notify admin dashboard
-                        socketio.emit('admin_message_sent', {'user_id': user_id})
+                    # Real-time notify admin dashboard
+                    socketio.emit('admin_message_sent', {'user_id': user_id})
             
             except Exception as e:
                 return {'status': 'error', 'msg': f'File send error: {str(e)}'}, 500
-            finally:
-                for temp_path in temp_paths:
-                    try:
-                        os.remove(temp_path)
-                    except Exception as e:
-                        print('Error removing temp file:', temp_path, e)
 
         socketio.emit('new_message', {'user_id': user_id}, room='chat_' + str(user_id))
         socketio.emit('admin_message_sent', {'user_id': user_id}, room='chat_' + str(user_id))
@@ -1636,12 +3801,12 @@ def send_one():
     if message:
         save_message(int(user_id), 'admin', message)
         try:
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+            url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/sendMessage"
             data = {
                 'chat_id': int(user_id),
                 'text': message
             }
-            response = requests.post(url, data=data)
+            response = send_telegram_request(url, data, priority=PRIORITY_INTERACTIVE)
             if response.status_code == 200:
                 sent = True
             else:
@@ -1651,104 +3816,26 @@ def send_one():
     
     # Handle files
     if files and len(files) > 0:
-        temp_paths = []
-        
-        # File size validation
-        MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
-        MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
-        
-        for file in files:
-            filename = file.filename
-            mimetype = file.mimetype
-            
-            # Check file size
-            file.seek(0, 2)
-            file_size = file.tell()
-            file.seek(0)
-            
-            if mimetype.startswith('image/') and file_size > MAX_PHOTO_SIZE:
-                return jsonify({'status': 'error', 'message': f'Image {filename} is too large. Maximum size is 20MB.'}), 400
-            elif file_size > MAX_FILE_SIZE:
-                return jsonify({'status': 'error', 'message': f'File {filename} is too large. Maximum size is 50MB.'}), 400
-            
-            temp_path = f'temp_{filename}'
-            file.save(temp_path)
-            temp_paths.append(temp_path)
+        uploads, rejected = prepare_uploads(files)
+        if rejected:
+            return jsonify({'status': 'error', 'message': rejected[0][1]}), 400
         
         try:
-            for temp_path in temp_paths:
-                filename = os.path.basename(temp_path)
-                mimetype = None
+            for index, upload in enumerate(uploads):
+                # Add caption to first file only
+                response = upload.send(int(user_id), caption=message if index == 0 else None, priority=PRIORITY_INTERACTIVE)
                 
-                # Determine mimetype from file extension
-                if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp')):
-                    mimetype = 'image'
-                elif filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-                    mimetype = 'video'
-                elif filename.lower().endswith(('.mp3', '.wav', '.ogg', '.m4a')):
-                    mimetype = 'audio'
+                if response.status_code == 200:
+                    file_id = upload.sent_file_id(response.json())
+                    save_message(int(user_id), 'admin', f'[{upload.tag}]{file_ref(file_id)}' if file_id else f'[{upload.tag}]admin-sent-{upload.filename}')
+                    media_mirror.store_upload(file_id, upload)
+                    sent = True
                 else:
-                    mimetype = 'document'
-                
-                # Send file to Telegram
-                with open(temp_path, 'rb') as f:
-                    files_data = {'document': f}
-                    data = {'chat_id': int(user_id)}
-                    
-                    if message and temp_path == temp_paths[0]:  # Add caption to first file only
-                        data['caption'] = message
-                    
-                    
-                    if mimetype == 'image':
-                        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-                        files_data = {'photo': f}
-                    elif mimetype == 'video':
-                        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendVideo"
-                        files_data = {'video': f}
-                    elif mimetype == 'audio':
-                        # Check if it's a voice message (m4a format)
-                        if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendVoice"
-                            files_data = {'voice': f}
-                        else:
-                            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendAudio"
-                            files_data = {'audio': f}
-                    else:
-                        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendDocument"
-                        files_data = {'document': f}
-                    
-                    f.seek(0)  # Reset file pointer
-                    response = requests.post(url, data=data, files=files_data)
-                    
-                    if response.status_code == 200:
-                        # Save message based on type
-                        if mimetype == 'image':
-                            is_gif = filename.lower().endswith('.gif')
-                            # For admin-sent files, we'll use a placeholder URL that indicates it was sent
-                            save_message(int(user_id), 'admin', f'[{"gif" if is_gif else "image"}]admin-sent-{filename}')
-                        elif mimetype == 'video':
-                            save_message(int(user_id), 'admin', f'[video]admin-sent-{filename}')
-                        elif mimetype == 'audio':
-                            if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                                save_message(int(user_id), 'admin', f'[voice]admin-sent-{filename}')
-                            else:
-                                save_message(int(user_id), 'admin', f'[audio]admin-sent-{filename}')
-                        else:
-                            save_message(int(user_id), 'admin', f'[document]admin-sent-{filename}')
-                        
-                        sent = True
-                    else:
-                        print(f"Telegram API error sending file: {response.text}")
+                    print(f"Telegram API error sending file: {response.text}")
             
         except Exception as e:
             print(f"Telegram file send error: {e}")
             return jsonify({'status': 'error', 'message': f'Failed to send media: {str(e)}'}), 500
-        finally:
-            for temp_path in temp_paths:
-                try:
-                    os.remove(temp_path)
-                except Exception as e:
-                    print('Error removing temp file:', temp_path, e)
     
     socketio.emit('new_message', {'user_id': int(user_id)}, room='chat_' + str(user_id))
     socketio.emit('admin_message_sent', {'user_id': int(user_id)}, room='chat_' + str(user_id))
@@ -1758,139 +3845,678 @@ def send_one():
     else:
         return {'status': 'error', 'msg': 'Failed to send message'}, 500
 
-@app.route('/send_all', methods=['POST'])
-def send_all():
-    message = request.form.get('message')
-    files = request.files.getlist('files')
-    
-    if not message and not files:
-        return {'status': 'error', 'msg': 'Missing message or files'}, 400
-    
-    users = get_all_users()
-    success_count = 0
-    
-    for u in users:
+# --- Broadcast templates ---
+# Template field -> users column it is rendered from (tracking_link is derived from user_id)
+TEMPLATE_FIELDS = {
+    'user_id': 'u.user_id',
+    'full_name': 'u.full_name',
+    'username': 'u.username',
+    'referral_count': 'u.referral_count',
+    'tracking_link': None
+}
+TEMPLATE_RENDER_BATCH = 500
+
+class BroadcastTemplate:
+    """A broadcast text with {field} placeholders, parsed once and rendered per recipient.
+
+    Field names are case-insensitive so {TRACKING_LINK} from WELCOME_MESSAGE
+    works too; {{ and }} produce literal braces. Plain broadcasts are never
+    rejected: unknown {fields} and unbalanced braces are sent as written.
+    """
+
+    def __init__(self, text):
+        self.text = text or ''
+        self.fields = []
+        literals = []
         try:
-            # Handle text message
-            if message:
-                save_message(u[0], 'admin', message)
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                data = {
-                    'chat_id': int(u[0]),
-                    'text': message
-                }
-                response = requests.post(url, data=data, timeout=10)  # Added timeout
-                if response.status_code == 200:
-                    success_count += 1
+            parsed = list(string.Formatter().parse(self.text))
+        except ValueError:
+            # Stray { or } - not a template, send the text untouched
+            parsed = None
+        for literal, field, format_spec, conversion in parsed or []:
+            literals.append(literal.replace('%', '%%'))
+            if field is None:
+                continue
+            if field.lower() not in TEMPLATE_FIELDS or format_spec or conversion:
+                # Not one of ours, e.g. {price} or JSON in the text: keep it literally
+                original = '{' + field + (f'!{conversion}' if conversion else '') + (f':{format_spec}' if format_spec else '') + '}'
+                literals.append(original.replace('%', '%%'))
+                continue
+            self.fields.append(field.lower())
+            literals.append('%s')
+        # Rendering is a single %-format of the precompiled pattern
+        self.pattern = ''.join(literals)
+        # Text sent when there are no fields: {{ and }} unescaped, or the raw text if it didn't parse
+        self.plain = self.text if parsed is None or self.fields else self.pattern % ()
+        # Columns to select for the recipients; user_id always comes first for keyset pagination
+        self.names = ['user_id'] + [f for f in dict.fromkeys(self.fields) if TEMPLATE_FIELDS[f] and f != 'user_id']
+        self.columns = ', '.join(TEMPLATE_FIELDS[f] for f in self.names)
+
+    @property
+    def is_personalized(self):
+        return bool(self.fields)
+
+    def render_rows(self, rows, bot_username):
+        """Render the template for a batch of rows selected with self.columns"""
+        if not self.fields:
+            return [self.plain] * len(rows)
+        pattern = self.pattern
+        # Row index of each placeholder, None for the derived tracking link
+        positions = [None if f == 'tracking_link' else self.names.index(f) for f in self.fields]
+        rendered = []
+        for row in rows:
+            rendered.append(pattern % tuple(
+                tracking_link_for(row[0], bot_username) if i is None else ('' if row[i] is None else row[i])
+                for i in positions
+            ))
+        return rendered
+
+def get_bot_username():
+    """Return the bot username, asking getMe once if it is not cached yet"""
+    global BOT_USERNAME_CACHE
+    if not BOT_USERNAME_CACHE:
+        try:
+            response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=10)
+            if response.status_code == 200 and response.json().get('ok'):
+                BOT_USERNAME_CACHE = response.json()['result'].get('username')
+        except Exception as e:
+            print(f"❌ Could not get bot username: {e}")
+    return BOT_USERNAME_CACHE or "chatcustomer_bot"
+
+def tracking_link_for(user_id, bot_username):
+    """Personal tracking link of a user without generating a new random one per broadcast"""
+    return LINK_CACHE.get(f"personal_{user_id}") or f"https://t.me/{bot_username}?start=ref_{user_id}"
+
+def iter_segment_messages(segment, message, batch_size=TEMPLATE_RENDER_BATCH):
+    """Stream (user row, rendered text) for a segment, rendering the template a batch at a time"""
+    template = BroadcastTemplate(message)
+    if not template.is_personalized:
+        for row in iter_segment_users(segment):
+            yield row, template.plain
+        return
+    bot_username = get_bot_username() if 'tracking_link' in template.fields else None
+    batch = []
+    for row in iter_segment_users(segment, chunk_size=batch_size, columns=template.columns):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield from zip(batch, template.render_rows(batch, bot_username))
+            batch = []
+    if batch:
+        yield from zip(batch, template.render_rows(batch, bot_username))
+
+# --- Broadcast delivery receipts ---
+RECEIPT_BATCH_SIZE = 500
+RECEIPT_JOB_RATE = 25  # Bot API calls per second for bulk edit/delete jobs
+RECEIPT_JOB_CHUNK = 500
+RECEIPT_JOBS = {}  # broadcast_id -> progress of the latest edit/delete job
+RECEIPT_JOBS_LOCK = threading.Lock()
+
+def create_broadcast(message, segment):
+    """Insert a broadcasts row and return its id"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('INSERT INTO broadcasts (message, segment, status, created_at) VALUES (?, ?, ?, ?)',
+              (message, json.dumps(segment), 'sending', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    broadcast_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return broadcast_id
+
+def finish_broadcast(broadcast_id, sent_count, total, status='sent'):
+    """Store the final counts of a broadcast"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("UPDATE broadcasts SET status = ?, sent_count = ?, total_count = ?, finished_at = ? WHERE id = ?",
+              (status, sent_count, total, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), broadcast_id))
+    conn.commit()
+    conn.close()
+
+def response_message_id(response):
+    """Return the message_id from a successful Bot API send response"""
+    try:
+        return response.json().get('result', {}).get('message_id')
+    except ValueError:
+        return None
+
+class ReceiptWriter:
+    """Buffers the delivery receipts of a broadcast and inserts them in batches"""
+
+    def __init__(self, broadcast_id, batch_size=RECEIPT_BATCH_SIZE):
+        self.broadcast_id = broadcast_id
+        self.batch_size = batch_size
+        self.rows = []
+
+    def add(self, user_id, response, kind):
+        """Queue the receipt of one send; kind is 'text', 'caption' or 'media'"""
+        if response is not None and response.status_code == 200:
+            message_id, status = response_message_id(response), 'sent'
+        else:
+            message_id = None
+            status = (classify_delivery_error(response.text) if response is not None else None) or 'failed'
+        self.rows.append((self.broadcast_id, user_id, message_id, kind, status,
+                          datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        c.executemany('INSERT INTO delivery_receipts (broadcast_id, user_id, message_id, kind, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                      self.rows)
+        conn.commit()
+        conn.close()
+        self.rows = []
+
+def receipt_job_request(method, data):
+    """Call the Bot API for a receipt job at bulk priority, waiting out 429 responses"""
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/{method}"
+    return send_telegram_request(url, data, priority=PRIORITY_BULK, retries=2)
+
+def run_receipt_job(broadcast_id, action, text=None, rate=RECEIPT_JOB_RATE):
+    """Edit or delete every delivered message of a broadcast, paced to rate calls per second"""
+    progress = {'action': action, 'status': 'running', 'done': 0, 'failed': 0,
+                'started_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    with RECEIPT_JOBS_LOCK:
+        RECEIPT_JOBS[broadcast_id] = progress
+
+    # Only text and the captioned first file can be edited; everything delivered can be deleted
+    kinds = ('text', 'caption') if action == 'edit' else ('text', 'caption', 'media')
+    # Edits are rendered per recipient like the original send, from the user row
+    template = BroadcastTemplate(text) if action == 'edit' else None
+    personalized = template is not None and template.is_personalized
+    bot_username = get_bot_username() if personalized and 'tracking_link' in template.fields else None
+    user_columns = ''.join(f', {TEMPLATE_FIELDS[f]}' for f in template.names[1:]) if personalized else ''
+    query = f'''
+        SELECT r.id, r.message_id, r.kind, r.user_id{user_columns} FROM delivery_receipts r
+        LEFT JOIN users u ON u.user_id = r.user_id
+        WHERE r.broadcast_id = ? AND r.id > ? AND r.message_id IS NOT NULL AND r.status != 'deleted'
+        AND r.kind IN ({','.join('?' * len(kinds))})
+        ORDER BY r.id LIMIT ?
+    '''
+    interval = 1.0 / rate
+    next_call = time.monotonic()
+    last_id = 0
+    conn = sqlite3.connect(DB_NAME)
+    try:
+        while True:
+            c = conn.cursor()
+            c.execute(query, (broadcast_id, last_id) + kinds + (RECEIPT_JOB_CHUNK,))
+            rows = c.fetchall()
+            if not rows:
+                break
+            updates = []
+            # Template rows start at user_id, the layout render_rows expects
+            texts = template.render_rows([row[3:] for row in rows], bot_username) if personalized else [template.plain if template else text] * len(rows)
+            for (receipt_id, message_id, kind, user_id), rendered in zip((row[:4] for row in rows), texts):
+                delay = next_call - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_call = max(next_call, time.monotonic() - interval) + interval
+
+                data = {'chat_id': user_id, 'message_id': message_id}
+                if action == 'delete':
+                    method = 'deleteMessage'
+                elif kind == 'text':
+                    method = 'editMessageText'
+                    data['text'] = rendered
                 else:
-                    print(f"Telegram API error for user {u[0]}: {response.text}")
+                    method = 'editMessageCaption'
+                    data['caption'] = rendered
+                try:
+                    response = receipt_job_request(method, data)
+                    # "message is not modified" means the edit is already in place
+                    if response.status_code == 200 or 'message is not modified' in response.text:
+                        updates.append(('deleted' if action == 'delete' else 'edited', receipt_id))
+                        progress['done'] += 1
+                    else:
+                        updates.append((f'{action}_failed', receipt_id))
+                        progress['failed'] += 1
+                except Exception as e:
+                    print(f"❌ Broadcast {broadcast_id} {action} error for user {user_id}: {e}")
+                    updates.append((f'{action}_failed', receipt_id))
+                    progress['failed'] += 1
+
+            now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            c.executemany('UPDATE delivery_receipts SET status = ?, updated_at = ? WHERE id = ?',
+                          [(status, now, receipt_id) for status, receipt_id in updates])
+            conn.commit()
+            last_id = rows[-1][0]
+
+        if action == 'edit':
+            c.execute('UPDATE broadcasts SET message = ? WHERE id = ?', (text, broadcast_id))
+        else:
+            c.execute("UPDATE broadcasts SET status = 'deleted' WHERE id = ?", (broadcast_id,))
+        conn.commit()
+        progress['status'] = 'done'
+    except Exception as e:
+        print(f"❌ Broadcast {broadcast_id} {action} job failed: {e}")
+        progress['status'] = 'failed'
+        progress['error'] = str(e)
+    finally:
+        conn.close()
+
+    progress['finished_at'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"✅ Broadcast {broadcast_id} {action}: {progress['done']} done, {progress['failed']} failed")
+    socketio.emit('broadcast_job_finished', dict(progress, broadcast_id=broadcast_id))
+
+def broadcast_exists(broadcast_id):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM broadcasts WHERE id = ?', (broadcast_id,))
+    row = c.fetchone()
+    conn.close()
+    return row is not None
+
+def start_receipt_job(broadcast_id, action, text=None):
+    """Start a receipt job in a background thread unless one is already running for the broadcast"""
+    with RECEIPT_JOBS_LOCK:
+        current = RECEIPT_JOBS.get(broadcast_id)
+        if current and current['status'] == 'running':
+            return False
+        RECEIPT_JOBS[broadcast_id] = {'action': action, 'status': 'running', 'done': 0, 'failed': 0}
+    threading.Thread(target=run_receipt_job, args=(broadcast_id, action, text), daemon=True).start()
+    return True
+
+def broadcast_to_segment(message, files, segment, spread_seconds=0, broadcast_id=None):
+    """Send a message and/or files to every user in a segment.
+
+    The message may use BroadcastTemplate fields such as {full_name}.
+    With spread_seconds > 0 the sends are paced evenly over that window
+    instead of going out as fast as possible. Every send is recorded in
+    delivery_receipts under broadcast_id. Returns (success_count, total).
+    """
+    if broadcast_id is None:
+        broadcast_id = create_broadcast(message, segment)
+    receipts = ReceiptWriter(broadcast_id)
+    success_count = 0
+    total = 0
+    status = 'failed'
+    try:
+        interval = 0
+        if spread_seconds and spread_seconds > 0:
+            audience = count_segment_users(segment)
+            interval = spread_seconds / audience if audience else 0
+        started = time.monotonic()
+
+        # Validate and wrap the uploads once; each is rewound and re-sent per user
+        uploads, rejected = prepare_uploads(files or [])
+        for filename, reason in rejected:
+            print(f"Skipping file for broadcast: {reason}")
+
+        for u, text in iter_segment_messages(segment, message):
+            if interval:
+                delay = started + total * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            total += 1
+            try:
+                # Handle text message
+                if message:
+                    save_message(u[0], 'admin', text)
+                    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/sendMessage"
+                    data = {
+                        'chat_id': int(u[0]),
+                        'text': text
+                    }
+                    response = send_telegram_request(url, data, timeout=10, priority=PRIORITY_BULK)
+                    receipts.add(u[0], response, 'text')
+                    if response.status_code == 200:
+                        success_count += 1
+                    else:
+                        print(f"Telegram API error for user {u[0]}: {response.text}")
             
-            # Handle files
-            if files and len(files) > 0:
-                temp_paths = []
-                
-                # File size validation
-                MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
-                MAX_PHOTO_SIZE = 20 * 1024 * 1024  # 20MB
-                
-                for file in files:
-                    filename = file.filename
-                    mimetype = file.mimetype
-                    
-                    # Check file size
-                    file.seek(0, 2)
-                    file_size = file.tell()
-                    file.seek(0)
-                    
-                    if mimetype.startswith('image/') and file_size > MAX_PHOTO_SIZE:
-                        continue  # Skip this file for this user
-                    elif file_size > MAX_FILE_SIZE:
-                        continue  # Skip this file for this user
-                    
-                    temp_path = f'temp_{filename}_{u[0]}'  # Unique temp file per user
-                    file.save(temp_path)
-                    temp_paths.append(temp_path)
-                
+                # Handle files
                 try:
-                    for temp_path in temp_paths:
-                        filename = os.path.basename(temp_path).split('_')[1]  # Get original filename
-                        mimetype = None
-                        
-                        # Determine mimetype from file extension
-                        if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp')):
-                            mimetype = 'image'
-                        elif filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-                            mimetype = 'video'
-                        elif filename.lower().endswith(('.mp3', '.wav', '.ogg', '.m4a')):
-                            mimetype = 'audio'
+                    for index, upload in enumerate(uploads):
+                        # Add caption to first file only
+                        response = upload.send(int(u[0]), caption=text if index == 0 else None, priority=PRIORITY_BULK)
+                        receipts.add(u[0], response, 'caption' if index == 0 and message else 'media')
+                    
+                        if response.status_code == 200:
+                            file_id = upload.sent_file_id(response.json())
+                            save_message(u[0], 'admin', f'[{upload.tag}]{file_ref(file_id)}' if file_id else f'[{upload.tag}]admin-sent-{upload.filename}')
+                            # Copied into the mirror once per broadcast, not once per recipient
+                            if upload.mirrored_file_id is None:
+                                media_mirror.store_upload(file_id, upload)
+                            success_count += 1
                         else:
-                            mimetype = 'document'
-                        
-                        # Send file to Telegram
-                        with open(temp_path, 'rb') as f:
-                            files_data = {'document': f}
-                            data = {'chat_id': int(u[0])}
-                            
-                            if message and temp_path == temp_paths[0]:  # Add caption to first file only
-                                data['caption'] = message
-                            
-                            if mimetype == 'image':
-                                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-                                files_data = {'photo': f}
-                            elif mimetype == 'video':
-                                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendVideo"
-                                files_data = {'video': f}
-                            elif mimetype == 'audio':
-                                # Check if it's a voice message (m4a format)
-                                if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                                    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendVoice"
-                                    files_data = {'voice': f}
-                                else:
-                                    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendAudio"
-                                    files_data = {'audio': f}
-                            else:
-                                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendDocument"
-                                files_data = {'document': f}
-                            
-                            f.seek(0)  # Reset file pointer
-                            response = requests.post(url, data=data, files=files_data, timeout=30)  # Increased timeout for file uploads
-                            
-                            if response.status_code == 200:
-                                # Save message based on type
-                                if mimetype == 'image':
-                                    is_gif = filename.lower().endswith('.gif')
-                                    # For admin-sent files, we'll use a placeholder URL that indicates it was sent
-                                    save_message(u[0], 'admin', f'[{"gif" if is_gif else "image"}]admin-sent-{filename}')
-                                elif mimetype == 'video':
-                                    save_message(u[0], 'admin', f'[video]admin-sent-{filename}')
-                                elif mimetype == 'audio':
-                                    if filename.lower().endswith('.m4a') or 'voice' in filename.lower():
-                                        save_message(u[0], 'admin', f'[voice]admin-sent-{filename}')
-                                    else:
-                                        save_message(u[0], 'admin', f'[audio]admin-sent-{filename}')
-                                else:
-                                    save_message(u[0], 'admin', f'[document]admin-sent-{filename}')
-                                
-                                success_count += 1
-                            else:
-                                print(f"Telegram API error sending file to user {u[0]}: {response.text}")
-                        
+                            print(f"Telegram API error sending file to user {u[0]}: {response.text}")
+                    
                 except Exception as e:
                     print(f"Telegram file send error for user {u[0]}: {e}")
-                finally:
-                    for temp_path in temp_paths:
-                        try:
-                            os.remove(temp_path)
-                        except Exception as e:
-                            print('Error removing temp file:', temp_path, e)
             
-            socketio.emit('new_message', {'user_id': u[0]}, room='chat_' + str(u[0]))
-            socketio.emit('admin_message_sent', {'user_id': u[0]}, room='chat_' + str(u[0]))
+                socketio.emit('new_message', {'user_id': u[0]}, room='chat_' + str(u[0]))
+                socketio.emit('admin_message_sent', {'user_id': u[0]}, room='chat_' + str(u[0]))
             
-        except Exception as e:
-            print(f"Telegram send error for user {u[0]}: {e}")
-    
-    return {'status': 'ok', 'count': success_count, 'total': len(users)}
+            except Exception as e:
+                print(f"Telegram send error for user {u[0]}: {e}")
+        status = 'sent'
+    except Exception as e:
+        print(f"❌ Broadcast {broadcast_id} stopped: {e}")
+        raise
+    finally:
+        # Receipts already buffered must reach the table, or edit/recall cannot find those messages
+        receipts.flush()
+        finish_broadcast(broadcast_id, success_count, total, status)
+    return success_count, total
+
+@app.route('/send_all', methods=['POST'])
+def send_all():
+    message = request.form.get('message')
+    files = request.files.getlist('files')
+
+    try:
+        segment = parse_segment(request.form)
+    except ValueError:
+        return {'status': 'error', 'msg': 'referred_by must be a valid user ID'}, 400
+    # Dry run: only report how many users the segment would reach and how the first message renders
+    if request.form.get('dry_run', '').lower() in ('1', 'true', 'yes'):
+        preview = next((text for _, text in iter_segment_messages(segment, message, batch_size=1)), None)
+        return {'status': 'ok', 'dry_run': True, 'segment': segment, 'audience': count_segment_users(segment), 'preview': preview}
+
+    if not message and not files:
+        return {'status': 'error', 'msg': 'Missing message or files'}, 400
+
+    broadcast_id = create_broadcast(message, segment)
+    success_count, total = broadcast_to_segment(message, files, segment, broadcast_id=broadcast_id)
+    return {'status': 'ok', 'broadcast_id': broadcast_id, 'count': success_count, 'total': total, 'segment': segment}
+
+@app.route('/broadcasts')
+def list_broadcasts():
+    """List the most recent broadcasts"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT id, message, segment, status, sent_count, total_count, created_at, finished_at FROM broadcasts ORDER BY id DESC LIMIT 100')
+    rows = c.fetchall()
+    conn.close()
+    return jsonify([
+        {
+            'broadcast_id': row[0],
+            'message': row[1],
+            'segment': json.loads(row[2] or '{}'),
+            'status': row[3],
+            'sent_count': row[4],
+            'total_count': row[5],
+            'created_at': row[6],
+            'finished_at': row[7]
+        } for row in rows
+    ])
+
+@app.route('/broadcasts/<int:broadcast_id>')
+def broadcast_detail(broadcast_id):
+    """Get a broadcast with its receipt counts by status and the progress of its edit/delete job"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT id, message, segment, status, sent_count, total_count, created_at, finished_at FROM broadcasts WHERE id = ?', (broadcast_id,))
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        return jsonify({'status': 'error', 'msg': 'Broadcast not found'}), 404
+    c.execute('SELECT status, COUNT(*) FROM delivery_receipts WHERE broadcast_id = ? GROUP BY status', (broadcast_id,))
+    receipts = dict(c.fetchall())
+    conn.close()
+    with RECEIPT_JOBS_LOCK:
+        job = dict(RECEIPT_JOBS[broadcast_id]) if broadcast_id in RECEIPT_JOBS else None
+    return jsonify({
+        'broadcast_id': row[0],
+        'message': row[1],
+        'segment': json.loads(row[2] or '{}'),
+        'status': row[3],
+        'sent_count': row[4],
+        'total_count': row[5],
+        'created_at': row[6],
+        'finished_at': row[7],
+        'receipts': receipts,
+        'job': job
+    })
+
+@app.route('/broadcasts/<int:broadcast_id>/edit', methods=['POST'])
+def edit_broadcast(broadcast_id):
+    """Edit the text (or caption) of every delivered copy of a broadcast"""
+    payload = request.get_json(silent=True) or request.form
+    text = payload.get('message')
+    if not text:
+        return jsonify({'status': 'error', 'msg': 'Missing message'}), 400
+    if not broadcast_exists(broadcast_id):
+        return jsonify({'status': 'error', 'msg': 'Broadcast not found'}), 404
+    if not start_receipt_job(broadcast_id, 'edit', text):
+        return jsonify({'status': 'error', 'msg': 'A job is already running for this broadcast'}), 409
+    return jsonify({'status': 'ok', 'broadcast_id': broadcast_id, 'action': 'edit'})
+
+@app.route('/broadcasts/<int:broadcast_id>/delete', methods=['POST'])
+def delete_broadcast(broadcast_id):
+    """Recall a broadcast by deleting every delivered copy"""
+    if not broadcast_exists(broadcast_id):
+        return jsonify({'status': 'error', 'msg': 'Broadcast not found'}), 404
+    if not start_receipt_job(broadcast_id, 'delete'):
+        return jsonify({'status': 'error', 'msg': 'A job is already running for this broadcast'}), 409
+    return jsonify({'status': 'ok', 'broadcast_id': broadcast_id, 'action': 'delete'})
+
+# --- Scheduled broadcasts ---
+SCHEDULED_UPLOADS_DIR = 'scheduled_uploads'
+
+def parse_send_at(value):
+    """Parse a send_at value ('YYYY-MM-DD HH:MM[:SS]' or 'YYYY-MM-DDTHH:MM', optionally with a UTC offset) as naive server local time"""
+    send_at = datetime.datetime.fromisoformat(value.strip())
+    if send_at.tzinfo is not None:
+        # Convert before dropping the offset, otherwise it would be read as local time
+        send_at = send_at.astimezone().replace(tzinfo=None)
+    return send_at
+
+def save_scheduled_attachments(job_id, files):
+    """Persist the uploads of a scheduled broadcast so the job survives restarts"""
+    attachments = []
+    job_dir = os.path.join(SCHEDULED_UPLOADS_DIR, str(job_id))
+    for index, file in enumerate(files):
+        if not file or not file.filename:
+            continue
+        os.makedirs(job_dir, exist_ok=True)
+        path = os.path.join(job_dir, f"{index}_{os.path.basename(file.filename)}")
+        file.save(path)
+        attachments.append({'path': path, 'filename': file.filename, 'mimetype': file.mimetype})
+    return attachments
+
+def run_scheduled_broadcast(job_id):
+    """Claim a due scheduled broadcast and send it"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    # Claiming with a status check makes cancelled or already started jobs a no-op
+    c.execute("UPDATE scheduled_broadcasts SET status = 'running', started_at = ? WHERE id = ? AND status = 'pending'",
+              (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id))
+    conn.commit()
+    if c.rowcount != 1:
+        conn.close()
+        return
+    c.execute('SELECT message, segment, attachments, spread_seconds FROM scheduled_broadcasts WHERE id = ?', (job_id,))
+    message, segment, attachments, spread_seconds = c.fetchone()
+    broadcast_id = create_broadcast(message, json.loads(segment or '{}'))
+    c.execute('UPDATE scheduled_broadcasts SET broadcast_id = ? WHERE id = ?', (broadcast_id, job_id))
+    conn.commit()
+    conn.close()
+
+    print(f"⏰ Starting scheduled broadcast {job_id}")
+    sent_count, total = 0, 0
+    error = None
+    files = []
+    try:
+        for attachment in json.loads(attachments or '[]'):
+            files.append(FileStorage(stream=open(attachment['path'], 'rb'),
+                                     filename=attachment['filename'],
+                                     content_type=attachment['mimetype']))
+        sent_count, total = broadcast_to_segment(message, files, json.loads(segment or '{}'), spread_seconds or 0, broadcast_id)
+        status = 'done'
+    except Exception as e:
+        print(f"❌ Scheduled broadcast {job_id} failed: {e}")
+        status = 'failed'
+        error = str(e)
+    finally:
+        for file in files:
+            file.close()
+
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('UPDATE scheduled_broadcasts SET status = ?, sent_count = ?, total_count = ?, error = ?, finished_at = ? WHERE id = ?',
+              (status, sent_count, total, error, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id))
+    conn.commit()
+    conn.close()
+    shutil.rmtree(os.path.join(SCHEDULED_UPLOADS_DIR, str(job_id)), ignore_errors=True)
+
+    print(f"✅ Scheduled broadcast {job_id} {status}: {sent_count}/{total}")
+    socketio.emit('scheduled_broadcast_finished', {'job_id': job_id, 'broadcast_id': broadcast_id, 'status': status, 'count': sent_count, 'total': total})
+
+class BroadcastScheduler:
+    """In-process timer queue that starts scheduled broadcasts when they are due"""
+
+    def __init__(self):
+        self.queue = []  # heap of (send_at timestamp, job_id)
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.load_pending_jobs()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f"⏰ Broadcast scheduler started with {len(self.queue)} pending job(s)")
+
+    def load_pending_jobs(self):
+        """Re-queue persisted jobs after a restart"""
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        # A job that was running when the process stopped may have partially sent, so it is not resent
+        c.execute("UPDATE scheduled_broadcasts SET status = 'interrupted', finished_at = ? WHERE status = 'running'",
+                  (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        # A job still saving its attachments lost its upload request; it cannot be completed
+        c.execute("SELECT id FROM scheduled_broadcasts WHERE status = 'saving'")
+        for (job_id,) in c.fetchall():
+            shutil.rmtree(os.path.join(SCHEDULED_UPLOADS_DIR, str(job_id)), ignore_errors=True)
+        c.execute("UPDATE scheduled_broadcasts SET status = 'failed', error = ?, finished_at = ? WHERE status = 'saving'",
+                  ('Interrupted while saving attachments', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+        c.execute("SELECT id, send_at FROM scheduled_broadcasts WHERE status = 'pending'")
+        jobs = c.fetchall()
+        conn.close()
+        for job_id, send_at in jobs:
+            self.add(job_id, send_at)
+
+    def add(self, job_id, send_at):
+        when = parse_send_at(send_at).timestamp()
+        with self.condition:
+            heapq.heappush(self.queue, (when, job_id))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    timeout = self.queue[0][0] - time.time() if self.queue else None
+                    self.condition.wait(timeout)
+                _, job_id = heapq.heappop(self.queue)
+            # Run each job in its own thread so a long broadcast doesn't delay the next one
+            threading.Thread(target=run_scheduled_broadcast, args=(job_id,), daemon=True).start()
+
+broadcast_scheduler = BroadcastScheduler()
+
+@app.route('/broadcasts/schedule', methods=['POST'])
+def schedule_broadcast():
+    """Schedule a broadcast to a segment at send_at, optionally spread over spread_minutes"""
+    message = request.form.get('message')
+    files = request.files.getlist('files')
+    send_at = request.form.get('send_at')
+
+    if not message and not files:
+        return {'status': 'error', 'msg': 'Missing message or files'}, 400
+    if not send_at:
+        return {'status': 'error', 'msg': 'Missing send_at'}, 400
+
+    try:
+        send_at = parse_send_at(send_at).strftime('%Y-%m-%d %H:%M:%S')
+        spread_seconds = int(float(request.form.get('spread_minutes') or 0) * 60)
+        segment = parse_segment(request.form)
+    except ValueError as e:
+        return {'status': 'error', 'msg': f'Invalid schedule parameters: {e}'}, 400
+
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('INSERT INTO scheduled_broadcasts (message, segment, send_at, spread_seconds, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+              (message, json.dumps(segment), send_at, spread_seconds, 'saving', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    job_id = c.lastrowid
+    conn.commit()
+
+    try:
+        attachments = save_scheduled_attachments(job_id, files)
+    except Exception as e:
+        print(f"❌ Could not save attachments of scheduled broadcast {job_id}: {e}")
+        shutil.rmtree(os.path.join(SCHEDULED_UPLOADS_DIR, str(job_id)), ignore_errors=True)
+        c.execute("UPDATE scheduled_broadcasts SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                  (f'Could not save attachments: {e}', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id))
+        conn.commit()
+        conn.close()
+        return {'status': 'error', 'msg': f'Could not save attachments: {e}'}, 500
+    c.execute("UPDATE scheduled_broadcasts SET attachments = ?, status = 'pending' WHERE id = ?", (json.dumps(attachments), job_id))
+    conn.commit()
+    conn.close()
+
+    broadcast_scheduler.add(job_id, send_at)
+    print(f"⏰ Broadcast {job_id} scheduled for {send_at}")
+
+    return {
+        'status': 'ok',
+        'job_id': job_id,
+        'send_at': send_at,
+        'spread_seconds': spread_seconds,
+        'segment': segment,
+        'audience': count_segment_users(segment)
+    }
+
+@app.route('/broadcasts/scheduled')
+def list_scheduled_broadcasts():
+    """List the most recent scheduled broadcasts"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, message, segment, send_at, spread_seconds, status, sent_count, total_count, error, created_at, started_at, finished_at, broadcast_id
+        FROM scheduled_broadcasts
+        ORDER BY send_at DESC
+        LIMIT 100
+    ''')
+    jobs = c.fetchall()
+    conn.close()
+    return jsonify([
+        {
+            'job_id': row[0],
+            'message': row[1],
+            'segment': json.loads(row[2] or '{}'),
+            'send_at': row[3],
+            'spread_seconds': row[4],
+            'status': row[5],
+            'sent_count': row[6],
+            'total_count': row[7],
+            'error': row[8],
+            'created_at': row[9],
+            'started_at': row[10],
+            'finished_at': row[11],
+            'broadcast_id': row[12]
+        } for row in jobs
+    ])
+
+@app.route('/broadcasts/scheduled/<int:job_id>/cancel', methods=['POST'])
+def cancel_scheduled_broadcast(job_id):
+    """Cancel a scheduled broadcast that has not started yet"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("UPDATE scheduled_broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'pending'",
+              (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id))
+    cancelled = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    if not cancelled:
+        return jsonify({'status': 'error', 'msg': 'Job not found or already started'}), 404
+    shutil.rmtree(os.path.join(SCHEDULED_UPLOADS_DIR, str(job_id)), ignore_errors=True)
+    return jsonify({'status': 'ok', 'job_id': job_id})
 
 @app.route('/user/<int:user_id>/label', methods=['POST'])
 def set_user_label(user_id):
@@ -1902,6 +4528,33 @@ def set_user_label(user_id):
     conn.close()
     return jsonify({'status': 'ok', 'user_id': user_id, 'label': label})
 
+@app.route('/outbound-stats')
+def outbound_stats():
+    """Get the outbound dispatcher queue depth per priority and the remaining rate budget"""
+    return jsonify(outbound.stats())
+
+@app.route('/delivery-status')
+def delivery_status_stats():
+    """Get counts of users by delivery status"""
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(delivery_status, 'ok'), COUNT(*) FROM users GROUP BY COALESCE(delivery_status, 'ok')")
+    counts = dict(c.fetchall())
+    conn.close()
+    return jsonify({
+        'counts': counts,
+        'undeliverable': sum(counts.get(status, 0) for status in UNDELIVERABLE_STATUSES)
+    })
+
+@app.route('/delivery-status/revalidate', methods=['POST'])
+def delivery_status_revalidate():
+    """Manually run one revalidation pass over undeliverable users"""
+    try:
+        limit = int(request.args.get('limit', REVALIDATION_BATCH))
+        return jsonify({'status': 'ok', **revalidate_undeliverable_users(limit)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/tracking-stats')
 def get_tracking_stats():
     """Get tracking statistics for admin dashboard"""
@@ -2062,12 +4715,13 @@ def run_telegram_bot():
         print(f"🔧 Bot token: {BOT_TOKEN[:10]}...")
         print(f"🔧 Chat ID: {CHAT_ID}")
         
-        # Add error handling for bot conflicts
-        loop.run_until_complete(application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=['message', 'callback_query', 'chat_join_request'],
+        # run_polling drives the loop itself; it must not be awaited. Pending
+        # updates are kept: catch_up_updates handles them before polling starts
+        application.run_polling(
+            drop_pending_updates=False,
+            allowed_updates=ALLOWED_UPDATES,
             close_loop=False
-        ))
+        )
         print("✅ Telegram bot started successfully")
     except Exception as e:
         print(f"❌ Telegram bot error: {e}")
@@ -2107,8 +4761,8 @@ def run_pyrogram_bot():
             print("❌ Pyrogram app not available, exiting")
             return
         
-        # Run the bot
-        loop.run_until_complete(app.run())
+        # Run the bot and the pending join request sweeper
+        loop.run_until_complete(run_pyrogram_client(app))
     except Exception as e:
         print(f"❌ Pyrogram bot error: {e}")
         if "Conflict" in str(e):
@@ -2123,7 +4777,7 @@ def bot_status():
     """Check if bots are working properly"""
     try:
         # Test Telegram bot
-        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=5)
+        response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=5)
         telegram_status = "✅ Working" if response.status_code == 200 else "❌ Not working"
         
         # Test Pyrogram bot connection
@@ -2220,34 +4874,60 @@ def get_receptionist_id():
 def index():
     return "Hello, world!"
 
+MEDIA_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Range',
+    'Cache-Control': 'public, max-age=3600',  # Cache for 1 hour
+    'Accept-Ranges': 'bytes'
+}
+
+def fetch_telegram_media(file_path=None, file_id=None):
+    """Fetch a Telegram file by path or by file_id (through the shared getFile cache)"""
+    if file_id:
+        file_url = telegram_files.url(file_id)
+        if not file_url:
+            return None
+        response = requests.get(file_url, stream=True, timeout=30)
+        if response.status_code == 404:
+            # The cached path expired early; resolve it once more
+            response.close()
+            telegram_files.invalidate(file_id)
+            file_url = telegram_files.url(file_id, refresh=True)
+            if not file_url:
+                return None
+            response = requests.get(file_url, stream=True, timeout=30)
+        return response
+    return requests.get(f"{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}/{file_path}", stream=True, timeout=30)
+
+def telegram_media_response(file_path=None, file_id=None):
+    name = file_id or file_path
+    if file_id:
+        mirrored = media_mirror.lookup(file_id)
+        if mirrored is not None:
+            path, content_type = mirrored
+            response = send_file(os.path.abspath(path), mimetype=content_type, conditional=True, max_age=3600)
+            response.headers.update({k: v for k, v in MEDIA_HEADERS.items() if k != 'Cache-Control'})
+            return response
+        # Served from Telegram this time; later requests hit the local copy
+        media_mirror.prefetch(file_id)
+    response = fetch_telegram_media(file_path=file_path, file_id=file_id)
+    if response is not None and response.status_code == 200:
+        headers = dict(MEDIA_HEADERS)
+        headers['Content-Type'] = response.headers.get('Content-Type', 'application/octet-stream')
+        headers['Content-Length'] = response.headers.get('Content-Length', '')
+        return response.content, 200, headers
+    print(f"Telegram API error for {name}: {response.status_code if response is not None else 'getFile failed'}")
+    return jsonify({'error': 'File not found'}), 404
+
 @app.route('/media/<path:file_path>')
 def serve_media(file_path):
-    """Serve Telegram media files with proper CORS headers"""
+    """Serve Telegram media by file_id (or a legacy file path) with proper CORS headers"""
     try:
-        # Construct the full Telegram file URL
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        
-        # Fetch the file from Telegram
-        response = requests.get(file_url, stream=True, timeout=30)
-        
-        if response.status_code == 200:
-            # Set CORS headers
-            headers = {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Range',
-                'Content-Type': response.headers.get('Content-Type', 'application/octet-stream'),
-                'Content-Length': response.headers.get('Content-Length', ''),
-                'Cache-Control': 'public, max-age=3600',  # Cache for 1 hour
-                'Accept-Ranges': 'bytes'
-            }
-            
-            # Return the file with proper headers
-            return response.content, 200, headers
-        else:
-            print(f"Telegram API error for {file_path}: {response.status_code}")
-            return jsonify({'error': 'File not found'}), 404
-            
+        # Bot API file paths always contain a folder; file ids never contain a slash
+        if '/' in file_path:
+            return telegram_media_response(file_path=file_path)
+        return telegram_media_response(file_id=file_path)
     except Exception as e:
         print(f"Error serving media file {file_path}: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -2265,38 +4945,16 @@ def serve_media_options(file_path):
 
 @app.route('/media-proxy')
 def media_proxy():
-    """Proxy media files from Telegram with CORS support"""
+    """Proxy media files from Telegram by file_id or path with CORS support"""
+    file_id = request.args.get('file_id')
     file_path = request.args.get('path')
-    if not file_path:
+    if not file_id and not file_path:
         return jsonify({'error': 'No file path provided'}), 400
     
     try:
-        # Construct the full Telegram file URL
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        
-        # Fetch the file from Telegram
-        response = requests.get(file_url, stream=True, timeout=30)
-        
-        if response.status_code == 200:
-            # Set CORS headers
-            headers = {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Range',
-                'Content-Type': response.headers.get('Content-Type', 'application/octet-stream'),
-                'Content-Length': response.headers.get('Content-Length', ''),
-                'Cache-Control': 'public, max-age=3600',  # Cache for 1 hour
-                'Accept-Ranges': 'bytes'
-            }
-            
-            # Return the file with proper headers
-            return response.content, 200, headers
-        else:
-            print(f"Telegram API error for {file_path}: {response.status_code}")
-            return jsonify({'error': 'File not found'}), 404
-            
+        return telegram_media_response(file_path=file_path, file_id=file_id)
     except Exception as e:
-        print(f"Error proxying media file {file_path}: {e}")
+        print(f"Error proxying media file {file_id or file_path}: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/media-proxy', methods=['OPTIONS'])
@@ -2475,7 +5133,7 @@ async def mylink(update: Update, context: ContextTypes.DEFAULT_TYPE):
         personal_link = generate_personal_tracking_link(user.id, user.first_name)
         
         # Get referral stats
-        stats = get_referral_stats(user.id)
+        stats = await run_db(get_referral_stats, user.id)
         referral_count = stats['referral_count'] if stats else 0
         
         message_text = (
@@ -2829,7 +5487,7 @@ def admin_get_user_info(user_id):
                 'join_date': join_date,
                 'created_at': created_at,
                 'label': label,
-                'photo_url': photo_url
+                'photo_url': public_photo_url(photo_url)
             },
             'links': {
                 'current_link': invite_link,
@@ -3110,7 +5768,7 @@ def admin_get_tracking_users(user_id):
                     'username': row[2] or '',
                     'join_date': row[3],
                     'invite_link': row[4],
-                    'photo_url': row[5],
+                    'photo_url': public_photo_url(row[5]),
                     'label': row[6],
                     'is_online': get_user_online_status(row[0], 5)
                 } for row in referred_users
@@ -3190,7 +5848,7 @@ def test_bot_username():
         # Test bot username detection
         bot_username = None
         try:
-            response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=10)
+            response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=10)
             if response.status_code == 200:
                 bot_data = response.json()
                 if bot_data.get('ok'):
@@ -3230,6 +5888,7 @@ def test_bot_username():
 
 def start_bots():
     """Start bot processes - can be called by Railway or other deployment platforms"""
+    global RECEPTIONIST_ID
     import multiprocessing
     import time
     import os
@@ -3263,7 +5922,7 @@ def start_bots():
     
     # Check if bot is already running
     try:
-        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=5)
+        response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=5)
         if response.status_code == 200:
             print("✅ Bot is accessible")
         else:
@@ -3271,8 +5930,13 @@ def start_bots():
     except Exception as e:
         print(f"⚠️ Could not check bot status: {e}")
     
-    # Start bots in separate processes
-    telegram_process = multiprocessing.Process(target=run_telegram_bot, daemon=True)
+    # Start bots in separate processes (webhook mode runs the PTB application in this process)
+    if TELEGRAM_MODE == 'webhook':
+        telegram_process = None
+        if start_webhook_application():
+            print("🔗 Telegram bot running in webhook mode")
+    else:
+        telegram_process = multiprocessing.Process(target=run_telegram_bot, daemon=True)
     
     # Check if Pyrogram is available before starting
     pyrogram_available = False
@@ -3291,8 +5955,9 @@ def start_bots():
         pyrogram_process = None
         print("⚠️ Pyrogram bot process not started (Pyrogram not available)")
     
-    telegram_process.start()
-    print("🤖 Telegram bot process started")
+    if telegram_process is not None:
+        telegram_process.start()
+        print("🤖 Telegram bot process started")
     
     # Give the bots time to start
     print("⏳ Waiting for bots to initialize...")
@@ -3305,10 +5970,16 @@ def start_bots():
 telegram_process = None
 pyrogram_process = None
 
+def telegram_bot_running():
+    """Whether the PTB bot is up, either as the polling process or the webhook application"""
+    if TELEGRAM_MODE == 'webhook':
+        return webhook_loop is not None
+    return telegram_process is not None and telegram_process.is_alive()
+
 def initialize_bots_on_first_request():
     """Initialize bots on first request - called by Railway"""
     global telegram_process, pyrogram_process
-    if telegram_process is None or not telegram_process.is_alive():
+    if not telegram_bot_running():
         try:
             print("🚀 Railway detected - starting bots...")
             telegram_process, pyrogram_process = start_bots()
@@ -3321,7 +5992,7 @@ def manual_start_bots():
     """Manual endpoint to start bots - useful for Railway deployment"""
     global telegram_process, pyrogram_process
     try:
-        if telegram_process is None or not telegram_process.is_alive():
+        if not telegram_bot_running():
             print("🚀 Manually starting bots...")
             telegram_process, pyrogram_process = start_bots()
             return jsonify({
@@ -3334,7 +6005,7 @@ def manual_start_bots():
             return jsonify({
                 'status': 'already_running',
                 'message': 'Bots are already running',
-                'telegram_alive': telegram_process.is_alive(),
+                'telegram_alive': telegram_bot_running(),
                 'pyrogram_alive': pyrogram_process.is_alive() if pyrogram_process else False
             })
     except Exception as e:
@@ -3415,10 +6086,20 @@ try:
         except Exception as e:
             print(f"❌ Error starting bots in background: {e}")
     
-    # Start bots in background thread
-    bot_thread = threading.Thread(target=start_bots_background, daemon=True)
-    bot_thread.start()
-    print("🔄 Bot startup thread initiated")
+    # Start bots in background thread (AUTO_START_BOTS=0 disables this, e.g. for benchmarks)
+    if os.environ.get('AUTO_START_BOTS', '1') != '0':
+        bot_thread = threading.Thread(target=start_bots_background, daemon=True)
+        bot_thread.start()
+        print("🔄 Bot startup thread initiated")
+    else:
+        print("⏸️ AUTO_START_BOTS=0, bots not started")
+
+    # Periodically re-check users that blocked the bot or were deactivated
+    revalidation_thread = threading.Thread(target=run_delivery_revalidation_loop, daemon=True)
+    revalidation_thread.start()
+
+    # Scheduled broadcasts (re-queues jobs persisted before a restart)
+    broadcast_scheduler.start()
     
 except Exception as e:
     print(f"⚠️ Could not start bots during initialization: {e}")
@@ -3458,7 +6139,7 @@ if __name__ == '__main__':
     
     # Check if bot is already running
     try:
-        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getMe", timeout=5)
+        response = requests.get(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getMe", timeout=5)
         if response.status_code == 200:
             print("✅ Bot is accessible")
         else:
@@ -3466,8 +6147,13 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"⚠️ Could not check bot status: {e}")
     
-    # Start bots in separate processes
-    telegram_process = multiprocessing.Process(target=run_telegram_bot, daemon=True)
+    # Start bots in separate processes (webhook mode runs the PTB application in this process)
+    if TELEGRAM_MODE == 'webhook':
+        telegram_process = None
+        if start_webhook_application():
+            print("🔗 Telegram bot running in webhook mode")
+    else:
+        telegram_process = multiprocessing.Process(target=run_telegram_bot, daemon=True)
     
     # Check if Pyrogram is available before starting
     pyrogram_available = False
@@ -3486,8 +6172,9 @@ if __name__ == '__main__':
         pyrogram_process = None
         print("⚠️ Pyrogram bot process not started (Pyrogram not available)")
     
-    telegram_process.start()
-    print("🤖 Telegram bot process started")
+    if telegram_process is not None:
+        telegram_process.start()
+        print("🤖 Telegram bot process started")
     
     # Give the bots time to start
     print("⏳ Waiting for bots to initialize...")
@@ -3508,7 +6195,8 @@ if __name__ == '__main__':
         print("🛑 Shutting down...")
         if pyrogram_process:
             pyrogram_process.terminate()
-        telegram_process.terminate()
+        if telegram_process:
+            telegram_process.terminate()
         print("✅ All processes terminated")
 
 print("🚀 Flask app initialized for Railway deployment...")
@@ -0,0 +1,198 @@
+"""Broadcast and chat-send throughput benchmark against the fake Bot API.
+
+Drives /send_all, /send_one and /chat/<user_id> through the Flask test client
+with api.py pointed at a local FakeTelegramServer, and reports msgs/s,
+p50/p99 Bot API call latency and memory for each audience size.
+
+    python bench_broadcast.py
+    python bench_broadcast.py --sizes 1000,10000 --latency 0.005 --rate-403 0.02 --with-photo
+
+The database lives in a temporary directory, so users.db is never touched.
+"""
+import argparse
+import contextlib
+import io
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+from fake_telegram import FakeTelegramServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 1x1 transparent PNG
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000100055fe7ba0000000049454e44ae426082'
+)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+class CallTimer:
+    """Records the latency of every HTTP call made through requests"""
+
+    def __init__(self):
+        self.latencies = []
+        self.original_send = requests.adapters.HTTPAdapter.send
+
+    def install(self):
+        timer = self
+        original_send = self.original_send
+
+        def timed_send(adapter, request, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original_send(adapter, request, *args, **kwargs)
+            finally:
+                timer.latencies.append(time.perf_counter() - started)
+
+        requests.adapters.HTTPAdapter.send = timed_send
+
+    def reset(self):
+        self.latencies = []
+
+
+def seed_users(api, count):
+    """Replace all users and messages with count synthetic users"""
+    conn = sqlite3.connect(api.DB_NAME)
+    c = conn.cursor()
+    c.execute('DELETE FROM users')
+    c.execute('DELETE FROM messages')
+    join_date = time.strftime('%Y-%m-%d %H:%M:%S')
+    c.executemany(
+        'INSERT INTO users (user_id, full_name, username, join_date, created_at) VALUES (?, ?, ?, ?, ?)',
+        ((user_id, f'Bench User {user_id}', f'bench{user_id}', join_date, join_date) for user_id in range(1, count + 1))
+    )
+    conn.commit()
+    conn.close()
+
+
+def request_data(message, with_photo):
+    data = {'message': message}
+    if with_photo:
+        data['files'] = (io.BytesIO(TINY_PNG), 'bench_photo.png', 'image/png')
+    return data
+
+
+def run_scenario(name, func, timer, server, trace_memory):
+    """Run one scenario and collect throughput, latency and memory figures"""
+    timer.reset()
+    server.reset_stats()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        requests_made = func()
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    calls = len(timer.latencies)
+    stats = dict(server.stats)
+    return {
+        'scenario': name,
+        'requests': requests_made,
+        'api_calls': calls,
+        'elapsed': elapsed,
+        'msgs_per_s': calls / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(timer.latencies, 50) * 1000,
+        'p99_ms': percentile(timer.latencies, 99) * 1000,
+        'peak_alloc_mb': peak / 1024 / 1024 if peak is not None else None,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'http_429': stats.get('429', 0),
+        'http_403': stats.get('403', 0)
+    }
+
+
+def print_result(size, result):
+    peak = f"{result['peak_alloc_mb']:.1f}" if result['peak_alloc_mb'] is not None else '-'
+    print(f"{size:>8} {result['scenario']:<10} {result['api_calls']:>8} {result['elapsed']:>9.2f} "
+          f"{result['msgs_per_s']:>9.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+          f"{peak:>9} {result['max_rss_mb']:>8.1f} {result['http_429']:>6} {result['http_403']:>6}")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark send_all, send_one and chat_send against a fake Bot API')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated recipient counts')
+    parser.add_argument('--single-limit', type=int, default=1000,
+                        help='Max recipients driven through send_one/chat_send per size (one request each)')
+    parser.add_argument('--scenarios', default='send_all,send_one,chat_send')
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake server latency per call in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-403', type=float, default=0.0)
+    parser.add_argument('--outbound-rate', type=float, default=0.0,
+                        help='Global outbound sends per second (0 = unlimited, production default is 30)')
+    parser.add_argument('--with-photo', action='store_true', help='Attach a small photo to every send')
+    parser.add_argument('--trace-memory', action='store_true', help='Report tracemalloc peak (slower)')
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(latency=args.latency, jitter=args.jitter,
+                                rate_429=args.rate_429, rate_403=args.rate_403).start()
+    workdir = tempfile.mkdtemp(prefix='bench_broadcast_')
+    os.environ['TELEGRAM_API_BASE'] = server.base_url
+    os.environ['AUTO_START_BOTS'] = '0'
+    os.environ['OUTBOUND_RATE'] = str(args.outbound_rate)
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import api
+    client = api.app.test_client()
+    timer = CallTimer()
+    timer.install()
+
+    print(f"Fake Bot API: {server.base_url} (latency {args.latency}s, 429 rate {args.rate_429}, 403 rate {args.rate_403})")
+    print(f"{'users':>8} {'scenario':<10} {'calls':>8} {'seconds':>9} {'msgs/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'peak MB':>9} {'rss MB':>8} {'429':>6} {'403':>6}")
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    try:
+        for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+            single = min(size, args.single_limit)
+
+            def bench_send_all():
+                client.post('/send_all', data=request_data('Benchmark broadcast', args.with_photo),
+                            content_type='multipart/form-data')
+                return 1
+
+            def bench_send_one():
+                for user_id in range(1, single + 1):
+                    client.post('/send_one', data=dict(request_data('Benchmark direct', args.with_photo), user_id=str(user_id)),
+                                content_type='multipart/form-data')
+                return single
+
+            def bench_chat_send():
+                for user_id in range(1, single + 1):
+                    client.post(f'/chat/{user_id}', data=request_data('Benchmark reply', args.with_photo),
+                                content_type='multipart/form-data')
+                return single
+
+            funcs = {'send_all': bench_send_all, 'send_one': bench_send_one, 'chat_send': bench_chat_send}
+            for name in scenarios:
+                seed_users(api, size)
+                print_result(size, run_scenario(name, funcs[name], timer, server, args.trace_memory))
+    finally:
+        server.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
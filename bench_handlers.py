@@ -0,0 +1,165 @@
+"""Inbound message handler benchmark with synthetic updates.
+
+Feeds synthetic text and media updates straight into api.user_message_handler
+with a PTB Bot pointed at a local FakeTelegramServer, and reports handler
+throughput, p50/p99 latency and Bot API calls per update for each kind, and
+how many messages per-user flood control deferred or dropped.
+
+    python bench_handlers.py
+    python bench_handlers.py --updates 2000 --users 50 --latency 0.02 --concurrency 8
+    python bench_handlers.py --users 1 --kinds text,photo   # one user flooding
+
+The database lives in a temporary directory, so users.db is never touched.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+from fake_telegram import FakeTelegramServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# kind -> (file folder, extension, size, header, extra fields of the media object)
+MEDIA_KINDS = {
+    'photo': ('photos', 'jpg', 80 * 1024, b'\xff\xd8\xff', {'width': 1280, 'height': 1280}),
+    'video': ('videos', 'mp4', 2 * 1024 * 1024, b'\x00\x00\x00\x18ftyp', {'width': 640, 'height': 360, 'duration': 5}),
+    'voice': ('voice', 'oga', 30 * 1024, b'OggS', {'duration': 3}),
+    'audio': ('music', 'mp3', 3 * 1024 * 1024, b'ID3', {'duration': 180}),
+    'document': ('documents', 'pdf', 200 * 1024, b'%PDF', {'file_name': 'report.pdf', 'mime_type': 'application/pdf'}),
+    'animation': ('animations', 'mp4', 500 * 1024, b'\x00\x00\x00\x18ftyp', {'width': 320, 'height': 240, 'duration': 2}),
+    'sticker': ('stickers', 'webp', 20 * 1024, b'RIFF', {'width': 512, 'height': 512, 'is_animated': False, 'is_video': False, 'type': 'regular'}),
+    'video_note': ('video_notes', 'mp4', 400 * 1024, b'\x00\x00\x00\x18ftyp', {'length': 240, 'duration': 4})
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def build_message(server, kind, update_id, user_id):
+    """Synthetic message dict of the given kind from user_id"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'Bench{user_id}', 'username': f'bench{user_id}'}
+    }
+    if kind == 'text':
+        message['text'] = f'Benchmark message {update_id}'
+        return message
+    folder, extension, size, header, extra = MEDIA_KINDS[kind]
+    file_id = server.register_file(kind, folder, extension, size, header)
+    media = server.file_object(file_id, **extra)
+    if kind == 'photo':
+        message['photo'] = [server.file_object(file_id, width=90, height=90), media]
+    elif kind == 'animation':
+        # Telegram sends animations with a matching document
+        message['animation'] = media
+        message['document'] = server.file_object(file_id, file_name='animation.mp4', mime_type='video/mp4')
+    else:
+        message[kind] = media
+    return message
+
+
+async def run_kind(api, bot, server, kind, count, users, concurrency):
+    """Push count updates of one kind through the handler and collect timings"""
+    from telegram import Update
+
+    updates = [
+        Update.de_json({'update_id': i, 'message': build_message(server, kind, i, 1000 + i % users)}, bot)
+        for i in range(1, count + 1)
+    ]
+    context = types.SimpleNamespace(bot=bot, args=[])
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(update):
+        async with semaphore:
+            started = time.perf_counter()
+            await api.user_message_handler(update, context)
+            latencies.append(time.perf_counter() - started)
+
+    server.reset_stats()
+    started = time.perf_counter()
+    await asyncio.gather(*(handle(update) for update in updates))
+    elapsed = time.perf_counter() - started
+    stats = dict(server.stats)
+    api_calls = sum(v for k, v in stats.items() if k not in ('429', '403', 'upload_bytes'))
+    return {
+        'kind': kind,
+        'updates': count,
+        'elapsed': elapsed,
+        'per_s': count / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'calls_per_update': api_calls / count,
+        'get_file': stats.get('getFile', 0)
+    }
+
+
+async def run(args, api, server):
+    from telegram import Bot
+
+    bot = Bot(api.BOT_TOKEN, base_url=f"{server.base_url}/bot", base_file_url=f"{server.base_url}/file/bot")
+    async with bot:
+        # Warm the profile photo and known-user caches so the steady state is measured
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            await run_kind(api, bot, server, 'text', args.users, args.users, args.concurrency)
+            await asyncio.sleep(0.5)
+
+        print(f"{'kind':<11} {'updates':>8} {'seconds':>9} {'upd/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'calls/upd':>10} {'getFile':>8}")
+        for kind in [k.strip() for k in args.kinds.split(',') if k.strip()]:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                result = await run_kind(api, bot, server, kind, args.updates, args.users, args.concurrency)
+            print(f"{result['kind']:<11} {result['updates']:>8} {result['elapsed']:>9.2f} {result['per_s']:>9.1f} "
+                  f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['calls_per_update']:>10.2f} {result['get_file']:>8}")
+            sys.stdout.flush()
+
+        api.flood_control.flush()
+        while api.flood_control.tasks:
+            await asyncio.gather(*list(api.flood_control.tasks))
+        flood = api.flood_control.stats()
+        print(f"flood control: {flood.get('deferred', 0)} deferred in {flood.get('flushes', 0)} writes, {flood.get('dropped', 0)} dropped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark user_message_handler with synthetic updates')
+    parser.add_argument('--updates', type=int, default=500, help='Updates per kind')
+    parser.add_argument('--users', type=int, default=100, help='Distinct senders')
+    parser.add_argument('--kinds', default='text,' + ','.join(MEDIA_KINDS))
+    parser.add_argument('--concurrency', type=int, default=1, help='Updates handled at once')
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake server latency per call in seconds')
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(latency=args.latency, profile_photos=True).start()
+    workdir = tempfile.mkdtemp(prefix='bench_handlers_')
+    os.environ['TELEGRAM_API_BASE'] = server.base_url
+    os.environ['AUTO_START_BOTS'] = '0'
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import api
+
+    print(f"Fake Bot API: {server.base_url} (latency {args.latency}s, concurrency {args.concurrency})")
+    try:
+        asyncio.run(run(args, api, server))
+    finally:
+        server.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
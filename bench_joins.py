@@ -0,0 +1,162 @@
+"""Join-request burst load test against the fake Bot API.
+
+Feeds synthetic chat_join_request updates through api.approve_join with a PTB
+Bot pointed at a local FakeTelegramServer, and reports how fast requests are
+approved, how long until every row is committed, how long background
+enrichment (photos, welcome DMs) takes, how many admin and referrer
+notifications went out on their own or folded into digests, and the Bot API
+calls and database batches used per join.
+
+    python bench_joins.py
+    python bench_joins.py --joins 5000 --latency 0.02 --concurrency 16 --referred 0.3
+    python bench_joins.py --redeliver 1.0   # every request arrives twice, as with PTB and Pyrogram both running
+
+The database lives in a temporary directory, so users.db is never touched.
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+from fake_telegram import FakeTelegramServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def build_join_request(api, update_id, user_id, referrer):
+    """Synthetic chat_join_request update, optionally through a referrer's tracking link"""
+    link = f"https://t.me/+bench?ref={referrer}" if referrer else 'https://t.me/+bench'
+    return {
+        'update_id': update_id,
+        'chat_join_request': {
+            'chat': {'id': api.CHAT_ID, 'type': 'supergroup', 'title': 'Bench Group'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Joiner{user_id}', 'username': f'joiner{user_id}'},
+            'user_chat_id': user_id,
+            'date': int(time.time()),
+            'invite_link': {'invite_link': link, 'creator': {'id': 1, 'is_bot': False, 'first_name': 'Admin'},
+                            'creates_join_request': True, 'is_primary': False, 'is_revoked': False}
+        }
+    }
+
+
+def count_users(api):
+    conn = sqlite3.connect(api.DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM users')
+    total = c.fetchone()[0]
+    conn.close()
+    return total
+
+
+async def run(args, api, server):
+    from telegram import Bot, Update
+    from telegram.request import HTTPXRequest
+
+    # Same connection pool size as the bot ApplicationBuilder creates
+    bot = Bot(api.BOT_TOKEN, base_url=f"{server.base_url}/bot", base_file_url=f"{server.base_url}/file/bot",
+              request=HTTPXRequest(connection_pool_size=256))
+    async with bot:
+        referrers = max(1, args.joins // 50)
+        updates = []
+        for i in range(1, args.joins + 1):
+            referrer = 500000 + i % referrers if (i % 100) < args.referred * 100 else None
+            updates.append(Update.de_json(build_join_request(api, i, 100000 + i, referrer), bot))
+        # The same request delivered again, as the second transport sees it
+        updates += [Update.de_json(update.to_dict(), bot) for update in updates[:int(args.joins * args.redeliver)]]
+        context = types.SimpleNamespace(bot=bot, args=[])
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def handle(update):
+            async with semaphore:
+                started = time.perf_counter()
+                await api.approve_join(update, context)
+                latencies.append(time.perf_counter() - started)
+
+        server.reset_stats()
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            await asyncio.gather(*(handle(update) for update in updates))
+            approved = time.perf_counter() - started
+            api.join_pipeline.flush()
+            while api.join_pipeline.commit_tasks:
+                await asyncio.gather(*list(api.join_pipeline.commit_tasks))
+            committed = time.perf_counter() - started
+            await api.join_pipeline.drain(stages=['welcome', 'channel_welcome'])
+            welcomed = time.perf_counter() - started
+            await api.join_pipeline.drain(stages=['photo'])
+            photos = time.perf_counter() - started
+            # Close the digest windows instead of waiting for them to expire
+            digest = api.notification_digest
+            for chat_id in list(digest.chats):
+                digest.flush(chat_id)
+            while digest.tasks:
+                await asyncio.gather(*list(digest.tasks))
+            notified = time.perf_counter() - started
+
+    stats = dict(server.stats)
+    calls = {k: v for k, v in stats.items() if k not in ('429', '403', 'upload_bytes')}
+    pipeline = api.join_pipeline.stats()
+    print(f"joins:        {args.joins} (concurrency {args.concurrency}, {args.referred:.0%} referred, {args.redeliver:.0%} redelivered)")
+    print(f"approved:     {approved:.2f}s ({len(updates) / approved:.0f} requests/s), handler p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms")
+    print(f"committed:    {committed:.2f}s, {pipeline.get('batches', 0)} DB batches, {count_users(api)} users in DB, "
+          f"{pipeline.get('duplicates', 0)} duplicate deliveries skipped")
+    print(f"welcome DMs:  {welcomed:.2f}s ({pipeline.get('welcome_done', 0)} joins, "
+          f"{pipeline.get('channel_welcome_done', 0)} failed DMs covered by {pipeline.get('channel_welcome_done', 0) - pipeline.get('channel_welcome_skipped', 0)} channel post(s))")
+    print(f"photos:       {photos:.2f}s ({pipeline.get('photo_done', 0)} joins)")
+    notifications = api.notification_digest.stats()
+    print(f"notifications: {notified:.2f}s, {notifications.get('immediate', 0)} sent immediately, "
+          f"{notifications.get('deferred', 0)} folded into {notifications.get('digests', 0)} digests")
+    print(f"Bot API calls per join: {sum(calls.values()) / args.joins:.2f} ({', '.join(f'{k}={v}' for k, v in sorted(calls.items()))})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the join-request pipeline')
+    parser.add_argument('--joins', type=int, default=2000, help='Join requests in the burst')
+    parser.add_argument('--concurrency', type=int, default=16, help='Join requests handled at once')
+    parser.add_argument('--referred', type=float, default=0.2, help='Fraction of joins through a referral link')
+    parser.add_argument('--latency', type=float, default=0.01, help='Fake server latency per call in seconds')
+    parser.add_argument('--redeliver', type=float, default=0.0, help='Fraction of requests delivered a second time')
+    parser.add_argument('--rate-403', type=float, default=0.0, help='Fraction of users that blocked the bot')
+    parser.add_argument('--outbound-rate', type=float, default=0, help='Outbound sends per second (0 = uncapped)')
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(latency=args.latency, rate_403=args.rate_403, profile_photos=True).start()
+    workdir = tempfile.mkdtemp(prefix='bench_joins_')
+    os.environ['TELEGRAM_API_BASE'] = server.base_url
+    os.environ['AUTO_START_BOTS'] = '0'
+    os.environ['OUTBOUND_RATE'] = str(args.outbound_rate)
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import api
+    # Profile photo pacing protects the real Bot API; the fake one doesn't need it
+    if not args.outbound_rate:
+        api.join_pipeline.photo_interval = 0
+
+    print(f"Fake Bot API: {server.base_url} (latency {args.latency}s)")
+    try:
+        asyncio.run(run(args, api, server))
+    finally:
+        server.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,77 @@ def init_db():
         message TEXT,
         timestamp TEXT
     )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        segment TEXT,
+        attachments TEXT,
+        send_at TEXT,
+        spread_seconds INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'pending',
+        sent_count INTEGER DEFAULT 0,
+        total_count INTEGER DEFAULT 0,
+        error TEXT,
+        created_at TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        broadcast_id INTEGER
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_broadcasts_status ON scheduled_broadcasts (status, send_at)')
+    c.execute('''CREATE TABLE IF NOT EXISTS media_cache (
+        sha256 TEXT,
+        kind TEXT,
+        file_id TEXT,
+        size INTEGER,
+        last_used TEXT,
+        PRIMARY KEY (sha256, kind)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache (last_used)')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        segment TEXT,
+        status TEXT DEFAULT 'sending',
+        sent_count INTEGER DEFAULT 0,
+        total_count INTEGER DEFAULT 0,
+        created_at TEXT,
+        finished_at TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS delivery_receipts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        message_id INTEGER,
+        kind TEXT,
+        status TEXT,
+        updated_at TEXT
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_delivery_receipts_broadcast ON delivery_receipts (broadcast_id, status)')
+    c.execute('''CREATE TABLE IF NOT EXISTS media_mirror (
+        file_id TEXT PRIMARY KEY,
+        sha256 TEXT,
+        size INTEGER,
+        content_type TEXT,
+        last_used TEXT
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_mirror_sha256 ON media_mirror (sha256)')
+    c.execute('''CREATE TABLE IF NOT EXISTS join_requests (
+        chat_id INTEGER,
+        user_id INTEGER,
+        request_date INTEGER,
+        source TEXT,
+        status TEXT,
+        created_at TEXT,
+        approved_at TEXT,
+        claimed_at INTEGER,
+        PRIMARY KEY (chat_id, user_id, request_date)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_join_requests_created_at ON join_requests (created_at)')
+    c.execute('''CREATE TABLE IF NOT EXISTS bot_state (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TEXT
+    )''')
     conn.commit()
     conn.close()
 
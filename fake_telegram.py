@@ -0,0 +1,422 @@
+"""Fake Telegram Bot API server for local benchmarks and tests.
+
+Implements the subset of the Bot API used by api.py (sendMessage, sendPhoto,
+sendVideo, sendDocument, sendMediaGroup, getFile, getMe and friends) with
+configurable latency and injected 429 / 403 errors, so send paths can be
+measured without touching real Telegram.
+
+Run standalone and point the app at it:
+
+    python fake_telegram.py --port 8081 --latency 0.05 --rate-429 0.01 --rate-403 0.02
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 python api.py
+
+or embed it with FakeTelegramServer(...).start() (see bench_broadcast.py).
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+FAKE_BOT = {
+    'id': 1000000001,
+    'is_bot': True,
+    'first_name': 'Fake Bot',
+    'username': 'fake_test_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False
+}
+
+# Bot API methods that deliver something to a chat (subject to 403 injection)
+SEND_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument', 'sendAudio', 'sendVoice',
+    'sendAnimation', 'sendMediaGroup', 'sendChatAction', 'editMessageText', 'editMessageCaption', 'copyMessage'
+}
+
+# Upload field -> (result key, file_path folder, extension)
+MEDIA_FIELDS = {
+    'photo': ('photo', 'photos', 'jpg'),
+    'video': ('video', 'videos', 'mp4'),
+    'document': ('document', 'documents', 'bin'),
+    'audio': ('audio', 'music', 'mp3'),
+    'voice': ('voice', 'voice', 'oga'),
+    'animation': ('animation', 'animations', 'mp4')
+}
+
+HEADER_BYTES = 64  # Bytes of each upload kept so /file/ can serve real magic numbers
+
+
+class FakeTelegramServer:
+    """Threaded fake Bot API server with latency and error injection"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 rate_429=0.0, rate_403=0.0, retry_after=1, blocked_chats=None,
+                 profile_photos=False, seed=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_403 = rate_403
+        self.retry_after = retry_after
+        self.blocked_chats = set(blocked_chats or [])
+        self.profile_photos = profile_photos
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.files = {}  # file_id -> {'file_path', 'size', 'header', 'kind'}
+        self.stats = Counter()
+        self.webhook = None  # parameters of the last setWebhook call
+        self.updates = []  # pending updates served by getUpdates, oldest first
+        self.server = None
+        self.thread = None
+        self.app = self.create_app()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self.server = make_server(self.host, self.port, self.app, threaded=True)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+
+    def queue_updates(self, updates):
+        """Make updates pending, as if they arrived while the bot was offline"""
+        with self.lock:
+            self.updates.extend(updates)
+
+    # --- Behaviour ---
+
+    def is_blocked(self, chat_id):
+        """Deterministically block a fraction of chats so the same users fail on every run"""
+        if chat_id is None:
+            return False
+        if str(chat_id) in self.blocked_chats:
+            return True
+        if self.rate_403 <= 0:
+            return False
+        digest = hashlib.sha256(f"{self.seed}:{chat_id}".encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.rate_403
+
+    def register_file(self, kind, folder, extension, size, header=b''):
+        with self.lock:
+            number = next(self.file_ids)
+        file_id = f"FAKE{kind.upper()}{number:012d}"
+        self.files[file_id] = {
+            'file_path': f"{folder}/file_{number}.{extension}",
+            'size': size,
+            'header': header,
+            'kind': kind
+        }
+        return file_id
+
+    def file_object(self, file_id, **extra):
+        info = self.files.get(file_id, {'size': 0})
+        return dict({
+            'file_id': file_id,
+            'file_unique_id': 'U' + hashlib.md5(file_id.encode()).hexdigest()[:15],
+            'file_size': info['size']
+        }, **extra)
+
+    def read_upload(self, field, value):
+        """Return a file_id for an uploaded file, an attach:// reference or an existing file_id"""
+        result_key, folder, extension = MEDIA_FIELDS[field]
+        if value and value.startswith('attach://'):
+            field_name = value[len('attach://'):]
+        else:
+            field_name = field
+        upload = request.files.get(field_name)
+        if upload is not None:
+            header = upload.stream.read(HEADER_BYTES)
+            size = len(header)
+            for chunk in iter(lambda: upload.stream.read(64 * 1024), b''):
+                size += len(chunk)
+            with self.lock:
+                self.stats['upload_bytes'] += size
+            return self.register_file(result_key, folder, extension, size, header)
+        if value and value in self.files:
+            return value
+        # Missing upload or unknown file_id (e.g. from another server run)
+        return None
+
+    def media_payload(self, field, file_id, filename=None):
+        result_key = MEDIA_FIELDS[field][0]
+        if result_key == 'photo':
+            small = self.file_object(file_id, width=90, height=90)
+            large = self.file_object(file_id, width=1280, height=1280)
+            return {'photo': [small, large]}
+        extra = {}
+        if filename:
+            extra['file_name'] = filename
+        return {result_key: self.file_object(file_id, **extra)}
+
+    def message(self, chat_id, **fields):
+        with self.lock:
+            message_id = next(self.message_ids)
+        return dict({
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private' if int(chat_id) > 0 else 'channel'},
+            'from': {'id': FAKE_BOT['id'], 'is_bot': True, 'first_name': FAKE_BOT['first_name']}
+        }, **fields)
+
+    # --- HTTP ---
+
+    def create_app(self):
+        app = Flask('fake_telegram')
+
+        @app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+        def bot_method(token, method):
+            return self.handle(method)
+
+        @app.route('/file/bot<token>/<path:file_path>')
+        def download(token, file_path):
+            return self.download(file_path)
+
+        @app.route('/_stats')
+        def stats():
+            with self.lock:
+                return jsonify(dict(self.stats))
+
+        return app
+
+    def params(self):
+        params = request.values.to_dict()
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            params.update(body)
+        return params
+
+    def error(self, status, description, **parameters):
+        payload = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        return jsonify(payload), status
+
+    def handle(self, method):
+        params = self.params()
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        with self.lock:
+            self.stats[method] += 1
+            inject_429 = self.rate_429 > 0 and self.random.random() < self.rate_429
+        if inject_429:
+            with self.lock:
+                self.stats['429'] += 1
+            return self.error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+
+        chat_id = params.get('chat_id')
+        if method in SEND_METHODS and self.is_blocked(chat_id):
+            with self.lock:
+                self.stats['403'] += 1
+            return self.error(403, 'Forbidden: bot was blocked by the user')
+
+        handler = getattr(self, f"method_{method}", None)
+        if handler is None:
+            return self.error(404, 'Not Found')
+        try:
+            result = handler(params)
+        except BadRequest as e:
+            return self.error(400, f"Bad Request: {e}")
+        return jsonify({'ok': True, 'result': result})
+
+    def download(self, file_path):
+        info = next((f for f in self.files.values() if f['file_path'] == file_path), None)
+        if info is None:
+            return self.error(404, 'Not Found')
+        body = (info['header'] + b'\0' * max(0, info['size'] - len(info['header'])))[:info['size']]
+        range_header = request.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start, _, end = range_header[len('bytes='):].partition('-')
+            start = int(start or 0)
+            end = int(end) if end else len(body) - 1
+            return body[start:end + 1], 206, {
+                'Content-Type': 'application/octet-stream',
+                'Content-Range': f"bytes {start}-{end}/{len(body)}"
+            }
+        return body, 200, {'Content-Type': 'application/octet-stream'}
+
+    # --- Bot API methods ---
+
+    def require_chat(self, params):
+        if params.get('chat_id') in (None, ''):
+            raise BadRequest('chat_id is empty')
+        return params['chat_id']
+
+    def method_getMe(self, params):
+        return FAKE_BOT
+
+    def method_sendMessage(self, params):
+        chat_id = self.require_chat(params)
+        if not params.get('text'):
+            raise BadRequest('message text is empty')
+        return self.message(chat_id, text=params['text'])
+
+    def send_media(self, field, params):
+        chat_id = self.require_chat(params)
+        file_id = self.read_upload(field, params.get(field))
+        if file_id is None:
+            raise BadRequest('wrong file identifier/HTTP URL specified')
+        upload = request.files.get(field)
+        fields = self.media_payload(field, file_id, upload.filename if upload else None)
+        if params.get('caption'):
+            fields['caption'] = params['caption']
+        return self.message(chat_id, **fields)
+
+    def method_sendPhoto(self, params):
+        return self.send_media('photo', params)
+
+    def method_sendVideo(self, params):
+        return self.send_media('video', params)
+
+    def method_sendDocument(self, params):
+        return self.send_media('document', params)
+
+    def method_sendAudio(self, params):
+        return self.send_media('audio', params)
+
+    def method_sendVoice(self, params):
+        return self.send_media('voice', params)
+
+    def method_sendAnimation(self, params):
+        return self.send_media('animation', params)
+
+    def method_sendMediaGroup(self, params):
+        chat_id = self.require_chat(params)
+        media = params.get('media')
+        if isinstance(media, str):
+            media = json.loads(media)
+        if not media or not 2 <= len(media) <= 10:
+            raise BadRequest('media group must include 2-10 items')
+        messages = []
+        for item in media:
+            field = item.get('type')
+            if field not in MEDIA_FIELDS:
+                raise BadRequest(f"unsupported media type {field}")
+            file_id = self.read_upload(field, item.get('media'))
+            if file_id is None:
+                raise BadRequest('wrong file identifier/HTTP URL specified')
+            fields = self.media_payload(field, file_id)
+            if item.get('caption'):
+                fields['caption'] = item['caption']
+            messages.append(self.message(chat_id, media_group_id='FAKEGROUP', **fields))
+        return messages
+
+    def method_getFile(self, params):
+        file_id = params.get('file_id')
+        if file_id not in self.files:
+            raise BadRequest('invalid file_id')
+        return self.file_object(file_id, file_path=self.files[file_id]['file_path'])
+
+    def method_sendChatAction(self, params):
+        self.require_chat(params)
+        return True
+
+    def method_editMessageText(self, params):
+        chat_id = self.require_chat(params)
+        return self.message(chat_id, text=params.get('text', ''), edit_date=int(time.time()))
+
+    def method_editMessageCaption(self, params):
+        chat_id = self.require_chat(params)
+        return self.message(chat_id, caption=params.get('caption', ''), edit_date=int(time.time()))
+
+    def method_deleteMessage(self, params):
+        self.require_chat(params)
+        return True
+
+    def method_getUserProfilePhotos(self, params):
+        if not self.profile_photos:
+            return {'total_count': 0, 'photos': []}
+        file_id = f"FAKEPROFILE{params.get('user_id')}"
+        if file_id not in self.files:
+            self.files[file_id] = {'file_path': f"profile_photos/{params.get('user_id')}.jpg", 'size': 2048, 'header': b'\xff\xd8\xff', 'kind': 'photo'}
+        return {'total_count': 1, 'photos': [[self.file_object(file_id, width=160, height=160)]]}
+
+    def method_approveChatJoinRequest(self, params):
+        self.require_chat(params)
+        return True
+
+    def method_declineChatJoinRequest(self, params):
+        self.require_chat(params)
+        return True
+
+    def method_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        with self.lock:
+            if offset > 0:
+                # An offset confirms every update below it
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            return self.updates[:limit]
+
+    def method_setWebhook(self, params):
+        self.webhook = dict(params)
+        return True
+
+    def method_deleteWebhook(self, params):
+        self.webhook = None
+        return True
+
+    def method_getWebhookInfo(self, params):
+        webhook = self.webhook or {}
+        return {'url': webhook.get('url', ''), 'has_custom_certificate': False, 'pending_update_count': len(self.updates)}
+
+
+class BadRequest(Exception):
+    """Raised by fake methods to produce a 400 Bad Request response"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra random latency up to this many seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Probability of a 429 Too Many Requests')
+    parser.add_argument('--rate-403', type=float, default=0.0, help='Fraction of chats that have blocked the bot')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--blocked', default='', help='Comma separated chat IDs that have blocked the bot')
+    parser.add_argument('--profile-photos', action='store_true', help='Give every user a profile photo')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        rate_429=args.rate_429, rate_403=args.rate_403, retry_after=args.retry_after,
+        blocked_chats=[c for c in args.blocked.split(',') if c], profile_photos=args.profile_photos,
+        seed=args.seed
+    ).start()
+    print(f"🧪 Fake Telegram Bot API listening on {server.base_url}")
+    print(f"   export TELEGRAM_API_BASE={server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""Replay recorded Telegram updates against the webhook endpoint.
+
+Updates are read from a JSON array, a JSON-lines file or a saved getUpdates
+response ({"ok": true, "result": [...]}), or generated with --synthetic.
+
+Against a running server (TELEGRAM_MODE=webhook):
+
+    python replay_updates.py --file updates.json --url http://127.0.0.1:5001 --secret <WEBHOOK_SECRET>
+
+Without --url the harness runs everything locally: it starts a FakeTelegramServer,
+imports api.py in webhook mode inside a temporary directory and posts through the
+Flask test client, then reports acknowledgement latency and the Bot API calls the
+handlers made:
+
+    python replay_updates.py --synthetic 500 --kinds text,photo --save updates.json
+
+With --catch-up the updates are left pending on the fake server instead, and
+api.catch_up_updates handles them the way the polling bot does after a restart.
+The same updates are then offered again to check that none is handled twice:
+
+    python replay_updates.py --synthetic 2000 --kinds text --catch-up
+
+--fail-updates makes the handlers of that many backlog updates raise for their
+first --fail-attempts runs, to check that failed updates are retried and never
+skipped:
+
+    python replay_updates.py --synthetic 1000 --kinds text --catch-up --fail-updates 5 --fail-attempts 2
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def load_updates(path):
+    """Read updates from a JSON array, JSON lines or a getUpdates response"""
+    with open(path) as f:
+        content = f.read().strip()
+    if not content:
+        return []
+    if content[0] in '[{':
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            data = data.get('result', [data])
+        if isinstance(data, list):
+            return data
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def synthetic_updates(server, count, kinds, users):
+    """Generate updates with bench_handlers' message builder"""
+    from bench_handlers import build_message
+
+    kinds = [k.strip() for k in kinds.split(',') if k.strip()]
+    return [
+        {'update_id': i, 'message': build_message(server, kinds[i % len(kinds)], i, 1000 + i % users)}
+        for i in range(1, count + 1)
+    ]
+
+
+def post_remote(updates, url, secret, concurrency):
+    """POST each update to a running server; returns (status counts, ack latencies)"""
+    import requests
+
+    endpoint = f"{url.rstrip('/')}/telegram/webhook/{secret}"
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret}
+    session = requests.Session()
+
+    def post(update):
+        started = time.perf_counter()
+        response = session.post(endpoint, json=update, headers=headers, timeout=10)
+        return response.status_code, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post, updates))
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses, [latency for _, latency in results]
+
+
+def post_local(api, updates):
+    """POST each update through the Flask test client; returns (status counts, ack latencies)"""
+    client = api.app.test_client()
+    endpoint = f"/telegram/webhook/{api.WEBHOOK_SECRET}"
+    headers = {'X-Telegram-Bot-Api-Secret-Token': api.WEBHOOK_SECRET}
+    statuses = {}
+    latencies = []
+    for update in updates:
+        started = time.perf_counter()
+        response = client.post(endpoint, json=update, headers=headers)
+        latencies.append(time.perf_counter() - started)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    return statuses, latencies
+
+
+def pending_updates(api):
+    processor = api.update_processor
+    return api.application.update_queue.qsize() + processor.active + processor.waiting
+
+
+def wait_for_drain(api, timeout):
+    """Wait until the application has handled every queued update"""
+    deadline = time.time() + timeout
+    while pending_updates(api) and time.time() < deadline:
+        time.sleep(0.02)
+    return pending_updates(api)
+
+
+def count_messages(api):
+    conn = sqlite3.connect(api.DB_NAME)
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM messages')
+    total = c.fetchone()[0]
+    conn.close()
+    return total
+
+
+def inject_failures(api, updates, count, attempts):
+    """Make storing the messages of count updates fail for their first attempts tries"""
+    texts = [u['message']['text'] for u in updates if u.get('message', {}).get('text')]
+    failing = {text: attempts for text in texts[::max(1, len(texts) // count)][:count]} if count else {}
+    store = api.store_inbound_message
+
+    async def flaky_store(user_id, full_name, username, message, throttled=False):
+        if failing.get(message):
+            failing[message] -= 1
+            raise RuntimeError(f'injected failure for {message!r}')
+        await store(user_id, full_name, username, message, throttled)
+
+    api.store_inbound_message = flaky_store
+    api.CATCHUP_RETRY_DELAY = 0.05
+
+
+async def catch_up(api, server, updates, fail_updates=0, fail_attempts=0):
+    """Leave updates pending on the fake server and run the startup catch-up over them twice"""
+    from telegram import Update
+
+    inject_failures(api, updates, fail_updates, fail_attempts)
+    await api.application.initialize()
+    try:
+        server.queue_updates(updates)
+        server.reset_stats()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            await api.catch_up_updates(api.application)
+            elapsed = time.perf_counter() - started
+        stats = api.backlog.stats()
+        print(f"caught up on {stats.get('updates', 0)} updates in {elapsed:.2f}s ({len(updates) / elapsed if elapsed else 0:.0f}/s), "
+              f"{server.stats['getUpdates']} getUpdates calls, {len(server.updates)} left pending")
+        print(f"messages: {count_messages(api)} in DB, written in {stats.get('batches', 0)} transactions; "
+              f"{stats.get('events', 0)} dashboard events, {stats.get('joins', 0)} joins")
+        if fail_updates:
+            print(f"failures: {stats.get('retried', 0)} retries, {stats.get('failed', 0)} update(s) left for polling, "
+                  f"stored offset {api.update_offsets.saved}")
+
+        # Telegram offers unconfirmed updates again after a crash; none may be handled twice
+        server.queue_updates(updates)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            await api.catch_up_updates(api.application)
+            skipped = api.update_offsets.skipped
+            for update in updates[:100]:
+                # Redelivered through the webhook, where no offset is sent
+                await api.update_processor.process_update(Update.de_json(update, api.application.bot), asyncio.sleep(0))
+        print(f"redelivered: {len(server.updates)} left pending, {api.update_offsets.skipped - skipped} of 100 webhook redeliveries skipped, "
+              f"{count_messages(api)} messages in DB, stored offset {api.update_offsets.saved}")
+    finally:
+        await api.application.shutdown()
+
+
+def report(statuses, latencies, elapsed):
+    count = len(latencies)
+    print(f"posted {count} updates in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f}/s)")
+    print(f"status codes: {', '.join(f'{k}={v}' for k, v in sorted(statuses.items()))}")
+    print(f"ack latency p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded updates against /telegram/webhook/<secret>')
+    parser.add_argument('--file', help='Recorded updates (JSON array, JSON lines or getUpdates response)')
+    parser.add_argument('--synthetic', type=int, default=0, help='Generate this many updates instead (local mode)')
+    parser.add_argument('--kinds', default='text,photo,voice,document', help='Kinds for --synthetic')
+    parser.add_argument('--users', type=int, default=50, help='Distinct senders for --synthetic')
+    parser.add_argument('--save', help='Write the replayed updates to this JSON file')
+    parser.add_argument('--url', help='Base URL of a running server; omit to replay in-process')
+    parser.add_argument('--secret', default=os.environ.get('WEBHOOK_SECRET', ''), help='Webhook secret of the running server')
+    parser.add_argument('--concurrency', type=int, default=4, help='Parallel POSTs in --url mode')
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake server latency per call in local mode')
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--catch-up', action='store_true', help='Replay as a backlog pending at startup (polling mode)')
+    parser.add_argument('--fail-updates', type=int, default=0, help='With --catch-up: text updates whose handler fails')
+    parser.add_argument('--fail-attempts', type=int, default=1, help='How many times each of them fails')
+    args = parser.parse_args()
+
+    if not args.file and not args.synthetic:
+        parser.error('give --file or --synthetic')
+
+    if args.url:
+        if not args.file:
+            parser.error('--url replays recorded updates; give --file')
+        if not args.secret:
+            parser.error('--url needs --secret (or WEBHOOK_SECRET)')
+        updates = load_updates(args.file)
+        started = time.perf_counter()
+        statuses, latencies = post_remote(updates, args.url, args.secret, args.concurrency)
+        report(statuses, latencies, time.perf_counter() - started)
+        return
+
+    from fake_telegram import FakeTelegramServer
+
+    server = FakeTelegramServer(latency=args.latency, profile_photos=True).start()
+    workdir = tempfile.mkdtemp(prefix='replay_updates_')
+    os.environ['TELEGRAM_API_BASE'] = server.base_url
+    os.environ['AUTO_START_BOTS'] = '0'
+    os.environ['TELEGRAM_MODE'] = 'polling' if args.catch_up else 'webhook'
+    os.environ.setdefault('WEBHOOK_URL', 'http://127.0.0.1')
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+    try:
+        if args.catch_up:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                import api
+            updates = load_updates(args.file) if args.file else synthetic_updates(server, args.synthetic, args.kinds, args.users)
+            asyncio.run(catch_up(api, server, updates, args.fail_updates, args.fail_attempts))
+            return
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            import api
+            running = api.start_webhook_application()
+        if not running:
+            print('❌ Webhook application did not start')
+            return
+        print(f"Fake Bot API: {server.base_url}, webhook registered: {bool(server.webhook)}")
+
+        updates = load_updates(args.file) if args.file else synthetic_updates(server, args.synthetic, args.kinds, args.users)
+        if args.save:
+            with open(os.path.join(REPO_DIR, args.save) if not os.path.isabs(args.save) else args.save, 'w') as f:
+                json.dump(updates, f)
+
+        server.reset_stats()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            statuses, latencies = post_local(api, updates)
+            acked = time.perf_counter() - started
+            left = wait_for_drain(api, args.drain_timeout)
+            drained = time.perf_counter() - started
+        report(statuses, latencies, acked)
+        latency = api.update_processor.stats()['latency_ms']
+        print(f"handled in {drained:.2f}s ({left} left), handler p50 {latency['p50']} ms, p99 {latency['p99']} ms")
+        calls = {k: v for k, v in server.stats.items() if k not in ('429', '403', 'upload_bytes')}
+        print(f"Bot API calls: {', '.join(f'{k}={v}' for k, v in sorted(calls.items())) or 'none'}")
+    finally:
+        server.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()